@@ -7,11 +7,68 @@ class Paths:
     SESSIONS    = ["experiment", "baseline"]
 
 
+class AlignmentParams:
+    BEHAVIOR_ROOT = "subject_answer/final_data"           # task output, one combined CSV per subject
+    COMBINED_GLOB = "combined_data/subject_*_combined.csv"  # inside <BEHAVIOR_ROOT>/subject_<id>/, latest is used
+    TIME_FORMAT   = "%Y-%m-%d_%H-%M-%S.%f"                 # timestamps written by the task
+    TOLERANCE_S   = 0.05    # a trigger and a behavioral timestamp further apart than this are not the same moment
+    BIN_S         = 0.02    # resolution of the clock-offset histogram
+    JITTER_MS     = 5.0     # trigger audit: a session whose largest per-anchor jitter (std around the anchor's median latency) exceeds this is flagged
+    AUDIT_PATH    = f"{Paths.OUTPUT_ROOT}/trigger_audit.csv"   # per-session table, per-anchor table next to it
+
+    # EEG trigger (ParallelPortDict.EVENT_DICT name) → combined-CSV timestamp column of the same moment
+    ANCHORS = {
+        "show_binding_trials":       "binding_object_appear",
+        "show_difficulty_question":  "binding_difficulty_question_appear",
+        "show_object_in_test_trial": "test_object_appear",
+        "start_retrieval_time":      "test_start_retrival_time",
+        "show_retrieval_question":   "test_retrival_question_appear",
+        "show_colors_answers":       "test_colors_question_appear",
+        "show_scenes_answers":       "test_scenes_question_appear",
+    }
+
+
+class ComputeParams:
+    N_WORKERS         = None   # processes in the across-subject pool (None = all cores)
+    N_JOBS            = None   # n_jobs of every MNE / AutoReject call inside one job (None = cores / workers)
+    MEMORY_FRACTION   = 0.8    # share of the available RAM the pool may admit jobs into
+    RAW_MEMORY_FACTOR = 12     # estimated peak RAM of one job = this × size of its .eeg file
+    POLL_SECONDS      = 1.0    # how often the pool checks for finished jobs
+
+
+class MemoryParams:
+    OUT_OF_CORE   = False   # preload recordings into memory-mapped files instead of RAM
+    MEMMAP_DIR    = None    # folder of the memory-mapped files (None = system temp dir, should be a local disk)
+    CHUNK_SECONDS = 60.0    # length of the chunks channel statistics are computed over
+
+    # filter / notch chunk by chunk into a memory-mapped output (streaming_filter); implies OUT_OF_CORE for reading,
+    # so the recording is preloaded into a memory-mapped file and neither its input nor its output is held in RAM
+    STREAMING_FILTER     = False
+    FILTER_CHUNK_SECONDS = 300.0   # kept samples per filtered chunk (each chunk also reads the filter padding)
+    IIR_DECAY            = 1e-7    # the IIR padding lasts until the impulse response decays below this × its peak
+
+
+class CacheParams:
+    ENABLED           = True
+    CACHE_DIR         = f"{Paths.OUTPUT_ROOT}/.cache"   # <cache>/<subject>/<session>/<stage>_<key>-raw.fif
+    VERSION           = 2      # bump when the code of a stage changes, invalidates every checkpoint
+    CHECKPOINT_STAGES = ["filter", "resample", "bad_channels", "reference", "ica", "epoch", "autoreject"]
+    HASH_CHUNK_BYTES  = 8 * 1024 * 1024
+    MANIFEST_PATH     = f"{Paths.OUTPUT_ROOT}/manifest.json"   # what every finished session was computed from
+
+
+class ProfileParams:
+    ENABLED = True
+    FOLDER  = f"{Paths.OUTPUT_ROOT}/profiles"   # <folder>/<subject>_<session>.json, cohort_summary.json
+    RSS_SAMPLE_SECONDS = 0.05   # interval of the RSS sampling thread during a stage
+
+
 class FilterParams:
     L_FREQ      = 0.1    # high-pass cut-off (Hz)
     H_FREQ      = 40.0   # low-pass cut-off  (Hz)
     NOTCH_FREQ  = 50.0   # power-line noise  (Hz, EU standard)
     RESAMPLE_HZ = 256    # downsample target (Hz)
+    RESAMPLE_FIRST = False   # decimate (anti-aliased) before the band-pass / notch, so they run at the low rate
 
 
 class ICAParams:
@@ -21,6 +78,11 @@ class ICAParams:
     FIT_L_FREQ   = 1.0   # high-pass used only for ICA fitting
 
 
+class AutoRejectParams:
+    FIT_SIZE     = 200   # epochs AutoReject is fitted on, drawn stratified by event type and time (None = all)
+    RANDOM_STATE = 42
+
+
 class EpochParams:
     TMIN     = -0.2       # epoch start relative to trigger (s)
     TMAX     = 1.0        # epoch end   relative to trigger (s)
@@ -42,7 +104,47 @@ class TriggerCodes:
 class RejectCriteria:
     HARD_AMPLITUDE  = 150e-6   # hard threshold before AutoReject (V)
     FLAT_THRESHOLD  = 0.5e-6   # channel std below this → flat channel (V)
-    NOISY_Z_SCORE   = 3        # channel std z-score above this → noisy channel
+
+
+class BadChannelParams:
+    WINDOW_SECONDS      = 1.0    # statistics are computed per window, streamed MemoryParams.CHUNK_SECONDS at a time
+    ROBUST_Z            = 5.0    # window amplitude (MAD) robust z-score (median / MAD across channels) above this → noisy
+    MIN_CORRELATION     = 0.4    # median |correlation| with the nearest neighbours below this → uncorrelated
+    N_NEIGHBOURS        = 4
+    BAD_WINDOW_FRACTION = 0.05   # a channel flagged in more than this share of the windows is bad
+    RANSAC_WINDOWS      = 300    # windows RANSAC is fitted on, evenly spaced over the recording (None = all)
+
+
+class MonitorParams:
+    BLOCK_SECONDS     = 0.1    # samples pushed per block by the stream
+    ROLLING_SECONDS   = 10.0   # time constant of the exponentially weighted channel statistics
+    NOTCH_Q           = 30.0   # quality factor of the causal notch
+    LATENCY_BUDGET_S  = 0.5    # a block processed later than this after it arrived is reported
+    REPORT_SECONDS    = 1.0    # the status is printed at most this often (and whenever the bad channels change)
+    REALTIME          = True   # the file replay paces blocks at the recording rate (False = as fast as possible)
+
+
+class SyntheticParams:
+    N_CHANNELS       = 64
+    MINUTES          = 10.0
+    SFREQ            = 1000
+    MONTAGE          = "easycap-M1"   # channel names and positions ("easycap-M1" or "standard_1020")
+    N_SOURCES        = 8              # spatially smooth background sources mixed into the channels
+    BACKGROUND_UV    = 10.0           # 1/f background amplitude (µV)
+    ALPHA_UV         = 5.0            # 10 Hz posterior alpha amplitude (µV)
+    BLINK_INTERVAL_S = 4.0            # mean time between blinks (s)
+    BLINK_UV         = 150.0          # blink amplitude at the most frontal channel (µV)
+    ECG_HZ           = 1.2
+    ECG_UV           = 5.0
+    LINE_HZ          = 50.0
+    LINE_UV          = 10.0
+    N_BAD            = 2              # bad channels: the first is flat, the others noisy
+    EVENT_INTERVAL_S = (1.5, 4.0)     # min / max time between triggers (s)
+    CHUNK_SECONDS    = 10.0           # generated and written chunk by chunk
+    SEED             = 0
+
+    BENCH_SIZES      = [(32, 5.0, 500), (64, 10.0, 1000), (64, 30.0, 1000), (64, 60.0, 1000)]   # (channels, min, Hz)
+    BENCH_ROOT       = None           # folder of the benchmark data and results (None = <temp dir>/bmr_benchmark)
 
 
 class FrequencyBands:
@@ -62,6 +164,7 @@ class FrequencyBands:
 
 
 class ChannelGroups:
+    EOG       = ["HEOG", "VEOG"]   # typed as EOG channels (no scalp position), not in ALL
     FRONTAL   = ["Fp1", "Fp2", "F3", "F4", "Fz", "F7", "F8"]
     CENTRAL   = ["C3", "C4", "Cz"]
     PARIETAL  = ["P3", "P4", "Pz", "P7", "P8"]
@@ -77,11 +180,54 @@ class ChannelGroups:
     }
 
 
+class SpectralParams:
+    METHOD     = "multitaper"   # mne compute_psd method ("multitaper" or "welch")
+    BANDWIDTH  = 4.0            # multitaper frequency smoothing (Hz)
+    CACHE_DIR  = f"{Paths.OUTPUT_ROOT}/.cache/band_power"   # <cache>/<subject>_<epochs file>_<key>.pkl
+    TABLE_PATH = f"{Paths.OUTPUT_ROOT}/band_power.csv"
+    VERSION    = 1              # bump when the computation changes, invalidates the cache
+
+
 class FileFormat:
     PREPROCESSED_SUFFIX = "-epo.fif"
     SUBJECT_FOLDER_PREFIX = "subject "
 
 
+class EpochFamilies:
+    # events of ParallelPortDict.EVENT_DICT cut with one window per family, events of no family (block starts,
+    # stop markers) are not epoched
+    STIMULUS = {
+        "events":   ['show_red', 'show_green', 'show_yellow', 'show_living_room', 'show_bathroom', 'show_kitchen',
+                     'show_binding_trials', 'show_object_in_test_trial', 'show_colors_answers', 'show_scenes_answers'],
+        "tmin":     -0.4,
+        "tmax":     5.0,
+        "baseline": None,
+    }
+    QUESTION = {
+        "events":   ['show_attention_question', 'show_difficulty_question', 'show_retrieval_question'],
+        "tmin":     -0.4,
+        "tmax":     2.0,
+        "baseline": None,
+    }
+    RESPONSE = {
+        "events":   ['start_retrieval_time', 'answer_on_retrieval_time', 'answer_attention_question',
+                     'answer_difficulty_question', 'answer_retrieval_question', 'answer_color_question',
+                     'answer_scene_question'],
+        "tmin":     -1.0,
+        "tmax":     0.5,
+        "baseline": None,
+    }
+
+    ALL = {
+        "stimulus": STIMULUS,
+        "question": QUESTION,
+        "response": RESPONSE,
+    }
+
+    ICA_FIT_FAMILY = "stimulus"   # the ICA is fitted on this family and applied to all of them
+    SAVE_FLOAT32   = True         # save epochs in single precision (half the disk space)
+
+
 class ParallelPortDict:
     EVENT_DICT = {
         'start_record_baseline': 1,
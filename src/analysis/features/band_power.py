@@ -0,0 +1,125 @@
+import os
+import json
+import hashlib
+from pathlib import Path
+from typing import Optional
+
+import mne
+import numpy as np
+import pandas as pd
+
+from src.analysis.enums.analysis_enums import (ComputeParams, FileFormat, FrequencyBands, ChannelGroups, Paths,
+                                               SpectralParams)
+from src.analysis.pre_processing.batch_runner import Job, run_jobs, n_jobs_per_worker
+from src.analysis.pre_processing.stage_cache import class_params, file_hash
+
+
+def band_matrix(freqs: np.ndarray) -> np.ndarray:
+    """(band, freq) weights integrating a PSD over every FrequencyBands band: the frequency step inside
+       [low, high), 0 outside"""
+    step = np.gradient(freqs) if len(freqs) > 1 else np.ones(1)
+    return np.array([((freqs >= low) & (freqs < high)) * step for low, high in FrequencyBands.ALL.values()])
+
+
+def group_matrix(ch_names: list) -> tuple:
+    """(group, channel) weights averaging the channels of every ChannelGroups group present in ch_names
+       (matched case-insensitively), groups without any channel are left out
+        output: (group names, weights)"""
+    index  = {name.lower(): i for i, name in enumerate(ch_names)}
+    groups, rows = [], []
+    for group, channels in ChannelGroups.ALL.items():
+        present = [index[name.lower()] for name in channels if name.lower() in index]
+        if not present:
+            print(f"  [band power] no channel of group {group}")
+            continue
+        row = np.zeros(len(ch_names))
+        row[present] = 1.0 / len(present)
+        groups.append(group)
+        rows.append(row)
+    return groups, np.array(rows).reshape(len(rows), len(ch_names))
+
+
+def band_power(epochs: mne.BaseEpochs, subject: str, n_jobs: int = 1) -> pd.DataFrame:
+    """per-epoch power of every FrequencyBands band × ChannelGroups group from one batched PSD:
+        1. PSD of every epoch and EEG channel in one compute_psd call (SpectralParams.METHOD)
+        2. integrate over the bands and average over the groups as two matrix products,
+           (epoch, channel, freq) → (epoch, channel, band) → (epoch, group, band)
+        output: tidy table (subject, epoch, event, band, group, power), power in µV²"""
+    fmin      = min(low for low, _ in FrequencyBands.ALL.values())
+    fmax      = max(high for _, high in FrequencyBands.ALL.values())
+    method_kw = {"bandwidth": SpectralParams.BANDWIDTH} if SpectralParams.METHOD == "multitaper" else {}
+    spectrum  = epochs.compute_psd(method=SpectralParams.METHOD, fmin=fmin, fmax=fmax, picks="eeg", n_jobs=n_jobs,
+                                  verbose=False, **method_kw)
+    psd, freqs = spectrum.get_data(return_freqs=True)
+    groups, weights = group_matrix(spectrum.ch_names)
+    power     = np.einsum("ecf,bf,gc->egb", psd, band_matrix(freqs), weights) * 1e12
+
+    code_to_event = {code: name for name, code in epochs.event_id.items()}
+    n_epochs, n_groups, n_bands = power.shape
+    return pd.DataFrame({
+        "subject": subject,
+        "epoch":   np.repeat(np.arange(n_epochs), n_groups * n_bands),
+        "event":   np.repeat([code_to_event.get(code, str(code)) for code in epochs.events[:, 2]], n_groups * n_bands),
+        "band":    np.tile(list(FrequencyBands.ALL), n_epochs * n_groups),
+        "group":   np.tile(np.repeat(groups, n_bands), n_epochs),
+        "power":   power.ravel(),
+    })
+
+
+def cache_key(epochs_path: Path) -> str:
+    """sha256 of the epochs file content and of every parameter the band power depends on (not the output paths)"""
+    params  = {params_class.__name__: class_params(params_class)
+               for params_class in [SpectralParams, FrequencyBands, ChannelGroups]}
+    params["SpectralParams"] = {name: value for name, value in params["SpectralParams"].items()
+                                if name not in ("CACHE_DIR", "TABLE_PATH")}
+    payload = json.dumps({"input": file_hash([epochs_path]), "params": params}, sort_keys=True)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def subject_band_power(subject: str, epochs_paths: list, n_jobs: int = 1,
+                       cache_dir: Path = Path(SpectralParams.CACHE_DIR)) -> pd.DataFrame:
+    """band power of every epochs file of a subject (a 'file' column tells them apart), each reused from the
+       cache when the file content and the parameters did not change"""
+    tables = []
+    for path in map(Path, epochs_paths):
+        key    = cache_key(path)
+        cached = cache_dir / f"{subject}_{path.name.replace(FileFormat.PREPROCESSED_SUFFIX, '')}_{key[:16]}.pkl"
+        if cached.exists():
+            table = pd.read_pickle(cached)
+        else:
+            epochs = mne.read_epochs(path, preload=True, verbose=False)
+            table  = band_power(epochs, subject=subject, n_jobs=n_jobs)
+            cache_dir.mkdir(parents=True, exist_ok=True)
+            table.to_pickle(cached)
+        tables.append(table.assign(file=path.name))
+    return pd.concat(tables, ignore_index=True) if tables else pd.DataFrame()
+
+
+def find_epochs(root: Path = Path(Paths.OUTPUT_ROOT)) -> dict:
+    """{subject: [epochs files]} of the Preprocessing outputs (<root>/<subject>/<session>/*-epo.fif)"""
+    epochs_paths = {}
+    for path in sorted(root.glob(f"*/*/*{FileFormat.PREPROCESSED_SUFFIX}")):
+        epochs_paths.setdefault(path.parent.parent.name, []).append(path)
+    return epochs_paths
+
+
+def cohort_band_power(epochs_paths: Optional[dict] = None, n_workers: Optional[int] = ComputeParams.N_WORKERS,
+                      out_path: Path = Path(SpectralParams.TABLE_PATH)) -> pd.DataFrame:
+    """band power of many subjects, one process per subject (batch_runner.run_jobs):
+        input: epochs_paths: {subject: [epochs .fif paths]} (default: find_epochs())
+        output: tidy table (subject, file, epoch, event, band, group, power) of every subject, written to out_path"""
+    epochs_paths = epochs_paths if epochs_paths is not None else find_epochs()
+    if not epochs_paths:
+        raise FileNotFoundError("No epochs files to compute band power on")
+    n_workers = min(n_workers or os.cpu_count() or 1, len(epochs_paths))
+    n_jobs    = n_jobs_per_worker(n_workers)
+    jobs = [Job(key=f"{subject} band power", function=subject_band_power,
+                kwargs=dict(subject=subject, epochs_paths=paths, n_jobs=n_jobs), n_threads=n_jobs)
+            for subject, paths in epochs_paths.items()]
+    rows   = run_jobs(jobs=jobs, n_workers=n_workers)
+    tables = [row["result"] for row in rows if row["status"] == "ok" and len(row["result"])]
+    table  = pd.concat(tables, ignore_index=True) if tables else pd.DataFrame()
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    table.to_csv(out_path, index=False)
+    print(f"  [band power] {table['subject'].nunique() if len(table) else 0} subjects, {len(table)} rows -> {out_path}")
+    return table
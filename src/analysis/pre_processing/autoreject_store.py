@@ -0,0 +1,58 @@
+import json
+from datetime import datetime
+from pathlib import Path
+from typing import Callable, Optional
+
+import mne
+import numpy as np
+from autoreject import read_auto_reject
+
+from src.analysis.pre_processing.ica_store import data_fingerprint
+
+
+def stratified_subsample(epochs: mne.BaseEpochs, size: Optional[int]) -> np.ndarray:
+    """indices of at most size epochs: every event type gets a share proportional to its count (at least one),
+       taken evenly spaced over the session so the start, middle and end of it are all represented"""
+    if not size or size >= len(epochs):
+        return np.arange(len(epochs))
+    codes   = epochs.events[:, 2]
+    indices = []
+    for code in np.unique(codes):
+        of_code = np.where(codes == code)[0]
+        share   = max(1, int(round(size * len(of_code) / len(epochs))))
+        picks   = np.unique(np.round(np.linspace(0, len(of_code) - 1, min(share, len(of_code)))).astype(int))
+        indices.extend(of_code[picks])
+    return np.sort(np.array(indices))
+
+
+class AutoRejectStore:
+    def __init__(self, ar_path: Path):
+        """persisted AutoReject fit of one subject session:
+            input: ar_path: the <name>-ar.hdf5 file, a <name>-ar.json sidecar next to it keeps the fingerprint of
+                   the epochs, the fitted epoch indices and the learned thresholds / interpolation parameters
+           a rerun on the same epochs with the same parameters skips the fit and only transforms"""
+        self.ar_path      = ar_path
+        self.sidecar_path = ar_path.with_name(ar_path.name.replace("-ar.hdf5", "-ar.json"))
+
+    def get(self, epochs: mne.BaseEpochs, params: dict, fit_size: Optional[int], make_ar: Callable):
+        """the AutoReject of epochs: loaded if it was fitted on the same epochs with the same parameters,
+           else fitted on a stratified subsample of fit_size epochs and saved
+            input: make_ar: returns the unfitted AutoReject, called only on a refit"""
+        fingerprint = data_fingerprint(epochs, {**params, "fit_size": fit_size})
+        sidecar     = json.loads(self.sidecar_path.read_text()) if self.sidecar_path.exists() else {}
+        if self.ar_path.exists() and sidecar.get("fingerprint") == fingerprint:
+            print(f"  [AutoReject] reusing {self.ar_path.name}")
+            return read_auto_reject(self.ar_path)
+
+        fit_idx = stratified_subsample(epochs, fit_size)
+        print(f"  [AutoReject] fitting on {len(fit_idx)}/{len(epochs)} epochs")
+        ar = make_ar()
+        ar.fit(epochs[fit_idx])
+        self.ar_path.parent.mkdir(parents=True, exist_ok=True)
+        ar.save(self.ar_path, overwrite=True)
+        self.sidecar_path.write_text(json.dumps({
+            "fingerprint": fingerprint, "params": params, "fit_size": fit_size, "fit_indices": fit_idx.tolist(),
+            "thresholds": getattr(ar, "threshes_", None), "n_interpolate": getattr(ar, "n_interpolate_", None),
+            "consensus": getattr(ar, "consensus_", None), "fitted": datetime.now().isoformat(timespec="seconds"),
+        }, indent=2, default=float))
+        return ar
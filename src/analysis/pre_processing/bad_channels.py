@@ -0,0 +1,76 @@
+from typing import Optional
+
+import mne
+import numpy as np
+
+from src.analysis.enums.analysis_enums import BadChannelParams, RejectCriteria
+from src.analysis.pre_processing.memory import chunks
+
+MAD_TO_STD = 1.4826
+
+
+def detect_bad_channels(raw: mne.io.BaseRaw, picks="eeg") -> dict:
+    """robust windowed bad-channel detection, streamed over the recording chunk by chunk (bounded memory):
+        1. cut every chunk into WINDOW_SECONDS windows
+        2. per window and channel: robust amplitude (MAD over time), flat if below RejectCriteria.FLAT_THRESHOLD,
+           noisy if its robust z-score across channels (median / MAD) is above ROBUST_Z
+        3. per window and channel: median |correlation| with its N_NEIGHBOURS nearest channels (all channels
+           without positions), uncorrelated if below MIN_CORRELATION
+        4. a channel is bad for a reason if it is flagged in more than BAD_WINDOW_FRACTION of the windows,
+           so a single transient burst neither flags nor masks a channel
+        output: {channel name: {reason: fraction of windows}} of the bad channels"""
+    pick_idx   = mne.pick_types(raw.info, eeg=True) if picks == "eeg" else mne.pick_channels(raw.ch_names, picks)
+    names      = [raw.ch_names[i] for i in pick_idx]
+    neighbours = _neighbours(raw.info, pick_idx)
+    window     = max(2, int(BadChannelParams.WINDOW_SECONDS * raw.info["sfreq"]))
+    counts     = {reason: np.zeros(len(names)) for reason in ["flat", "noisy", "uncorrelated"]}
+    n_windows  = 0
+
+    for start, stop in chunks(raw):
+        data = raw.get_data(picks=pick_idx, start=start, stop=stop)
+        n    = data.shape[1] // window
+        if n == 0:
+            continue
+        windows = data[:, :n * window].reshape(len(names), n, window).transpose(1, 0, 2)   # (window, channel, time)
+
+        amplitude = MAD_TO_STD * np.median(np.abs(windows - np.median(windows, axis=2, keepdims=True)), axis=2)
+        median    = np.median(amplitude, axis=1, keepdims=True)
+        spread    = MAD_TO_STD * np.median(np.abs(amplitude - median), axis=1, keepdims=True)
+        counts["flat"]  += (amplitude < RejectCriteria.FLAT_THRESHOLD).sum(axis=0)
+        robust_z  = (amplitude - median) / np.where(spread > 0, spread, np.inf)
+        counts["noisy"] += (robust_z > BadChannelParams.ROBUST_Z).sum(axis=0)
+
+        centered = windows - windows.mean(axis=2, keepdims=True)
+        norms    = np.linalg.norm(centered, axis=2, keepdims=True)
+        unit     = centered / np.where(norms > 0, norms, np.inf)
+        corr     = np.abs(np.einsum("wct,wdt->wcd", unit, unit))
+        neighbour_corr = np.median(np.take_along_axis(corr, neighbours[None].repeat(n, axis=0), axis=2), axis=2)
+        counts["uncorrelated"] += (neighbour_corr < BadChannelParams.MIN_CORRELATION).sum(axis=0)
+        n_windows += n
+
+    bads = {}
+    for reason, count in counts.items():
+        for index in np.where(count / max(n_windows, 1) > BadChannelParams.BAD_WINDOW_FRACTION)[0]:
+            bads.setdefault(names[index], {})[reason] = round(float(count[index] / n_windows), 3)
+    return bads
+
+
+def _neighbours(info: mne.Info, pick_idx: np.ndarray) -> np.ndarray:
+    """(channel, N_NEIGHBOURS) indices of the nearest channels by sensor position,
+       every other channel if positions are missing"""
+    positions = np.array([info["chs"][i]["loc"][:3] for i in pick_idx])
+    n_channels = len(pick_idx)
+    if np.isnan(positions).any() or not np.any(positions):
+        return np.array([[j for j in range(n_channels) if j != i] for i in range(n_channels)])
+    distances = np.linalg.norm(positions[:, None] - positions[None], axis=2)
+    np.fill_diagonal(distances, np.inf)
+    return np.argsort(distances, axis=1)[:, :min(BadChannelParams.N_NEIGHBOURS, n_channels - 1)]
+
+
+def ransac_windows(raw: mne.io.BaseRaw, n_windows: Optional[int] = BadChannelParams.RANSAC_WINDOWS) -> mne.Epochs:
+    """WINDOW_SECONDS fixed-length epochs for RANSAC: at most n_windows evenly spaced over the recording,
+       only those are loaded into memory"""
+    epochs = mne.make_fixed_length_epochs(raw, duration=BadChannelParams.WINDOW_SECONDS, preload=False, verbose=False)
+    if n_windows and len(epochs) > n_windows:
+        epochs = epochs[np.unique(np.linspace(0, len(epochs) - 1, n_windows).astype(int))]
+    return epochs.load_data()
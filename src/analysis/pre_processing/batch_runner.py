@@ -0,0 +1,157 @@
+import os
+import time
+import queue
+import traceback
+import multiprocessing
+from typing import Callable, Optional
+
+from src.analysis.enums.analysis_enums import ComputeParams
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+try:
+    from threadpoolctl import threadpool_limits
+except ImportError:
+    threadpool_limits = None
+
+
+class Job:
+    def __init__(self, key: str, function: Callable, kwargs: dict, memory_estimate: int = 0,
+                 n_threads: Optional[int] = None):
+        """one isolated unit of batch work:
+            input: key: unique name of the job (e.g. 'subject 101/experiment')
+                   function: top-level (picklable) function run in a fresh process as function(**kwargs)
+                   kwargs: picklable keyword arguments
+                   memory_estimate: expected peak RAM of the job in bytes (0 = unknown)
+                   n_threads: cap on the BLAS / OpenMP threads of the worker (None = no cap)"""
+        self.key             = key
+        self.function        = function
+        self.kwargs          = kwargs
+        self.memory_estimate = memory_estimate
+        self.n_threads       = n_threads
+
+
+def n_jobs_per_worker(n_workers: Optional[int] = 1) -> int:
+    """n_jobs for the MNE / AutoReject calls of one job: ComputeParams.N_JOBS if set, else the cores split
+       evenly across the workers running at the same time, so nested parallelism does not oversubscribe"""
+    if ComputeParams.N_JOBS:
+        return ComputeParams.N_JOBS
+    cores = os.cpu_count() or 1
+    return max(1, cores // (n_workers or cores))
+
+
+def available_memory() -> Optional[int]:
+    """bytes of RAM currently available (psutil, or sysconf on Linux), None if it can not be determined"""
+    if psutil is not None:
+        return psutil.virtual_memory().available
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def _job_entry(job: Job, results: multiprocessing.Queue):
+    """run one job inside its worker process and report (key, status, result, error, wall time)"""
+    start = time.perf_counter()
+    try:
+        if job.n_threads and threadpool_limits is not None:
+            with threadpool_limits(limits=job.n_threads):
+                result = job.function(**job.kwargs)
+        else:
+            result = job.function(**job.kwargs)
+        results.put((job.key, "ok", result, None, time.perf_counter() - start))
+    except Exception:
+        results.put((job.key, "failed", None, traceback.format_exc(), time.perf_counter() - start))
+
+
+def run_jobs(jobs: list, n_workers: Optional[int] = ComputeParams.N_WORKERS,
+             memory_fraction: float = ComputeParams.MEMORY_FRACTION) -> list:
+    """run jobs in a pool of isolated processes (one fresh 'spawn' process per job):
+        1. admit the next job when a worker slot is free and the memory estimates of the running jobs plus
+           the next one fit in memory_fraction of the RAM available at start (the first job is always admitted)
+        2. collect results as jobs finish; an exception or a crashed process (e.g. killed for memory)
+           marks only that job as failed, the rest of the batch continues
+        3. print a summary of status and wall time per job
+        output: list of {key, status, wall_s, result, error} in the order of jobs"""
+    n_workers  = n_workers or os.cpu_count() or 1
+    free       = available_memory()
+    budget     = free * memory_fraction if free else None
+    context    = multiprocessing.get_context("spawn")
+    results    = context.Queue()
+    pending    = list(jobs)
+    running    = {}
+    started    = {}
+    summary    = {}
+
+    print(f"  [batch] {len(jobs)} jobs on {n_workers} workers"
+          + (f", memory budget {budget / 1e9:.1f} GB" if budget else ""))
+
+    try:
+        while pending or running:
+            while pending and len(running) < n_workers and _fits(pending[0], running, budget):
+                job = pending.pop(0)
+                # not daemonic: joblib (n_jobs of MNE / AutoReject) can not start workers from a daemonic process,
+                # so the workers are terminated explicitly below instead
+                process = context.Process(target=_job_entry, args=(job, results), daemon=False)
+                process.start()
+                running[job.key] = (job, process)
+                started[job.key] = time.perf_counter()
+
+            _collect(results=results, running=running, summary=summary, timeout=ComputeParams.POLL_SECONDS)
+            for key, (job, process) in list(running.items()):
+                if process.is_alive():
+                    continue
+                # the result of a process that just exited may still be in the queue
+                _collect(results=results, running=running, summary=summary, timeout=0.1)
+                if key in running:
+                    running.pop(key)
+                    process.join()
+                    summary[key] = {"key": key, "status": "crashed", "wall_s": time.perf_counter() - started[key],
+                                    "result": None, "error": f"worker exited with code {process.exitcode}"}
+                    print(f"  [batch] crashed {key} (exit code {process.exitcode})")
+    finally:
+        # an interrupted batch (Ctrl+C, an error in the parent) must not leave workers behind
+        for _, process in running.values():
+            process.terminate()
+            process.join()
+
+    rows = [summary[job.key] for job in jobs]
+    _print_summary(rows)
+    return rows
+
+
+def _collect(results: multiprocessing.Queue, running: dict, summary: dict, timeout: float):
+    """wait up to timeout for a finished job, then take every other result already in the queue"""
+    while True:
+        try:
+            key, status, result, error, wall = results.get(timeout=timeout)
+        except queue.Empty:
+            return
+        summary[key] = {"key": key, "status": status, "wall_s": wall, "result": result, "error": error}
+        _, process = running.pop(key)
+        process.join()
+        print(f"  [batch] {status:<7} {key} ({wall:.1f} s)")
+        if error:
+            print(error)
+        timeout = 0
+
+
+def _fits(job: Job, running: dict, budget: Optional[float]) -> bool:
+    """True if the job may start now under the memory budget"""
+    if budget is None or not running:
+        return True
+    in_use = sum(running_job.memory_estimate for running_job, _ in running.values())
+    return in_use + job.memory_estimate <= budget
+
+
+def _print_summary(rows: list):
+    """print the per-job status and wall time table"""
+    print(f"\n{'='*60}")
+    print(f"  Batch summary: {sum(row['status'] == 'ok' for row in rows)}/{len(rows)} ok, "
+          f"{sum(row['wall_s'] for row in rows) / 60:.1f} min of job time")
+    for row in rows:
+        print(f"  {row['status']:<7} {row['wall_s']:8.1f} s  {row['key']}")
+    print(f"{'='*60}")
@@ -0,0 +1,132 @@
+from pathlib import Path
+from typing import Optional
+
+import mne
+import numpy as np
+import pandas as pd
+
+from src.analysis.enums.analysis_enums import AlignmentParams, ParallelPortDict
+
+
+def load_behavior(subject_id: str, behavior_root: Path = Path(AlignmentParams.BEHAVIOR_ROOT)) -> Optional[pd.DataFrame]:
+    """the latest combined CSV of a subject (one row per binding trial), None if there is none"""
+    csvs = sorted((behavior_root / f"subject_{subject_id}").glob(AlignmentParams.COMBINED_GLOB))
+    return pd.read_csv(csvs[-1]) if csvs else None
+
+
+def _seconds(timestamps: pd.Series) -> np.ndarray:
+    """task timestamps as seconds (NaN where missing)"""
+    parsed = pd.to_datetime(timestamps, format=AlignmentParams.TIME_FORMAT, errors="coerce")
+    return (parsed - pd.Timestamp("1970-01-01")).dt.total_seconds().to_numpy()
+
+
+def _anchor_pairs(events: np.ndarray, sfreq: float, behavior: pd.DataFrame) -> list:
+    """per anchor: (name, eeg event indices, eeg seconds, behavior row indices, behavior seconds)"""
+    pairs = []
+    for name, column in AlignmentParams.ANCHORS.items():
+        if column not in behavior:
+            continue
+        eeg_idx  = np.where(events[:, 2] == ParallelPortDict.EVENT_DICT[name])[0]
+        beh_time = _seconds(behavior[column])
+        beh_idx  = np.where(~np.isnan(beh_time))[0]
+        if len(eeg_idx) and len(beh_idx):
+            pairs.append((name, eeg_idx, events[eeg_idx, 0] / sfreq, beh_idx, beh_time[beh_idx]))
+    return pairs
+
+
+def estimate_clock(pairs: list) -> tuple:
+    """map from task clock to EEG clock, eeg = slope × task + offset:
+        1. offset: mode of every pairwise (eeg − task) difference of every anchor (vectorized histogram with
+           BIN_S bins), the true pairs all share it while missing / extra triggers only add scattered differences
+        2. slope and offset refined by least squares on the pairs within TOLERANCE_S of that offset (clock drift)
+        output: (slope, offset)"""
+    differences = np.concatenate([(eeg[:, None] - beh[None, :]).ravel() for _, _, eeg, _, beh in pairs])
+    bins        = np.floor(differences / AlignmentParams.BIN_S).astype(np.int64)
+    values, counts = np.unique(bins, return_counts=True)
+    # a true offset can straddle two bins, so count each bin together with its right neighbour
+    neighbour   = np.append(counts[1:] * (np.diff(values) == 1), 0)
+    best        = values[np.argmax(counts + neighbour)]
+    offset      = np.median(differences[(bins == best) | (bins == best + 1)])
+
+    task, eeg = [], []
+    for _, _, eeg_time, _, beh_time in pairs:
+        index, error = _nearest(eeg_time, beh_time + offset)
+        near = np.abs(error) < AlignmentParams.TOLERANCE_S
+        task.append(beh_time[near])
+        eeg.append(eeg_time[index[near]])
+    task, eeg = np.concatenate(task), np.concatenate(eeg)
+    if len(task) < 3 or np.ptp(task) == 0:
+        return 1.0, offset
+    slope, intercept = np.polyfit(task - task[0], eeg, 1)
+    return slope, intercept - slope * task[0]
+
+
+def _nearest(sorted_times: np.ndarray, targets: np.ndarray) -> tuple:
+    """index of the nearest value of sorted_times to every target and the signed error (vectorized)"""
+    right = np.clip(np.searchsorted(sorted_times, targets), 0, len(sorted_times) - 1)
+    left  = np.maximum(right - 1, 0)
+    index = np.where(np.abs(sorted_times[left] - targets) <= np.abs(sorted_times[right] - targets), left, right)
+    return index, sorted_times[index] - targets
+
+
+def align_events(events: np.ndarray, sfreq: float, behavior: pd.DataFrame, clock: Optional[tuple] = None) -> tuple:
+    """match every anchor trigger to the behavioral row of the same moment, tolerating missing and extra triggers:
+        1. estimate the task → EEG clock map (estimate_clock), unless a (slope, offset) clock is given
+        2. per anchor, the nearest trigger of every predicted behavioral timestamp within TOLERANCE_S,
+           one-to-one (a trigger claimed by two rows keeps the closer one)
+        output: (row index per event, -1 if unmatched; alignment error (ms) per event; summary DataFrame)"""
+    row_of_event = np.full(len(events), -1)
+    error_ms     = np.full(len(events), np.nan)
+    summary      = []
+    pairs        = _anchor_pairs(events, sfreq, behavior)
+    if not pairs:
+        return row_of_event, error_ms, pd.DataFrame(summary)
+
+    slope, offset = clock or estimate_clock(pairs)
+    for name, eeg_idx, eeg_time, beh_idx, beh_time in pairs:
+        index, error = _nearest(eeg_time, slope * beh_time + offset)
+        near  = np.where(np.abs(error) < AlignmentParams.TOLERANCE_S)[0]
+        near  = near[np.argsort(np.abs(error[near]))]
+        _, first = np.unique(index[near], return_index=True)
+        keep  = near[first]
+        row_of_event[eeg_idx[index[keep]]] = beh_idx[keep]
+        error_ms[eeg_idx[index[keep]]]     = error[keep] * 1000
+        summary.append({"anchor": name, "triggers": len(eeg_idx), "rows": len(beh_idx), "matched": len(keep),
+                        "median_error_ms": float(np.median(np.abs(error[keep]))) * 1000 if len(keep) else None})
+    summary = pd.DataFrame(summary)
+    summary["drift_ppm"] = (slope - 1) * 1e6
+    return row_of_event, error_ms, summary
+
+
+def attach_behavior(epochs: mne.BaseEpochs, behavior: pd.DataFrame) -> pd.DataFrame:
+    """add the matched behavioral row (object, features, both_correct, RTs, difficulty, ...) to the metadata of
+       every epoch whose trigger is an anchor, plus 'behavior_row' and 'alignment_error_ms' (NaN if unmatched)
+        output: the alignment summary per anchor"""
+    row_of_event, error_ms, summary = align_events(epochs.events, epochs.info["sfreq"], behavior)
+    matched  = behavior.reindex(np.where(row_of_event >= 0, row_of_event, -1)).reset_index(drop=True)
+    matched["behavior_row"]       = np.where(row_of_event >= 0, row_of_event, np.nan)
+    matched["alignment_error_ms"] = error_ms
+    metadata = (epochs.metadata.reset_index(drop=True) if epochs.metadata is not None
+                else pd.DataFrame(index=matched.index))
+    # a re-alignment (e.g. after a newer combined CSV) replaces the columns of the previous one
+    epochs.metadata = pd.concat([metadata.drop(columns=[c for c in metadata if c in matched]), matched], axis=1)
+    return summary
+
+
+def align_subjects(epochs_paths: dict, behavior_root: Path = Path(AlignmentParams.BEHAVIOR_ROOT)) -> pd.DataFrame:
+    """align many subjects in one call: {subject id: [epochs .fif paths]}, every file is read, gets the behavioral
+       metadata of its subject and is saved back; output: alignment summary of every subject, file and anchor"""
+    summaries = []
+    for subject_id, paths in epochs_paths.items():
+        behavior = load_behavior(subject_id, behavior_root)
+        if behavior is None:
+            print(f"  [align] no combined CSV for subject {subject_id}")
+            continue
+        for path in paths:
+            epochs  = mne.read_epochs(path, preload=True, verbose=False)
+            summary = attach_behavior(epochs, behavior)
+            epochs.save(path, overwrite=True, verbose=False)
+            summaries.append(summary.assign(subject=subject_id, file=Path(path).name))
+            print(f"  [align] subject {subject_id} {Path(path).name}: "
+                  f"{int(summary['matched'].sum()) if len(summary) else 0} epochs matched")
+    return pd.concat(summaries, ignore_index=True) if summaries else pd.DataFrame()
@@ -0,0 +1,112 @@
+import json
+import tempfile
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from src.analysis.enums.analysis_enums import (Paths, CacheParams, ProfileParams, SyntheticParams, FileFormat)
+from src.analysis.pre_processing.batch_runner import Job, run_jobs
+from src.analysis.pre_processing.synthetic_data import write_brainvision
+
+
+def _redirect_outputs(out_root: Path):
+    """point every output of the pipelines into the benchmark folder (runs inside the worker process),
+       with the stage cache off so every run computes every stage"""
+    Paths.OUTPUT_ROOT           = str(out_root / "preprocessed")
+    CacheParams.ENABLED         = False
+    CacheParams.CACHE_DIR       = str(out_root / "cache")
+    CacheParams.MANIFEST_PATH   = str(out_root / "manifest.json")
+    ProfileParams.FOLDER        = str(out_root / "profiles")
+
+
+def _bench_preprocessing(subject_dir: Path, out_root: Path) -> dict:
+    """run Preprocessing on one synthetic session, output: its profile"""
+    _redirect_outputs(out_root)
+    from src.analysis.pre_processing.pipeline import Preprocessing
+    pre_processing = Preprocessing(subject_dir=subject_dir, session="experiment")
+    pre_processing.run()
+    return {"recording_seconds": pre_processing.profiler.recording_seconds, "stages": pre_processing.profiler.stages}
+
+
+def _bench_or_pipeline(data_path: Path, subject_id: str, out_root: Path) -> dict:
+    """run OrPipeline (automatic bad channels, no figures) on one synthetic session, output: its profile"""
+    _redirect_outputs(out_root)
+    from src.analysis.pre_processing.or_pipeline import OrPipeline
+    pipe = OrPipeline(path=data_path, subject_id=subject_id, make_figures=False)
+    pipe.run(do_auto_bad_ch=True)
+    return {"recording_seconds": pipe.profiler.recording_seconds, "stages": pipe.profiler.stages}
+
+
+def run_benchmark(sizes: list = SyntheticParams.BENCH_SIZES, root: Path = None) -> pd.DataFrame:
+    """time and memory scaling of both pipelines on synthetic recordings:
+        1. write one synthetic recording per (n_channels, minutes, sfreq) size, in the layout both pipelines read
+           (<root>/data/EEG_data/subject <id>/experiment/Bindingdecoding<id>.vhdr)
+        2. run each pipeline on each recording in its own process, one at a time (clean timing and peak RSS)
+        3. table of wall time, cpu time and peak RSS per pipeline, size and stage, plus the per-pipeline slope
+           of wall time and peak RSS over recording minutes
+        output: the table, also written to <root>/benchmark.csv and the scaling to <root>/scaling.json"""
+    root      = Path(root or SyntheticParams.BENCH_ROOT or Path(tempfile.gettempdir()) / "bmr_benchmark")
+    data_path = root / "data"
+    jobs      = []
+    for index, (n_channels, minutes, sfreq) in enumerate(sizes):
+        subject_id = f"{900 + index}"
+        subject    = data_path / "EEG_data" / f"{FileFormat.SUBJECT_FOLDER_PREFIX}{subject_id}"
+        write_brainvision(subject / "experiment" / f"Bindingdecoding{subject_id}.vhdr",
+                          n_channels=n_channels, minutes=minutes, sfreq=sfreq)
+        size = dict(n_channels=n_channels, minutes=minutes, sfreq=sfreq)
+        jobs.append(Job(key=json.dumps({"pipeline": "preprocessing", **size}), function=_bench_preprocessing,
+                        kwargs=dict(subject_dir=subject, out_root=root / "out" / f"pre_{subject_id}")))
+        jobs.append(Job(key=json.dumps({"pipeline": "or_pipeline", **size}), function=_bench_or_pipeline,
+                        kwargs=dict(data_path=data_path, subject_id=subject_id,
+                                    out_root=root / "out" / f"or_{subject_id}")))
+
+    rows = []
+    for row in run_jobs(jobs=jobs, n_workers=1):
+        run = json.loads(row["key"])
+        if row["status"] != "ok":
+            rows.append({**run, "stage": "total", "status": row["status"], "wall_s": row["wall_s"]})
+            continue
+        stages = row["result"]["stages"]
+        rows += [{**run, "stage": stage["stage"], "status": "ok", "wall_s": stage["wall_s"], "cpu_s": stage["cpu_s"],
+                  "peak_rss": stage["peak_rss"]} for stage in stages]
+        rows.append({**run, "stage": "total", "status": "ok", "wall_s": row["wall_s"],
+                     "cpu_s": sum(stage["cpu_s"] for stage in stages),
+                     "peak_rss": max((stage["peak_rss"] or 0 for stage in stages), default=0)})
+
+    table = pd.DataFrame(rows)
+    table.to_csv(root / "benchmark.csv", index=False)
+    scaling = _scaling(table)
+    (root / "scaling.json").write_text(json.dumps(scaling, indent=2))
+    _print_scaling(table, scaling)
+    return table
+
+
+def _scaling(table: pd.DataFrame) -> dict:
+    """per pipeline: least-squares slope of total wall time (s) and peak RSS (GB) per recording minute"""
+    scaling = {}
+    totals  = table[(table["stage"] == "total") & (table["status"] == "ok")]
+    for pipeline, runs in totals.groupby("pipeline"):
+        if runs["minutes"].nunique() < 2:
+            continue
+        scaling[pipeline] = {"wall_s_per_min":   float(np.polyfit(runs["minutes"], runs["wall_s"], 1)[0]),
+                             "peak_gb_per_min":  float(np.polyfit(runs["minutes"], runs["peak_rss"] / 1e9, 1)[0])}
+    return scaling
+
+
+def _print_scaling(table: pd.DataFrame, scaling: dict):
+    """print the totals per run and the scaling slopes"""
+    print(f"\n{'='*60}")
+    print("  Benchmark")
+    for _, run in table[table["stage"] == "total"].iterrows():
+        peak = f"{run['peak_rss'] / 1e9:5.2f} GB" if run.get("peak_rss") else "    n/a"
+        print(f"  {run['pipeline']:<14} {run['n_channels']:3d} ch {run['minutes']:5.1f} min {run['sfreq']:5d} Hz  "
+              f"{run['wall_s']:8.1f} s  {peak}  {run['status']}")
+    for pipeline, slopes in scaling.items():
+        print(f"  {pipeline:<14} {slopes['wall_s_per_min']:.2f} s and {slopes['peak_gb_per_min']:.3f} GB "
+              f"per recording minute")
+    print(f"{'='*60}")
+
+
+if __name__ == "__main__":
+    run_benchmark()
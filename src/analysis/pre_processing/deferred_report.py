@@ -0,0 +1,76 @@
+import multiprocessing
+from pathlib import Path
+
+
+class DeferredReport:
+    def __init__(self, fig_path: Path, title: str):
+        """figures of a pipeline run, collected while it runs and rendered afterwards in a separate process:
+            input: fig_path: folder of the figures, every figure is saved there as <name>.png and the
+                   html report as <title>-report.html
+                   title: title of the report
+           the processing path only stores the (small) objects to plot, so it needs no display backend"""
+        self.fig_path = fig_path
+        self.title    = title
+        self.items    = []
+
+    def add(self, kind: str, name: str, **payload):
+        """queue a figure: kind is a key of RENDERERS, name the png file name, payload its arguments"""
+        self.items.append((kind, name, payload))
+
+    def start(self) -> multiprocessing.Process:
+        """render the queued figures in a 'spawn' process and return it (the caller may join it)"""
+        process = multiprocessing.get_context("spawn").Process(
+            target=_render, args=(self.items, self.fig_path, self.title))
+        process.start()
+        print(f"  [report] rendering {len(self.items)} figures in the background (pid {process.pid})")
+        self.items = []
+        return process
+
+
+def _ica_overlay(ica, evoked, exclude):
+    return ica.plot_overlay(evoked, exclude=exclude, show=False)
+
+
+def _ica_components(ica, picks):
+    figs = ica.plot_components(picks, show=False)
+    return figs[0] if isinstance(figs, list) else figs
+
+
+def _bad_epochs(epochs, scalings):
+    return epochs.plot(scalings=scalings, show=False)
+
+
+def _reject_log(reject_log):
+    return reject_log.plot('horizontal', show=False)
+
+
+RENDERERS = {
+    "ica_overlay":    _ica_overlay,
+    "ica_components": _ica_components,
+    "bad_epochs":     _bad_epochs,
+    "reject_log":     _reject_log,
+}
+
+
+def _render(items: list, fig_path: Path, title: str):
+    """worker: draw every queued figure off-screen, save it as png and collect it in an mne.Report"""
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    import mne
+    mne.viz.set_browser_backend("matplotlib")
+
+    report = mne.Report(title=title, verbose=False)
+    for kind, name, payload in items:
+        try:
+            fig = RENDERERS[kind](**payload)
+        except Exception as e:
+            print(f"  [report] skipping {name}: {e}")
+            continue
+        fig.savefig(fig_path / f"{name}.png")
+        report.add_figure(fig, title=name)
+        plt.close(fig)
+
+    report_path = fig_path / f"{title}-report.html"
+    report.save(report_path, overwrite=True, open_browser=False, verbose=False)
+    print(f"  [report] saved {report_path}")
@@ -0,0 +1,80 @@
+import json
+import hashlib
+from datetime import datetime
+from pathlib import Path
+from typing import Callable, Union
+
+import mne
+import numpy as np
+
+try:
+    from mne_icalabel import label_components
+except ImportError:
+    label_components = None
+
+
+def data_fingerprint(inst: Union[mne.io.BaseRaw, mne.BaseEpochs], params: dict) -> str:
+    """sha256 of the data an ICA is fitted on: channel names, sampling rate, shape, the fit parameters
+       and the samples (hashed channel by channel, so only one channel is copied at a time)"""
+    n_epochs = len(inst) if isinstance(inst, mne.BaseEpochs) else None
+    digest   = hashlib.sha256(json.dumps({"ch_names": inst.ch_names, "sfreq": inst.info["sfreq"],
+                                          "n_times": len(inst.times), "n_epochs": n_epochs, "params": params},
+                                         sort_keys=True, default=str).encode())
+    for pick in range(len(inst.ch_names)):
+        digest.update(np.ascontiguousarray(inst.get_data(picks=[pick])).tobytes())
+    return digest.hexdigest()
+
+
+class IcaStore:
+    def __init__(self, ica_path: Path):
+        """persisted ICA decomposition of one subject session:
+            input: ica_path: the <name>-ica.fif file, a <name>-ica.json sidecar next to it keeps the
+                   fingerprint of the data the ICA was fitted on and the cached ICLabel results
+           every fit / inspect / apply path asks the store, which refits only when the data or parameters changed"""
+        self.ica_path     = ica_path
+        self.sidecar_path = ica_path.with_name(ica_path.name.replace("-ica.fif", "-ica.json"))
+        self.fingerprint  = None
+
+    def get(self, inst: Union[mne.io.BaseRaw, mne.BaseEpochs], params: dict, make_fit_input: Callable,
+            make_ica: Callable) -> mne.preprocessing.ICA:
+        """the ICA of inst: loaded if it was fitted on the same data with the same parameters, else fitted and saved
+            input: inst: the data the fit input is made from (fingerprinted)
+                   params: fit parameters (part of the fingerprint)
+                   make_fit_input: returns the data to fit on (e.g. a high-passed copy), called only on a refit
+                   make_ica: returns the unfitted mne ICA, called only on a refit"""
+        self.fingerprint = data_fingerprint(inst, params)
+        sidecar = self._read_sidecar()
+        if self.ica_path.exists() and sidecar.get("fingerprint") == self.fingerprint:
+            print(f"  [ICA] reusing {self.ica_path.name}")
+            return mne.preprocessing.read_ica(self.ica_path, verbose=False)
+
+        ica = make_ica()
+        ica.fit(make_fit_input(), verbose=False)
+        self.ica_path.parent.mkdir(parents=True, exist_ok=True)
+        ica.save(self.ica_path, overwrite=True, verbose=False)
+        self._write_sidecar({"fingerprint": self.fingerprint, "params": params,
+                             "fitted": datetime.now().isoformat(timespec="seconds")})
+        return ica
+
+    def labels(self, ica: mne.preprocessing.ICA, make_fit_input: Callable) -> dict:
+        """ICLabel results of the stored ICA {'labels': [...], 'y_pred_proba': [...]}, computed once per fit
+           (call get first)"""
+        sidecar = self._read_sidecar()
+        if "iclabel" in sidecar and sidecar.get("fingerprint") == self.fingerprint:
+            return sidecar["iclabel"]
+
+        if label_components is None:
+            raise ImportError("ICLabel needs mne-icalabel: pip install mne-icalabel")
+        ic_labels = label_components(make_fit_input(), ica, method="iclabel")
+        sidecar["iclabel"] = {"labels": list(ic_labels["labels"]),
+                              "y_pred_proba": np.asarray(ic_labels["y_pred_proba"]).tolist()}
+        self._write_sidecar(sidecar)
+        return sidecar["iclabel"]
+
+    def _read_sidecar(self) -> dict:
+        """the sidecar JSON, empty if there is none"""
+        return json.loads(self.sidecar_path.read_text()) if self.sidecar_path.exists() else {}
+
+    def _write_sidecar(self, sidecar: dict):
+        """write the sidecar JSON"""
+        self.sidecar_path.write_text(json.dumps(sidecar, indent=2, default=str))
@@ -0,0 +1,73 @@
+import json
+import hashlib
+from datetime import datetime
+from pathlib import Path
+from typing import Optional
+
+from src.analysis.enums.analysis_enums import (CacheParams, FilterParams, ICAParams, AutoRejectParams, EpochParams,
+                                               TriggerCodes, RejectCriteria, FileFormat, BadChannelParams,
+                                               ChannelGroups)
+from src.analysis.pre_processing.stage_cache import class_params, file_hash, recording_files
+
+# the modules the preprocessed epochs of Preprocessing.run are computed by (not the tools next to them)
+OUTPUT_MODULES = ["pipeline", "stage_cache", "stage_graph", "bad_channels", "ica_store", "autoreject_store", "memory",
+                  "streaming_filter"]
+
+# every parameter class the preprocessed epochs depend on (not Paths / ComputeParams / MemoryParams)
+OUTPUT_PARAMS = [FilterParams, ICAParams, AutoRejectParams, EpochParams, TriggerCodes, RejectCriteria, FileFormat,
+                 BadChannelParams, ChannelGroups]
+
+
+def params_hash() -> str:
+    """sha256 of the full parameter set of OUTPUT_PARAMS"""
+    params = {params_class.__name__: class_params(params_class) for params_class in OUTPUT_PARAMS}
+    return hashlib.sha256(json.dumps(params, sort_keys=True).encode()).hexdigest()
+
+
+def code_version() -> str:
+    """CacheParams.VERSION and the sha256 of the OUTPUT_MODULES sources, so an edit to the code reprocesses"""
+    sources = [Path(__file__).parent / f"{module}.py" for module in OUTPUT_MODULES]
+    return f"{CacheParams.VERSION}-{file_hash(sources)[:16]}"
+
+
+class Manifest:
+    def __init__(self, manifest_path: Path = Path(CacheParams.MANIFEST_PATH)):
+        """record of every finished subject session: {key: {input_hash, input_stat, params_hash, code_version,
+           output, finished}}, read and written by the parent process of the batch only"""
+        self.manifest_path = manifest_path
+        self.entries       = json.loads(manifest_path.read_text()) if manifest_path.exists() else {}
+        self.params_hash   = params_hash()
+        self.code_version  = code_version()
+
+    def input_state(self, key: str, vhdr: Path) -> dict:
+        """content hash of the recording, reusing the recorded hash when size and mtime of its files did not change"""
+        files = recording_files(vhdr)
+        stat  = [[file.name, file.stat().st_size, file.stat().st_mtime_ns] for file in files]
+        entry = self.entries.get(key, {})
+        if entry.get("input_stat") == stat:
+            return {"input_hash": entry["input_hash"], "input_stat": stat}
+        return {"input_hash": file_hash(files), "input_stat": stat}
+
+    def is_up_to_date(self, key: str, state: dict, output: Path) -> bool:
+        """True if the session was finished from the same input, parameters and code, and its output still exists"""
+        entry = self.entries.get(key)
+        return (entry is not None and output.exists() and entry["input_hash"] == state["input_hash"]
+                and entry["params_hash"] == self.params_hash and entry["code_version"] == self.code_version)
+
+    def record(self, key: str, state: dict, output: Path):
+        """mark a session as finished"""
+        self.entries[key] = {**state, "params_hash": self.params_hash, "code_version": self.code_version,
+                             "output": str(output), "finished": datetime.now().isoformat(timespec="seconds")}
+
+    def save(self):
+        """write the manifest (atomically, through a temporary file)"""
+        self.manifest_path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = self.manifest_path.with_suffix(".tmp")
+        temp_path.write_text(json.dumps(self.entries, indent=2))
+        temp_path.replace(self.manifest_path)
+
+
+def find_vhdr(session_dir: Path) -> Optional[Path]:
+    """the first .vhdr file of a session folder, None if there is none"""
+    vhdrs = sorted(session_dir.glob("*.vhdr"))
+    return vhdrs[0] if vhdrs else None
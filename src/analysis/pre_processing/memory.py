@@ -0,0 +1,166 @@
+import os
+import sys
+import tempfile
+import threading
+import uuid
+from pathlib import Path
+from typing import Optional, Union
+
+import mne
+import numpy as np
+
+from src.analysis.enums.analysis_enums import MemoryParams, ProfileParams
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+
+def memmap_file(name: str) -> str:
+    """path of a fresh memory-mapped file of this process in MEMMAP_DIR"""
+    folder = Path(MemoryParams.MEMMAP_DIR or tempfile.gettempdir())
+    folder.mkdir(parents=True, exist_ok=True)
+    return str(folder / f"{name}_{os.getpid()}_{uuid.uuid4().hex[:8]}.dat")
+
+
+def preload_target(name: str) -> Union[bool, str]:
+    """value for the preload argument of mne readers: a fresh memory-mapped file in out-of-core mode
+       (OUT_OF_CORE, or STREAMING_FILTER, which would gain nothing from a bounded output of an input in RAM), else True"""
+    return memmap_file(name) if MemoryParams.OUT_OF_CORE or MemoryParams.STREAMING_FILTER else True
+
+
+def memmap_raw(data: np.memmap, raw: mne.io.BaseRaw) -> mne.io.BaseRaw:
+    """Raw over a memory-mapped data array with the info, first sample and annotations of raw"""
+    new_raw = mne.io.RawArray(data, raw.info.copy(), first_samp=raw.first_samp, verbose=False)
+    new_raw.set_annotations(raw.annotations.copy())
+    return new_raw
+
+
+def cleanup_memmaps():
+    """delete the memory-mapped files written by this process"""
+    for path in Path(MemoryParams.MEMMAP_DIR or tempfile.gettempdir()).glob(f"*_{os.getpid()}_*.dat"):
+        try:
+            path.unlink()
+        except OSError:
+            pass
+
+
+def memmap_copy(raw: mne.io.BaseRaw, name: str) -> mne.io.BaseRaw:
+    """copy of raw that keeps its data in a memory-mapped file in out-of-core mode (copied chunk by chunk),
+       a regular in-memory copy otherwise"""
+    if not MemoryParams.OUT_OF_CORE:
+        return raw.copy()
+    data = np.memmap(memmap_file(name), dtype=np.float64, mode="w+", shape=(len(raw.ch_names), raw.n_times))
+    for start, stop in chunks(raw):
+        data[:, start:stop] = raw.get_data(start=start, stop=stop)
+    return memmap_raw(data, raw)
+
+
+def chunks(raw: mne.io.BaseRaw, seconds: float = None):
+    """(start, stop) sample ranges of seconds (default CHUNK_SECONDS) covering the recording"""
+    step = max(1, int((seconds or MemoryParams.CHUNK_SECONDS) * raw.info["sfreq"]))
+    for start in range(0, raw.n_times, step):
+        yield start, min(start + step, raw.n_times)
+
+
+def channel_std(raw: mne.io.BaseRaw, picks="eeg") -> np.ndarray:
+    """standard deviation of every picked channel over the whole recording, computed chunk by chunk
+       (per-chunk mean and sum of squared deviations merged with Chan's formula, so only one chunk is in memory)"""
+    count, mean, m2 = 0, None, None
+    for start, stop in chunks(raw):
+        data        = raw.get_data(picks=picks, start=start, stop=stop)
+        n           = data.shape[1]
+        chunk_mean  = data.mean(axis=1)
+        chunk_m2    = ((data - chunk_mean[:, None]) ** 2).sum(axis=1)
+        if mean is None:
+            count, mean, m2 = n, chunk_mean, chunk_m2
+            continue
+        delta  = chunk_mean - mean
+        total  = count + n
+        mean   = mean + delta * n / total
+        m2     = m2 + chunk_m2 + delta ** 2 * count * n / total
+        count  = total
+    return np.sqrt(m2 / count)
+
+
+def peak_rss() -> Optional[int]:
+    """peak resident memory of this process so far in bytes (resource where available, else psutil),
+       None if it can not be determined"""
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+    if psutil is not None:
+        info = psutil.Process().memory_info()
+        return getattr(info, "peak_wset", info.rss)
+    return None
+
+
+def current_rss() -> Optional[int]:
+    """resident memory of this process now in bytes (psutil, else /proc on Linux, else the peak),
+       None if it can not be determined"""
+    if psutil is not None:
+        return psutil.Process().memory_info().rss
+    return _proc_status("VmRSS") or peak_rss()
+
+
+def _proc_status(field: str) -> Optional[int]:
+    """a memory field of /proc/self/status (e.g. VmRSS, VmHWM) in bytes, None where there is no /proc"""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(f"{field}:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        return None
+    return None
+
+
+def _reset_peak_rss() -> bool:
+    """reset the kernel's peak RSS (VmHWM) of this process to its current RSS (Linux), True if it was reset"""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return _proc_status("VmHWM") is not None
+    except OSError:
+        return False
+
+
+class PeakRss:
+    def __init__(self):
+        """peak resident memory of this process during a block (ru_maxrss only ever grows, so it can not
+           tell the stages apart):
+            1. on Linux the kernel peak (VmHWM) is reset when the block starts and read when it ends (exact)
+            2. elsewhere, and in addition, a background thread samples current_rss every
+               ProfileParams.RSS_SAMPLE_SECONDS (misses spikes shorter than that)
+           peak: bytes, None if the memory can not be determined"""
+        self.peak    = None
+        self._exact  = False
+        self._stop   = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+
+    def __enter__(self):
+        self._exact = _reset_peak_rss()
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        samples = [self.peak, current_rss(), _proc_status("VmHWM") if self._exact else None]
+        self.peak = max((sample for sample in samples if sample is not None), default=None)
+        return False
+
+    def _sample(self):
+        """keep the largest current_rss until the block ends"""
+        while True:
+            rss = current_rss()
+            if rss is not None and (self.peak is None or rss > self.peak):
+                self.peak = rss
+            if self._stop.wait(ProfileParams.RSS_SAMPLE_SECONDS):
+                return
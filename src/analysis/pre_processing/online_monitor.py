@@ -0,0 +1,143 @@
+import time
+from pathlib import Path
+from typing import Callable, Optional
+
+import mne
+import numpy as np
+from scipy.signal import iirnotch, sosfilt, sosfilt_zi, tf2sos
+
+from src.analysis.enums.analysis_enums import FilterParams, BadChannelParams, RejectCriteria, MonitorParams
+from src.analysis.pre_processing.bad_channels import _neighbours
+
+
+class FileReplayStream:
+    def __init__(self, vhdr: Path, block_seconds: float = MonitorParams.BLOCK_SECONDS,
+                 realtime: bool = MonitorParams.REALTIME):
+        """local stand-in of an amplifier stream: replays a BrainVision recording block by block
+            input: vhdr: the recording (read lazily, one block at a time)
+                   block_seconds: samples pushed per block
+                   realtime: pace the blocks at the recording rate, as the amplifier would"""
+        self.raw      = mne.io.read_raw_brainvision(vhdr, preload=False, verbose=False)
+        self.info     = self.raw.info
+        self.block    = max(1, int(block_seconds * self.info["sfreq"]))
+        self.realtime = realtime
+
+    def __iter__(self):
+        """(block (channel, sample) in V, index of its first sample, wall time it arrived)"""
+        sfreq = self.info["sfreq"]
+        start_wall = time.perf_counter()
+        for start in range(0, self.raw.n_times, self.block):
+            stop = min(start + self.block, self.raw.n_times)
+            if self.realtime:
+                time.sleep(max(0.0, start_wall + stop / sfreq - time.perf_counter()))
+            yield self.raw.get_data(start=start, stop=stop), start, time.perf_counter()
+
+
+class OnlineMonitor:
+    def __init__(self, info: mne.Info, picks="eeg"):
+        """online channel quality of a running recording, constant work and memory per sample:
+            1. causal FilterParams band-pass (mne's IIR design) and a NOTCH_Q notch, the filter state carried
+               from block to block (zero-phase filtering needs the future, so the online signal lags the offline one)
+            2. exponentially weighted (ROLLING_SECONDS) mean, variance and neighbour covariances per channel
+            3. flat / noisy / uncorrelated as in bad_channels.detect_bad_channels: std below
+               RejectCriteria.FLAT_THRESHOLD, robust z-score across channels above ROBUST_Z, median |correlation|
+               with the N_NEIGHBOURS nearest channels below MIN_CORRELATION (after one time constant of data)
+            input: info: of the stream, picks: 'eeg' or channel names"""
+        sfreq           = info["sfreq"]
+        self.pick_idx   = mne.pick_types(info, eeg=True) if picks == "eeg" else mne.pick_channels(info.ch_names, picks)
+        self.names      = [info.ch_names[i] for i in self.pick_idx]
+        self.neighbours = _neighbours(info, self.pick_idx)
+        self.sos        = mne.filter.create_filter(None, sfreq, FilterParams.L_FREQ, FilterParams.H_FREQ,
+                                                   method="iir", verbose=False)["sos"]
+        if FilterParams.NOTCH_FREQ and FilterParams.NOTCH_FREQ < sfreq / 2:
+            notch       = tf2sos(*iirnotch(FilterParams.NOTCH_FREQ, MonitorParams.NOTCH_Q, fs=sfreq))
+            self.sos    = np.vstack([self.sos, notch])
+        self.decay      = np.exp(-1.0 / (MonitorParams.ROLLING_SECONDS * sfreq))   # per-sample forgetting factor
+        self.warmup     = int(MonitorParams.ROLLING_SECONDS * sfreq)
+        self.zi         = None
+        self.mean       = np.zeros(len(self.names))
+        self.power      = np.zeros(len(self.names))
+        self.cross      = np.zeros(self.neighbours.shape)
+        self.n_samples  = 0
+
+    def update(self, block: np.ndarray) -> dict:
+        """filter one block of the stream (channel, sample) and update the statistics
+            output: {'bads': {channel: [reasons]}, 'std': per-channel rolling std (V), 'samples'}"""
+        data = block[self.pick_idx]
+        if self.zi is None:
+            # start in the steady state of the first sample, so the DC offset does not ring through the high-pass
+            self.zi = sosfilt_zi(self.sos)[:, None, :] * data[None, :, :1]
+        data, self.zi = sosfilt(self.sos, data, axis=1, zi=self.zi)
+
+        # exact exponential weighting of the block: sample k of n weighs (1 - decay) * decay ** (n - 1 - k)
+        n          = data.shape[1]
+        weights    = (1 - self.decay) * self.decay ** np.arange(n - 1, -1, -1)
+        carry      = self.decay ** n
+        self.mean  = carry * self.mean + data @ weights
+        self.power = carry * self.power + (data ** 2) @ weights
+        self.cross = carry * self.cross + np.einsum("ct,ckt,t->ck", data, data[self.neighbours], weights)
+        self.n_samples += n
+        return self.status()
+
+    def status(self) -> dict:
+        """current bad channels from the rolling statistics"""
+        variance = np.maximum(self.power - self.mean ** 2, 0)
+        std      = np.sqrt(variance)
+        bads     = {}
+        if self.n_samples >= self.warmup:
+            median   = np.median(std)
+            spread   = 1.4826 * np.median(np.abs(std - median))
+            robust_z = (std - median) / (spread if spread > 0 else np.inf)
+            cov      = self.cross - self.mean[:, None] * self.mean[self.neighbours]
+            norm     = std[:, None] * std[self.neighbours]
+            corr     = np.median(np.abs(cov / np.where(norm > 0, norm, np.inf)), axis=1)
+            for index, name in enumerate(self.names):
+                reasons = [reason for reason, flagged in [("flat", std[index] < RejectCriteria.FLAT_THRESHOLD),
+                                                          ("noisy", robust_z[index] > BadChannelParams.ROBUST_Z),
+                                                          ("uncorrelated", corr[index] < BadChannelParams.MIN_CORRELATION)]
+                           if flagged]
+                if reasons:
+                    bads[name] = reasons
+        return {"bads": bads, "std": std, "samples": self.n_samples}
+
+
+def run_monitor(vhdr: Path, realtime: bool = MonitorParams.REALTIME,
+                on_status: Optional[Callable] = None) -> dict:
+    """monitor a replayed recording: every block is filtered and the statistics updated as it arrives,
+       the bad channels are printed when they change, a one-line status every REPORT_SECONDS, and
+       blocks processed later than LATENCY_BUDGET_S after they arrived are reported
+        input: on_status: called with (seconds into the recording, status) after every block
+        output: {'samples', 'blocks', 'bads' (last status), 'mean_latency_s', 'max_latency_s', 'late_blocks'}"""
+    stream    = FileReplayStream(vhdr, realtime=realtime)
+    monitor   = OnlineMonitor(stream.info)
+    sfreq     = stream.info["sfreq"]
+    latencies = []
+    last_bads = None
+    last_print = 0.0
+    status    = monitor.status()
+
+    for block, start, arrived in stream:
+        status  = monitor.update(block)
+        latency = time.perf_counter() - arrived
+        latencies.append(latency)
+        seconds = (start + block.shape[1]) / sfreq
+        if latency > MonitorParams.LATENCY_BUDGET_S:
+            print(f"  [monitor] {seconds:8.1f} s  late block: {latency * 1e3:.0f} ms")
+        if status["bads"] != last_bads:
+            print(f"  [monitor] {seconds:8.1f} s  bad channels: {status['bads'] or 'none'}")
+            last_bads, last_print = status["bads"], seconds
+        elif seconds - last_print >= MonitorParams.REPORT_SECONDS:
+            print(f"  [monitor] {seconds:8.1f} s  {len(status['bads'])} bad, median std "
+                  f"{np.median(status['std']) * 1e6:.1f} µV, latency {latency * 1e3:.1f} ms")
+            last_print = seconds
+        if on_status is not None:
+            on_status(seconds, status)
+
+    latencies = np.array(latencies)
+    summary = {"samples": monitor.n_samples, "blocks": len(latencies), "bads": status["bads"],
+               "mean_latency_s": float(latencies.mean()) if len(latencies) else 0.0,
+               "max_latency_s": float(latencies.max()) if len(latencies) else 0.0,
+               "late_blocks": int((latencies > MonitorParams.LATENCY_BUDGET_S).sum())}
+    print(f"  [monitor] {summary['blocks']} blocks, latency mean {summary['mean_latency_s'] * 1e3:.1f} ms, "
+          f"max {summary['max_latency_s'] * 1e3:.1f} ms, {summary['late_blocks']} late")
+    return summary
@@ -4,41 +4,91 @@ import pandas as pd
 import matplotlib.pyplot as plt
 from pathlib import Path
 import mne
-from mne_icalabel import label_components
 from autoreject import AutoReject, Ransac
-from src.analysis.enums.analysis_enums import ParallelPortDict
+from src.analysis.enums.analysis_enums import (ParallelPortDict, AutoRejectParams, EpochFamilies, BadChannelParams,
+                                               CacheParams, FileFormat, MemoryParams, FilterParams, ChannelGroups)
+from src.analysis.pre_processing.batch_runner import n_jobs_per_worker
+from src.analysis.pre_processing.ica_store import IcaStore
+from src.analysis.pre_processing.autoreject_store import AutoRejectStore
+from src.analysis.pre_processing.deferred_report import DeferredReport
+from src.analysis.pre_processing.bad_channels import detect_bad_channels, ransac_windows
+from src.analysis.pre_processing.memory import cleanup_memmaps, channel_std
+from src.analysis.pre_processing.streaming_filter import stream_filter
+from src.analysis.pre_processing.stage_cache import StageCache, class_params, file_hash, recording_files
+from src.analysis.pre_processing.stage_graph import Node, StageGraph, read_raw
+from src.analysis.pre_processing.profiler import StageProfiler
 import os
 
 class OrPipeline:
-    def __init__(self, path: Path, subject_id: str):
+    def __init__(self, path: Path, subject_id: str, n_jobs: int = None, make_figures: bool = True):
         self.subject_id = subject_id
+        self.n_jobs = n_jobs or n_jobs_per_worker()  # ComputeParams.N_JOBS, else all cores
         self.path = path
         self.eeg_path = self.path / "EEG_data" / f"subject {self.subject_id}" / "experiment"
         self.results_path = self.path / "EEG_data" / f"subject {self.subject_id}" / 'post process'
         self.fig_path = self.path / "EEG_data" / f"subject {self.subject_id}" / "figures"
+        self.vhdr = self.eeg_path / f"Bindingdecoding{self.subject_id}.vhdr"
         self.results_path.mkdir(parents=True, exist_ok=True)
         self.fig_path.mkdir(parents=True, exist_ok=True)
+        # one ICA per fit family: the ICA_FIT_FAMILY fit, or a family's own fit when the recording has no fit family
+        self.ica_stores = {family: IcaStore(self.results_path / f'{self.subject_id}_{family}-ica.fif')
+                           for family in EpochFamilies.ALL}
+        self.ar_stores = {family: AutoRejectStore(self.results_path / f'{self.subject_id}_{family}-ar.hdf5')
+                          for family in EpochFamilies.ALL}
+        # figures of run() are rendered after it in a separate process, make_figures=False skips them (batch runs)
+        self.report = DeferredReport(self.fig_path, title=f'subject {self.subject_id}') if make_figures else None
+        self.profiler = StageProfiler(subject_id=self.subject_id, session='or_pipeline')
 
     def run(self, do_ica: bool = True, do_autoreject: bool = True, do_bad_channels: bool = True, do_auto_bad_ch: bool = False):
-        raw = self._load_vhdr()
-        self._resample_and_filtering(raw=raw)
-        self._handle_bad_channels(raw, do_auto_bad_ch, do_bad_channels)
-        epochs = self._make_epochs(raw)
-        epochs = self._rereference(epochs)
+        # the steps run as a StageGraph variant (see nodes), raw steps are checkpointed in the shared stage cache,
+        # every step is profiled (wall / cpu time, peak RSS, output shape) into results_path/<subject>_profile.json
+        graph = StageGraph(cache=self.stage_cache(), profiler=self.profiler)
+        graph.add(variant='or_pipeline', nodes=self.nodes(do_ica, do_autoreject, do_bad_channels, do_auto_bad_ch))
+        try:
+            families = graph.run()['or_pipeline']
+            with self.profiler.stage('save'):
+                for family, epochs in families.items():
+                    self._save_epochs(epochs, family)
+        finally:
+            cleanup_memmaps()
+            self.profiler.save(self.results_path / f'{self.subject_id}_profile.json')
+        if self.report is not None:
+            return self.report.start()
+
+    def stage_cache(self):
+        return StageCache(cache_dir=Path(CacheParams.CACHE_DIR) / f'{FileFormat.SUBJECT_FOLDER_PREFIX}{self.subject_id}' / 'experiment',
+                          input_hash=file_hash(recording_files(self.vhdr)))
+
+    def nodes(self, do_ica: bool = True, do_autoreject: bool = True, do_bad_channels: bool = True, do_auto_bad_ch: bool = False):
+        nodes = [
+            Node('read', lambda: read_raw(self.vhdr), checkpoint=False),
+            Node('or_load', lambda raw: self._prepare_raw(raw, EOG_ch=True),
+                 params=dict(montage='easycap-M1', EOG_ch=True, eog=ChannelGroups.EOG), checkpoint=False),
+            Node('or_filter', self._filter_node,
+                 params=dict(l_freq=0.1, notch=50.0, resample=ParallelPortDict.PREPRO_ARGS['resample'],
+                             resample_first=FilterParams.RESAMPLE_FIRST)),
+            # manual marking is interactive, so only the automatic result is checkpointed
+            Node('or_bad_channels', self._bad_channels_node(do_auto_bad_ch, do_bad_channels),
+                 params=dict(auto=do_auto_bad_ch, manual=do_bad_channels and not do_auto_bad_ch,
+                             **class_params(BadChannelParams)), checkpoint=do_auto_bad_ch),
+            Node('or_epoch', self._epoch_node, params=dict(families=EpochFamilies.ALL), checkpoint=False),
+        ]
         if do_autoreject:
-            epochs = self._auto_reject(epochs)
+            nodes.append(Node('or_autoreject', self._autoreject_node,
+                              params=dict(random_state=11, n_interpolate=[1, 2, 3, 4], **class_params(AutoRejectParams)),
+                              checkpoint=False))
         if do_ica:
-            raw.filter(l_freq=1, h_freq=None) # before ICA need high pass filter
-            self._do_ica(epochs)
-        self._final_resample_and_filtering(epochs)
-        self._save_epochs(epochs)
+            nodes.append(Node('or_ica', self._ica_node, checkpoint=False,
+                              params=dict(method='infomax', random_state=100, fit_family=EpochFamilies.ICA_FIT_FAMILY)))
+        nodes.append(Node('or_final', self._final_node, params=dict(h_freq=100.0, sfreq=500.0), checkpoint=False))
+        return nodes
 
     def _load_vhdr(self, EOG_ch=False):
         """" Doc """
-        vhdr_path = self.eeg_path / f"Bindingdecoding{self.subject_id}.vhdr"
-        raw = mne.io.read_raw_brainvision(vhdr_path, verbose=False)
-        raw.load_data()
+        return self._prepare_raw(read_raw(self.vhdr), EOG_ch=EOG_ch)
 
+    @staticmethod
+    def _prepare_raw(raw, EOG_ch=False):
         # set channel type for EMG and EOG
         raw.set_channel_types({"EMG": 'emg'})
 
@@ -46,7 +96,7 @@ class OrPipeline:
             raw.rename_channels({'HEGOC': 'HEOG'})
 
         if EOG_ch == True:
-            raw.set_channel_types({"HEOG": 'eog', "VEOG": 'eog'})
+            raw.set_channel_types({name: 'eog' for name in ChannelGroups.EOG if name in raw.ch_names})
 
         # Set montage
         montage = mne.channels.make_standard_montage('easycap-M1')  #
@@ -59,40 +109,93 @@ class OrPipeline:
 
         return raw
 
+    def _filter_node(self, raw):
+        return self._resample_and_filtering(raw=raw)
+
+    def _bad_channels_node(self, do_auto_bad_ch: bool, do_bad_channels: bool):
+        def function(raw):
+            self._handle_bad_channels(raw, do_auto_bad_ch, do_bad_channels)
+            return raw
+        return function
+
+    def _epoch_node(self, raw):
+        return {family: self._rereference(epochs) for family, epochs in self._make_epochs(raw).items()}
+
+    def _autoreject_node(self, families):
+        return {family: self._auto_reject(epochs, family) for family, epochs in families.items()}
+
+    def _ica_node(self, families):
+        fit_epochs = families.get(EpochFamilies.ICA_FIT_FAMILY)
+        if fit_epochs is None:
+            logging.warning(f"ICA: no {EpochFamilies.ICA_FIT_FAMILY} epochs, every family is fitted on itself")
+        # the fit family last, so it is still uncleaned (same fingerprint) while the others reuse its ICA
+        for family in sorted(families, key=lambda family: family == EpochFamilies.ICA_FIT_FAMILY):
+            self._do_ica(families[family], family, fit_epochs=fit_epochs)
+        return families
+
+    def _final_node(self, families):
+        for epochs in families.values():
+            self._final_resample_and_filtering(epochs)
+        return families
+
     def _resample_and_filtering(self, raw):
         self._move_out_emg_electrode(raw)
-        self._high_pass_filter(raw)
-        self._notch_filter(raw)
-        raw.resample(ParallelPortDict.PREPRO_ARGS['resample'])
+        if FilterParams.RESAMPLE_FIRST:
+            # anti-aliased decimation first, so the high-pass and notch run at the low rate
+            raw = self.resample_raw(raw, n_jobs=self.n_jobs)
+            return self.filter_raw(raw, n_jobs=self.n_jobs)
+        raw = self.filter_raw(raw, n_jobs=self.n_jobs)
+        return self.resample_raw(raw, n_jobs=self.n_jobs)
+
+    @classmethod
+    def filter_raw(cls, raw, n_jobs: int = 1):
+        if MemoryParams.STREAMING_FILTER:
+            # same high-pass and notch, chunk by chunk into a memory-mapped copy
+            return stream_filter(raw, l_freq=0.1, h_freq=None, notch_freqs=50.0, n_jobs=n_jobs, name="or_filter")
+        cls._high_pass_filter(raw, n_jobs=n_jobs)
+        cls._notch_filter(raw, n_jobs=n_jobs)
+        return raw
+
+    @staticmethod
+    def resample_raw(raw, n_jobs: int = 1):
+        raw.resample(ParallelPortDict.PREPRO_ARGS['resample'], n_jobs=n_jobs)
+        return raw
 
     def _handle_bad_channels(self, raw, do_auto_bad_ch: bool = True, do_bad_channels: bool = True):
         if do_auto_bad_ch:
-            self._auto_detect_bad_channels(raw)
+            self._auto_detect_bad_channels(raw, n_jobs=self.n_jobs)
         elif do_bad_channels:
             self._manual_bad_channels(raw)
 
     @staticmethod
     def _make_epochs(raw):
+        # one Epochs per EpochFamilies family, each with its own window, families without events are skipped
         events_from_annot, _ = mne.events_from_annotations(raw)
-        selected_events = np.array([x for x in events_from_annot if x[2] in ParallelPortDict.EVENT_DICT.values()])
-        metadata, _, _ = mne.epochs.make_metadata(selected_events, event_id=ParallelPortDict.EVENT_DICT, tmin=0, tmax=0,
-                                                  sfreq=raw.info['sfreq'])
-        return mne.Epochs(raw, events=selected_events, event_id=ParallelPortDict.EVENT_DICT,
-                          tmin=ParallelPortDict.PREPRO_ARGS['tmin'], tmax=ParallelPortDict.PREPRO_ARGS['tmax'],
-                          baseline=ParallelPortDict.PREPRO_ARGS['baseline'], preload=True,
-                          detrend=0, metadata=metadata, on_missing='warn')
+        families = {}
+        for family, window in EpochFamilies.ALL.items():
+            event_id = {name: ParallelPortDict.EVENT_DICT[name] for name in window['events']}
+            selected_events = np.array([x for x in events_from_annot if x[2] in event_id.values()])
+            if len(selected_events) == 0:
+                logging.info(f"Epochs: no {family} events found")
+                continue
+            metadata, _, _ = mne.epochs.make_metadata(selected_events, event_id=event_id, tmin=0, tmax=0,
+                                                      sfreq=raw.info['sfreq'])
+            families[family] = mne.Epochs(raw, events=selected_events, event_id=event_id,
+                                          tmin=window['tmin'], tmax=window['tmax'], baseline=window['baseline'],
+                                          preload=True, detrend=0, metadata=metadata, on_missing='warn')
+        return families
 
     @staticmethod
     def _rereference(epochs):
         return mne.set_eeg_reference(epochs)[0]
 
     def _final_resample_and_filtering(self, epochs):
-        self._low_pass_filter(epochs)
-        self._final_resample(epochs)
+        self._low_pass_filter(epochs, n_jobs=self.n_jobs)
+        self._final_resample(epochs, n_jobs=self.n_jobs)
 
-    def _save_epochs(self, epochs):
-        ep_fname = f'{self.subject_id}_prepro-epo.fif'
-        epochs.save(self.results_path / ep_fname, overwrite=True)
+    def _save_epochs(self, epochs, family: str = EpochFamilies.ICA_FIT_FAMILY):
+        ep_fname = f'{self.subject_id}_{family}_prepro-epo.fif'
+        epochs.save(self.results_path / ep_fname, overwrite=True, fmt='single' if EpochFamilies.SAVE_FLOAT32 else 'double')
         logging.info(f"Epochs saved to {self.results_path / ep_fname}")
 
     def plot_signal_snapshot(self, data, step_name: str):
@@ -119,28 +222,29 @@ class OrPipeline:
         plt.close()
 
     @staticmethod
-    def _high_pass_filter(raw, l_freq: float = 0.1):
-        raw.filter(l_freq=l_freq, h_freq=None)
+    def _high_pass_filter(raw, l_freq: float = 0.1, n_jobs: int = 1):
+        raw.filter(l_freq=l_freq, h_freq=None, n_jobs=n_jobs)
 
     @staticmethod
-    def _notch_filter(raw, freqs: float = 50.0):
-        raw.notch_filter(freqs=freqs)
+    def _notch_filter(raw, freqs: float = 50.0, n_jobs: int = 1):
+        raw.notch_filter(freqs=freqs, n_jobs=n_jobs)
 
     @staticmethod
-    def _auto_detect_bad_channels(raw):
-        epochs_for_ransac = mne.make_fixed_length_epochs(raw, duration=1.0, preload=True)
-        ransac = Ransac(verbose=False, n_jobs=1)
-        ransac.fit(epochs_for_ransac)
-        raw.info['bads'] = ransac.bad_chs_
+    def _auto_detect_bad_channels(raw, n_jobs: int = 1):
+        # robust windowed statistics over the whole recording, RANSAC on a subsample of its 1 s windows
+        robust_bads = detect_bad_channels(raw)
+        ransac = Ransac(verbose=False, n_jobs=n_jobs)
+        ransac.fit(ransac_windows(raw))
+        raw.info['bads'] = sorted(set(robust_bads) | set(ransac.bad_chs_))
+        logging.info(f"Robust detector: {robust_bads}, RANSAC: {ransac.bad_chs_}")
         raw.interpolate_bads(reset_bads=True)
-        logging.info(f"RANSAC: interpolated bad channels {ransac.bad_chs_}")
+        logging.info(f"Auto: interpolated bad channels {raw.info['bads']}")
 
     @staticmethod
     def _plot_channels_for_inspection(raw, fig_path):
         eeg_picks = mne.pick_types(raw.info, eeg=True)
         info_eeg = mne.pick_info(raw.info, eeg_picks)
-        data = raw.get_data(picks='eeg')
-        variances = np.var(data, axis=1)
+        variances = channel_std(raw, picks='eeg') ** 2
         ch_names = info_eeg.ch_names
 
         fig, axes = plt.subplots(2, 1, figsize=(16, 10))
@@ -168,29 +272,40 @@ class OrPipeline:
         raw.interpolate_bads(reset_bads=True)
         logging.info(f"Manual: interpolated bad channels {raw.info['bads']}")
 
-    @staticmethod
-    def _fit_ica(epochs):
-        epochs_for_ica = epochs.copy().filter(l_freq=1, h_freq=None)
-        ica = mne.preprocessing.ICA(method='infomax', fit_params=dict(extended=True), random_state=100)
-        ica.fit(epochs_for_ica)
-        return ica, epochs_for_ica
-
-    def _do_ica(self, epochs):
-        ica, epochs_for_ica = self._fit_ica(epochs)
-        labels = label_components(epochs_for_ica, ica, method='iclabel')['labels']
+    def _fit_ica(self, epochs, fit_family: str = EpochFamilies.ICA_FIT_FAMILY):
+        # stored per subject and fit family with the fingerprint of the epochs, refitted only when they change
+        return self.ica_stores[fit_family].get(inst=epochs, params=dict(method='infomax', extended=True, random_state=100, l_freq=1),
+                                  make_fit_input=lambda: self._ica_input(epochs),
+                                  make_ica=lambda: mne.preprocessing.ICA(method='infomax', fit_params=dict(extended=True),
+                                                                         random_state=100))
+
+    def _ica_input(self, epochs):
+        return epochs.copy().filter(l_freq=1, h_freq=None, n_jobs=self.n_jobs)
+
+    def _ica_labels(self, epochs, ica, fit_family: str = EpochFamilies.ICA_FIT_FAMILY):
+        return self.ica_stores[fit_family].labels(ica=ica, make_fit_input=lambda: self._ica_input(epochs))
+
+    def _do_ica(self, epochs, family: str = EpochFamilies.ICA_FIT_FAMILY, fit_epochs=None):
+        # fit (and label) on fit_epochs if given, so every family gets the same decomposition,
+        # else on the family itself into its own store
+        fit_family = EpochFamilies.ICA_FIT_FAMILY if fit_epochs is not None else family
+        fit_epochs = epochs if fit_epochs is None else fit_epochs
+        ica = self._fit_ica(fit_epochs, fit_family)
+        labels = self._ica_labels(fit_epochs, ica, fit_family)['labels']
         exclude_idx = [i for i, lbl in enumerate(labels) if lbl in ParallelPortDict.PREPRO_ARGS['drop ica']]
         ica.apply(epochs, exclude=exclude_idx)
 
-        ica.plot_overlay(epochs.average(), exclude=exclude_idx)
-        plt.savefig(self.fig_path / "ICA_Evoked_Overlay.png")
-        ica.plot_components(exclude_idx)
-        plt.savefig(self.fig_path / "ICA_Exclude_Comp.png")
+        if self.report is not None:
+            self.report.add('ica_overlay', f'ICA_Evoked_Overlay_{family}', ica=ica, evoked=epochs.average(),
+                            exclude=exclude_idx)
+            if epochs is fit_epochs:
+                self.report.add('ica_components', f'ICA_Exclude_Comp_{fit_family}', ica=ica, picks=exclude_idx)
 
-        logging.info(f"ICA: auto rejected {exclude_idx}")
+        logging.info(f"ICA: auto rejected {exclude_idx} from {family} epochs")
 
     def _plot_ica_for_inspection(self, epochs):
-        ica, epochs_for_ica = self._fit_ica(epochs)
-        ic_labels = label_components(epochs_for_ica, ica, method='iclabel')
+        ica = self._fit_ica(epochs)
+        ic_labels = self._ica_labels(epochs, ica)
 
         labels = ic_labels['labels']
         probs = ic_labels['y_pred_proba']
@@ -199,16 +314,16 @@ class OrPipeline:
         plt.savefig(self.fig_path / "ICA_all_components.png")
         plt.close()
 
-        ica.plot_sources(epochs_for_ica)
+        ica.plot_sources(self._ica_input(epochs))
         plt.savefig(self.fig_path / "ICA_sources.png")
         plt.close()
 
         print("ICA component index → ICLabel classification:")
         for i, (lbl, prob) in enumerate(zip(labels, probs)):
-            print(f"  {i}: {lbl} ({max(prob):.0%} confidence)")
+            print(f"  {i}: {lbl} ({np.max(prob):.0%} confidence)")
 
     def _manual_ica(self, epochs, exclude_indices: list):
-        ica, _ = self._fit_ica(epochs)
+        ica = self._fit_ica(epochs)
         ica.apply(epochs, exclude=exclude_indices)
 
         ica.plot_overlay(epochs.average(), exclude=exclude_indices)
@@ -218,32 +333,32 @@ class OrPipeline:
         logging.info(f"ICA: manually rejected {exclude_indices}")
 
     @staticmethod
-    def _low_pass_filter(epochs, h_freq: float = 100.0):
-        epochs.filter(l_freq=None, h_freq=h_freq)
+    def _low_pass_filter(epochs, h_freq: float = 100.0, n_jobs: int = 1):
+        epochs.filter(l_freq=None, h_freq=h_freq, n_jobs=n_jobs)
 
     @staticmethod
-    def _final_resample(epochs, sfreq: float = 500.0):
-        epochs.resample(sfreq)
+    def _final_resample(epochs, sfreq: float = 500.0, n_jobs: int = 1):
+        epochs.resample(sfreq, n_jobs=n_jobs)
 
     @staticmethod
     def _move_out_emg_electrode(raw):
         if 'EMG' in raw.ch_names:
             raw.drop_channels(['EMG'])
 
-    def _auto_reject(self, epochs):
-        ar = AutoReject(n_jobs=1, random_state=11, n_interpolate=[1, 2, 3, 4])
-        ar.fit(epochs[:100])
+    def _auto_reject(self, epochs, family: str = EpochFamilies.ICA_FIT_FAMILY):
+        # fitted on a stratified subsample (event types x session time) and reused while the epochs do not change
+        ar = self.ar_stores[family].get(epochs=epochs, params=dict(random_state=11, n_interpolate=[1, 2, 3, 4]),
+                               fit_size=AutoRejectParams.FIT_SIZE,
+                               make_ar=lambda: AutoReject(n_jobs=self.n_jobs, random_state=11,
+                                                          n_interpolate=[1, 2, 3, 4]))
         epochs_ar, reject_log = ar.transform(epochs, return_log=True)
 
-        fig = epochs[reject_log.bad_epochs].plot(scalings=dict(eeg=100e-6))
-        try:
-            fig.grab().save(str(self.fig_path / "Autoreject_Bad_Epochjs.png"))
-        except Exception as e:
-            print(f"Skipping grab() save due to: {e}")
-        reject_log.plot('horizontal')
-        plt.savefig(self.fig_path / "Autoreject_Reject_LOG")
+        if self.report is not None:
+            self.report.add('bad_epochs', f'Autoreject_Bad_Epochjs_{family}', epochs=epochs[reject_log.bad_epochs],
+                            scalings=dict(eeg=100e-6))
+            self.report.add('reject_log', f'Autoreject_Reject_LOG_{family}', reject_log=reject_log)
 
-        logging.info(f"Autoreject: removed {sum(reject_log.bad_epochs)} epochs")
+        logging.info(f"Autoreject: removed {sum(reject_log.bad_epochs)} {family} epochs")
         return epochs_ar
 
 
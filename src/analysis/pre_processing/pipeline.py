@@ -1,23 +1,46 @@
+import os
 import mne
 import numpy as np
 from pathlib import Path
-from typing import Optional
+from typing import Callable, Optional
 from autoreject import AutoReject
 
 from src.analysis.enums.analysis_enums import (Paths, FilterParams, ICAParams, EpochParams, TriggerCodes,
-                                               RejectCriteria, FileFormat)
+                                               RejectCriteria, FileFormat, ComputeParams, CacheParams, AutoRejectParams,
+                                               BadChannelParams, ProfileParams, MemoryParams, ChannelGroups)
+from src.analysis.pre_processing.batch_runner import Job, run_jobs, n_jobs_per_worker
+from src.analysis.pre_processing.stage_cache import StageCache, class_params, file_hash, recording_files
+from src.analysis.pre_processing.ica_store import IcaStore
+from src.analysis.pre_processing.autoreject_store import AutoRejectStore
+from src.analysis.pre_processing.manifest import Manifest, find_vhdr
+from src.analysis.pre_processing.bad_channels import detect_bad_channels
+from src.analysis.pre_processing.memory import cleanup_memmaps, memmap_copy
+from src.analysis.pre_processing.streaming_filter import stream_filter
+from src.analysis.pre_processing.stage_graph import Node, StageGraph, read_raw
+from src.analysis.pre_processing.or_pipeline import OrPipeline
+from src.analysis.pre_processing.profiler import StageProfiler, cohort_summary
 
 
 class Preprocessing:
-    def __init__(self, subject_dir: Path, session: str):
+    def __init__(self, subject_dir: Path, session: str, n_jobs: Optional[int] = None, input_hash: Optional[str] = None):
         """input: subject_dir: path to the subject folder (e.g. .../subject 101)
                   session: session name ('experiment' or 'baseline')
+                  n_jobs: n_jobs of the filter / notch / resample / AutoReject calls (None = n_jobs_per_worker())
+                  input_hash: content hash of the recording if already known (e.g. from the manifest),
+                              None = hashed on first use
            1. find the .vhdr file in subject_dir/session/
            2. load raw data and store subject_id"""
         self.subject_dir = subject_dir
         self.session     = session
         self.subject_id  = subject_dir.name
         self.vhdr        = self._find_vhdr()
+        self.ica_store   = IcaStore(Path(Paths.OUTPUT_ROOT) / self.subject_id / session /
+                                    f"{self.subject_id}_{session}-ica.fif")
+        self.ar_store    = AutoRejectStore(Path(Paths.OUTPUT_ROOT) / self.subject_id / session /
+                                           f"{self.subject_id}_{session}-ar.hdf5")
+        self.profiler    = StageProfiler(subject_id=self.subject_id, session=session)
+        self.n_jobs      = n_jobs or n_jobs_per_worker()
+        self.input_hash  = input_hash
         self.raw: mne.io.Raw
         self.epochs: mne.Epochs
 
@@ -31,7 +54,13 @@ class Preprocessing:
             6. ICA artefact removal
             7. epoch around triggers
             8. AutoReject
-            9. save epochs to .fif"""
+            9. save epochs to .fif
+           the stages run as a StageGraph variant (see nodes): every stage after loading is checkpointed
+           (StageCache), a rerun resumes after the deepest stage whose input file and parameters (of it and
+           every stage before it) did not change.
+           wall / cpu time, peak RSS and output shape of every stage are profiled (StageProfiler) into
+           ProfileParams.FOLDER; with MemoryParams.OUT_OF_CORE the continuous data lives in memory-mapped files
+           that are deleted at the end"""
         if self.vhdr is None:
             return
 
@@ -40,26 +69,84 @@ class Preprocessing:
         print(f"  File:    {self.vhdr.name}")
         print(f"{'='*60}")
 
-        self.raw = self._load_raw()
+        graph = StageGraph(cache=self.stage_cache(), profiler=self.profiler)
+        graph.add(variant="preprocessing", nodes=self.nodes())
+        try:
+            self.epochs = graph.run()["preprocessing"]
+            with self.profiler.stage("save"):
+                self._save()
+        finally:
+            cleanup_memmaps()
+            self.profiler.save()
+
+    def stage_cache(self) -> StageCache:
+        """checkpoint cache of this subject session, keyed by the content of its recording
+           (read and hashed only if input_hash was not given)"""
+        if self.input_hash is None:
+            self.input_hash = file_hash(recording_files(self.vhdr))
+        return StageCache(cache_dir=Path(CacheParams.CACHE_DIR) / self.subject_id / self.session,
+                          input_hash=self.input_hash)
+
+    def nodes(self) -> list:
+        """the pipeline as StageGraph nodes: the shared read node, then every stage of _stages in order"""
+        return [Node("read", lambda: read_raw(self.vhdr), checkpoint=False)] + [
+            Node(name, self._node_function(function), params=params,
+                 checkpoint=name in CacheParams.CHECKPOINT_STAGES)
+            for name, function, params in self._stages()]
+
+    def _node_function(self, stage: Callable) -> Callable:
+        """a stage method as a node function: input data in, stage output out"""
+        def function(data):
+            self._set_output(data)
+            stage()
+            return self._output()
+        return function
+
+    def _stages(self) -> list:
+        """(name, function, params) of every stage in order, params are everything its output depends on"""
+        rate_stages = [
+            ("filter",       self._filter,              class_params(FilterParams)),
+            ("resample",     self._resample,            class_params(FilterParams)),
+        ]
+        if FilterParams.RESAMPLE_FIRST:
+            rate_stages.reverse()
+        return [
+            ("load",         self._load_stage,          {"montage": "standard_1020", "eog": ChannelGroups.EOG}),
+            *rate_stages,
+            ("bad_channels", self._detect_bad_channels, {**class_params(BadChannelParams),
+                                                         "FLAT_THRESHOLD": RejectCriteria.FLAT_THRESHOLD}),
+            ("reference",    self._reference,           {"reference": "average"}),
+            ("ica",          self._run_ica,             class_params(ICAParams)),
+            ("epoch",        self._epoch_stage,         {**class_params(EpochParams), **class_params(TriggerCodes),
+                                                         "HARD_AMPLITUDE": RejectCriteria.HARD_AMPLITUDE}),
+            ("autoreject",   self._autoreject,          class_params(AutoRejectParams)),
+        ]
+
+    def _output(self):
+        """current data of the pipeline: epochs once they exist, else the raw recording"""
+        return self.epochs if hasattr(self, "epochs") else self.raw
+
+    def _set_output(self, data):
+        """resume from a checkpoint"""
+        if isinstance(data, mne.BaseEpochs):
+            self.epochs = data
+        else:
+            self.raw = data
+
+    def _load_stage(self):
+        """apply the montage to the raw recording read by the graph"""
+        self._set_montage(self.raw)
         print(f"  Loaded: {len(self.raw.ch_names)} channels, {self.raw.info['sfreq']} Hz, {self.raw.times[-1]:.1f} s")
 
-        self._filter()
-        self._resample()
-        self._detect_bad_channels()
-        self._reference()
-        self._run_ica()
-
+    def _epoch_stage(self):
+        """epoch the raw recording"""
         self.epochs = self._epoch()
         print(f"  Epochs before AutoReject: {len(self.epochs)}")
-        self._autoreject()
-        print(f"  Epochs after  AutoReject: {len(self.epochs)}")
-
-        self._save()
 
     def _find_vhdr(self) -> Optional[Path]:
         """return the .vhdr file inside subject_dir/session/, or None if missing"""
         session_dir = self.subject_dir / self.session
-        vhdrs = list(session_dir.glob("*.vhdr"))
+        vhdrs = sorted(session_dir.glob("*.vhdr"))
         if not vhdrs:
             print(f"  [skip] no .vhdr found in {session_dir}")
             return None
@@ -67,39 +154,45 @@ class Preprocessing:
             print(f"  [warn] multiple .vhdr files in {session_dir}, using {vhdrs[0].name}")
         return vhdrs[0]
 
-    def _load_raw(self) -> mne.io.Raw:
-        """load BrainVision file and apply standard 10-20 montage"""
-        raw = mne.io.read_raw_brainvision(self.vhdr, preload=True, verbose=False)
+    @staticmethod
+    def _set_montage(raw: mne.io.Raw):
+        """type the ChannelGroups.EOG channels as EOG and apply standard 10-20 montage"""
+        raw.set_channel_types({name: "eog" for name in ChannelGroups.EOG if name in raw.ch_names})
         montage = mne.channels.make_standard_montage("standard_1020")
         raw.set_montage(montage, match_case=False, on_missing="warn")
-        return raw
 
     def _filter(self):
         """band-pass + notch filter"""
-        self.raw.filter(l_freq=FilterParams.L_FREQ, h_freq=FilterParams.H_FREQ, method="iir", verbose=False)
-        self.raw.notch_filter(freqs=FilterParams.NOTCH_FREQ, verbose=False)
+        self.raw = self.filter_raw(self.raw, n_jobs=self.n_jobs)
 
     def _resample(self):
         """downsample to RESAMPLE_HZ if current rate is higher"""
-        if FilterParams.RESAMPLE_HZ and self.raw.info["sfreq"] > FilterParams.RESAMPLE_HZ:
-            self.raw.resample(FilterParams.RESAMPLE_HZ, verbose=False)
+        self.raw = self.resample_raw(self.raw, n_jobs=self.n_jobs)
+
+    @staticmethod
+    def filter_raw(raw: mne.io.BaseRaw, n_jobs: int = 1) -> mne.io.BaseRaw:
+        """band-pass + notch filter (chunk by chunk into a memory-mapped copy with MemoryParams.STREAMING_FILTER)"""
+        if MemoryParams.STREAMING_FILTER:
+            return stream_filter(raw, l_freq=FilterParams.L_FREQ, h_freq=FilterParams.H_FREQ, method="iir",
+                                 notch_freqs=FilterParams.NOTCH_FREQ, n_jobs=n_jobs, name="filter")
+        raw.filter(l_freq=FilterParams.L_FREQ, h_freq=FilterParams.H_FREQ, method="iir", n_jobs=n_jobs, verbose=False)
+        raw.notch_filter(freqs=FilterParams.NOTCH_FREQ, n_jobs=n_jobs, verbose=False)
+        return raw
+
+    @staticmethod
+    def resample_raw(raw: mne.io.BaseRaw, n_jobs: int = 1) -> mne.io.BaseRaw:
+        """downsample to RESAMPLE_HZ if current rate is higher (mne's resampling is anti-aliased)"""
+        if FilterParams.RESAMPLE_HZ and raw.info["sfreq"] > FilterParams.RESAMPLE_HZ:
+            raw.resample(FilterParams.RESAMPLE_HZ, n_jobs=n_jobs, verbose=False)
+        return raw
 
     def _detect_bad_channels(self):
-        """flag flat and noisy channels and interpolate them"""
-        data = self.raw.get_data(picks="eeg")
-        stds = data.std(axis=1)
-
-        flat_idx  = np.where(stds < RejectCriteria.FLAT_THRESHOLD)[0]
-        z         = (stds - stds.mean()) / stds.std()
-        noisy_idx = np.where(z > RejectCriteria.NOISY_Z_SCORE)[0]
-
-        bads = list(set(
-            [self.raw.ch_names[i] for i in flat_idx] +
-            [self.raw.ch_names[i] for i in noisy_idx]
-        ))
+        """flag flat, noisy and uncorrelated channels in windows streamed over the recording
+           (see bad_channels.detect_bad_channels) and interpolate them"""
+        bads = detect_bad_channels(self.raw, picks="eeg")
         if bads:
             print(f"  [bad channels] {bads}")
-        self.raw.info["bads"] = bads
+        self.raw.info["bads"] = list(bads)
         self.raw.interpolate_bads(reset_bads=True, verbose=False)
 
     def _reference(self):
@@ -107,18 +200,24 @@ class Preprocessing:
         self.raw.set_eeg_reference("average", projection=False, verbose=False)
 
     def _run_ica(self):
-        """run ICA and auto-label ocular & cardiac artefacts"""
-        raw_for_ica = self.raw.copy().filter(l_freq=ICAParams.FIT_L_FREQ, h_freq=None, verbose=False)
-
-        ica = mne.preprocessing.ICA(
-            n_components=ICAParams.N_COMPONENTS,
-            method=ICAParams.METHOD,
-            random_state=ICAParams.RANDOM_STATE,
-            max_iter="auto",
+        """run ICA (reusing the stored decomposition when the data did not change) and auto-label
+           ocular & cardiac artefacts"""
+        ica = self.ica_store.get(
+            inst=self.raw,
+            params=class_params(ICAParams),
+            make_fit_input=lambda: memmap_copy(self.raw, name=f"{self.subject_id}_{self.session}_ica").filter(
+                l_freq=ICAParams.FIT_L_FREQ, h_freq=None, n_jobs=self.n_jobs, verbose=False),
+            make_ica=lambda: mne.preprocessing.ICA(
+                n_components=ICAParams.N_COMPONENTS,
+                method=ICAParams.METHOD,
+                random_state=ICAParams.RANDOM_STATE,
+                max_iter="auto",
+            ),
         )
-        ica.fit(raw_for_ica, verbose=False)
 
-        eog_idx, _ = ica.find_bads_eog(self.raw, verbose=False)
+        eog_idx: list[int] = []
+        if "eog" in self.raw.get_channel_types():
+            eog_idx, _ = ica.find_bads_eog(self.raw, verbose=False)
         ecg_idx: list[int] = []
         if "ECG" in self.raw.get_channel_types():
             ecg_idx, _ = ica.find_bads_ecg(self.raw, verbose=False)
@@ -151,32 +250,117 @@ class Preprocessing:
         )
 
     def _autoreject(self):
-        """run AutoReject to repair / drop remaining bad epochs"""
-        ar = AutoReject(random_state=ICAParams.RANDOM_STATE, verbose=False)
-        self.epochs, reject_log = ar.fit_transform(self.epochs, return_log=True)
+        """run AutoReject to repair / drop remaining bad epochs, fitted on a stratified subsample of
+           AutoRejectParams.FIT_SIZE epochs (reused from the store when the epochs did not change)"""
+        ar = self.ar_store.get(
+            epochs=self.epochs,
+            params={"random_state": AutoRejectParams.RANDOM_STATE},
+            fit_size=AutoRejectParams.FIT_SIZE,
+            make_ar=lambda: AutoReject(random_state=AutoRejectParams.RANDOM_STATE, n_jobs=self.n_jobs, verbose=False),
+        )
+        self.epochs, reject_log = ar.transform(self.epochs, return_log=True)
         n_dropped = reject_log.bad_epochs.sum()
         print(f"  [AutoReject] dropped {n_dropped} epochs")
+        print(f"  Epochs after  AutoReject: {len(self.epochs)}")
 
     def _save(self):
         """save cleaned epochs to .fif file"""
-        out_dir = Path(Paths.OUTPUT_ROOT) / self.subject_id / self.session
-        out_dir.mkdir(parents=True, exist_ok=True)
-        out_path = out_dir / f"{self.subject_id}_{self.session}{FileFormat.PREPROCESSED_SUFFIX}"
+        out_path = output_path(subject_id=self.subject_id, session=self.session)
+        out_path.parent.mkdir(parents=True, exist_ok=True)
         self.epochs.save(out_path, overwrite=True, verbose=False)
         print(f"  Saved → {out_path}")
 
 
-def run_pipeline():
-    """run preprocessing for all subjects and sessions"""
+def run_pipeline(n_workers: Optional[int] = ComputeParams.N_WORKERS, force: bool = False) -> list:
+    """run preprocessing for all subjects and sessions in parallel:
+        1. skip the sessions the manifest (CacheParams.MANIFEST_PATH) records as finished from the same input
+           content, parameters and code version, unless force
+        2. one job per remaining (subject, session), each in its own process so a failing subject does not
+           stop the batch
+        3. jobs are admitted by free worker slots and their estimated memory (see batch_runner.run_jobs)
+        4. the cores are split between the workers: every job runs its MNE / AutoReject calls with
+           n_jobs_per_worker and caps its BLAS threads to the same number
+        5. record the sessions that finished with an output in the manifest
+        output: per-job summary rows (key, status, wall_s, error) of the scheduled jobs"""
     data_root    = Path(Paths.DATA_ROOT)
     subject_dirs = sorted(data_root.glob(f"{FileFormat.SUBJECT_FOLDER_PREFIX}*"))
     if not subject_dirs:
         raise FileNotFoundError(f"No subject folders found in {data_root}")
 
+    manifest  = Manifest()
+    scheduled = []
+    states    = {}
     for subject_dir in subject_dirs:
         for session in Paths.SESSIONS:
-            pre_processing = Preprocessing(subject_dir=subject_dir, session=session)
-            pre_processing.run()
+            key  = f"{subject_dir.name}/{session}"
+            vhdr = find_vhdr(subject_dir / session)
+            if vhdr is None:
+                continue
+            states[key] = manifest.input_state(key=key, vhdr=vhdr)
+            if force or not manifest.is_up_to_date(key=key, state=states[key],
+                                                   output=output_path(subject_dir.name, session)):
+                scheduled.append((subject_dir, session))
+    print(f"  [manifest] {len(states) - len(scheduled)} sessions up to date, {len(scheduled)} to process")
+    if not scheduled:
+        return []
+
+    n_workers = min(n_workers or os.cpu_count() or 1, len(scheduled))
+    n_jobs    = n_jobs_per_worker(n_workers)
+    jobs = [Job(key=f"{subject_dir.name}/{session}", function=_preprocess_job,
+                kwargs=dict(subject_dir=subject_dir, session=session, n_jobs=n_jobs,
+                            input_hash=states[f"{subject_dir.name}/{session}"]["input_hash"]),
+                memory_estimate=_estimate_memory(subject_dir=subject_dir, session=session), n_threads=n_jobs)
+            for subject_dir, session in scheduled]
+    rows = run_jobs(jobs=jobs, n_workers=n_workers)
+
+    for row, (subject_dir, session) in zip(rows, scheduled):
+        if row["status"] == "ok" and output_path(subject_dir.name, session).exists():
+            manifest.record(key=row["key"], state=states[row["key"]], output=output_path(subject_dir.name, session))
+    manifest.save()
+
+    profiles = [path for path in Path(ProfileParams.FOLDER).glob("*.json") if path.name != "cohort_summary.json"]
+    if ProfileParams.ENABLED and profiles:
+        cohort_summary(sorted(profiles))
+    return rows
+
+
+def output_path(subject_id: str, session: str) -> Path:
+    """the preprocessed epochs file of a subject session"""
+    return Path(Paths.OUTPUT_ROOT) / subject_id / session / f"{subject_id}_{session}{FileFormat.PREPROCESSED_SUFFIX}"
+
+
+def compare_pipelines(subject_dir: Path, session: str, or_pipeline: OrPipeline, input_hash: Optional[str] = None,
+                      **or_options) -> dict:
+    """run Preprocessing and OrPipeline (automatic bad channels by default) on the same recording in one StageGraph:
+       nodes they have in common (same name, parameters and inputs) run once and are checkpointed once
+       (input_hash: content hash of the recording if already known)
+        output: {'preprocessing': epochs, 'or_pipeline': {family: epochs}}"""
+    pre_processing = Preprocessing(subject_dir=subject_dir, session=session, input_hash=input_hash)
+    graph = StageGraph(cache=pre_processing.stage_cache(), profiler=pre_processing.profiler)
+    # the same file needs no second read, a different path must have the same content
+    if (or_pipeline.vhdr.resolve() != pre_processing.vhdr.resolve()
+            and file_hash(recording_files(or_pipeline.vhdr)) != graph.cache.input_hash):
+        raise ValueError(f"{or_pipeline.vhdr} is not the recording of {pre_processing.vhdr}")
+
+    graph.add(variant="preprocessing", nodes=pre_processing.nodes())
+    graph.add(variant="or_pipeline", nodes=or_pipeline.nodes(**{"do_auto_bad_ch": True, **or_options}))
+    try:
+        return graph.run()
+    finally:
+        cleanup_memmaps()
+        pre_processing.profiler.save()
+
+
+def _preprocess_job(subject_dir: Path, session: str, n_jobs: int, input_hash: Optional[str] = None):
+    """preprocess one subject session (runs inside a batch worker process), input_hash: from the manifest"""
+    pre_processing = Preprocessing(subject_dir=subject_dir, session=session, n_jobs=n_jobs, input_hash=input_hash)
+    pre_processing.run()
+
+
+def _estimate_memory(subject_dir: Path, session: str) -> int:
+    """estimated peak RAM of preprocessing one session: RAW_MEMORY_FACTOR × size of its .eeg data"""
+    eeg_bytes = sum(f.stat().st_size for f in (subject_dir / session).glob("*.eeg"))
+    return int(eeg_bytes * ComputeParams.RAW_MEMORY_FACTOR)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,113 @@
+import json
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from typing import Callable, Optional
+
+import mne
+import numpy as np
+
+from src.analysis.enums.analysis_enums import ProfileParams
+from src.analysis.pre_processing.memory import PeakRss, current_rss
+
+
+def data_shape(data) -> Optional[dict]:
+    """shape of the data a stage produced: raw, epochs, or a {name: epochs} dict of them"""
+    if isinstance(data, dict):
+        return {name: data_shape(value) for name, value in data.items()}
+    if isinstance(data, mne.BaseEpochs):
+        return {"n_epochs": len(data), "n_channels": len(data.ch_names), "n_times": len(data.times),
+                "sfreq": data.info["sfreq"]}
+    if isinstance(data, mne.io.BaseRaw):
+        return {"n_channels": len(data.ch_names), "n_times": data.n_times, "sfreq": data.info["sfreq"]}
+    return None
+
+
+class StageProfiler:
+    def __init__(self, subject_id: str, session: str):
+        """wall time, CPU time, peak RSS during the stage, RSS before / after and output shape of every stage
+           of one pipeline run"""
+        self.subject_id        = subject_id
+        self.session           = session
+        self.recording_seconds = None
+        self.stages            = []
+
+    @contextmanager
+    def stage(self, name: str, data: Callable = None):
+        """profile the block as stage name, data: returns the stage output (its shape is recorded)"""
+        if not ProfileParams.ENABLED:
+            yield
+            return
+        wall, cpu, rss = time.perf_counter(), time.process_time(), current_rss()
+        with PeakRss() as peak_rss:
+            yield
+        record = {"stage": name, "wall_s": time.perf_counter() - wall, "cpu_s": time.process_time() - cpu,
+                  "rss_before": rss, "rss_after": current_rss(), "peak_rss": peak_rss.peak,
+                  "shape": data_shape(data()) if data is not None else None}
+        self.stages.append(record)
+        peak = f"peak {record['peak_rss'] / 1e9:.2f} GB" if record["peak_rss"] else "peak n/a"
+        print(f"  [profile] {name:<13} {record['wall_s']:7.1f} s wall  {record['cpu_s']:7.1f} s cpu  {peak}")
+
+    def set_recording(self, raw: mne.io.BaseRaw):
+        """length of the input recording (seconds), the x-axis of the cohort scaling"""
+        self.recording_seconds = raw.n_times / raw.info["sfreq"]
+
+    def save(self, path: Path = None) -> Optional[Path]:
+        """write the profile JSON (default ProfileParams.FOLDER/<subject>_<session>.json)"""
+        if not ProfileParams.ENABLED:
+            return None
+        path = path or Path(ProfileParams.FOLDER) / f"{self.subject_id}_{self.session}.json"
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(json.dumps({
+            "subject": self.subject_id, "session": self.session, "recording_seconds": self.recording_seconds,
+            "created": datetime.now().isoformat(timespec="seconds"), "stages": self.stages,
+        }, indent=2, default=str))
+        return path
+
+
+def cohort_summary(profile_paths: list, out_path: Path = None) -> dict:
+    """summary over the profile JSONs of many sessions, per stage:
+        total and mean wall / cpu time, share of the total wall time, max peak RSS, and the seconds of wall
+        time per minute of recording (least-squares slope of wall time over recording length), so the stage
+        that dominates and how it scales are visible
+        output: {stage: summary}, also printed and written to out_path (default FOLDER/cohort_summary.json)"""
+    profiles = [json.loads(Path(path).read_text()) for path in profile_paths]
+    per_stage = {}
+    for profile in profiles:
+        for record in profile["stages"]:
+            per_stage.setdefault(record["stage"], []).append((profile["recording_seconds"], record))
+
+    total_wall = sum(record["wall_s"] for records in per_stage.values() for _, record in records) or 1.0
+    summary = {}
+    for stage, records in per_stage.items():
+        wall    = np.array([record["wall_s"] for _, record in records])
+        lengths = np.array([length or np.nan for length, _ in records], dtype=float)
+        known   = ~np.isnan(lengths)
+        slope   = (np.polyfit(lengths[known] / 60, wall[known], 1)[0]
+                   if known.sum() >= 2 and np.ptp(lengths[known]) > 0 else None)
+        summary[stage] = {
+            "sessions":         len(records),
+            "wall_total_s":     float(wall.sum()),
+            "wall_mean_s":      float(wall.mean()),
+            "cpu_mean_s":       float(np.mean([record["cpu_s"] for _, record in records])),
+            "wall_share":       float(wall.sum() / total_wall),
+            "peak_rss_max":     max((record["peak_rss"] or 0 for _, record in records), default=0),
+            "s_per_record_min": float(slope) if slope is not None else None,
+        }
+
+    print(f"\n{'='*60}")
+    print(f"  Profile summary: {len(profiles)} sessions")
+    for stage, row in sorted(summary.items(), key=lambda item: -item[1]["wall_total_s"]):
+        scaling = f"{row['s_per_record_min']:6.2f} s / rec. min" if row["s_per_record_min"] is not None else ""
+        print(f"  {stage:<13} {row['wall_share']:6.1%}  mean {row['wall_mean_s']:7.1f} s  {scaling}")
+    print(f"{'='*60}")
+
+    out_path = out_path or Path(ProfileParams.FOLDER) / "cohort_summary.json"
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    out_path.write_text(json.dumps(summary, indent=2))
+    return summary
+
+
+if __name__ == "__main__":
+    cohort_summary(sorted(p for p in Path(ProfileParams.FOLDER).glob("*.json") if p.name != "cohort_summary.json"))
@@ -0,0 +1,67 @@
+import time
+import tempfile
+from pathlib import Path
+from typing import Callable
+
+import mne
+import numpy as np
+import pandas as pd
+
+from src.analysis.pre_processing.batch_runner import n_jobs_per_worker
+from src.analysis.pre_processing.stage_graph import read_raw
+from src.analysis.pre_processing.synthetic_data import write_brainvision
+
+
+def compare_orders(raw: mne.io.BaseRaw, filter_raw: Callable, resample_raw: Callable, n_jobs: int = 1,
+                   edge_seconds: float = 10.0) -> dict:
+    """filter-then-resample (reference) against resample-then-filter (fast path) on copies of raw:
+        input: filter_raw / resample_raw: the filter and resample steps of a pipeline, (raw, n_jobs) -> raw
+               edge_seconds: the ends of the recording, where the filters settle, are reported separately
+        output: {'reference_s', 'fast_s', 'speedup', 'max_abs_deviation', 'max_interior_deviation',
+                 'relative_deviation'} (deviations in the data units, relative to the peak of the reference)"""
+    tic = time.perf_counter()
+    reference = resample_raw(filter_raw(raw.copy().load_data(), n_jobs), n_jobs)
+    reference_s = time.perf_counter() - tic
+
+    tic = time.perf_counter()
+    fast = filter_raw(resample_raw(raw.copy().load_data(), n_jobs), n_jobs)
+    fast_s = time.perf_counter() - tic
+
+    picks     = mne.pick_types(reference.info, eeg=True, eog=True, ecg=True, emg=True, exclude=[])
+    deviation = np.abs(fast.get_data(picks=picks) - reference.get_data(picks=picks))
+    edge      = min(int(edge_seconds * reference.info["sfreq"]), deviation.shape[1] // 4)
+    scale     = float(np.abs(reference.get_data(picks=picks)).max()) or 1.0
+    return {"reference_s": reference_s, "fast_s": fast_s, "speedup": reference_s / fast_s,
+            "max_abs_deviation": float(deviation.max()),
+            "max_interior_deviation": float(deviation[:, edge:deviation.shape[1] - edge].max()),
+            "relative_deviation": float(deviation.max()) / scale}
+
+
+def check_resample_first(vhdr: Path = None, n_jobs: int = None) -> pd.DataFrame:
+    """equivalence check of FilterParams.RESAMPLE_FIRST for both pipelines on a sample recording
+       (vhdr, or a short synthetic recording written to a temporary folder):
+        Preprocessing: band-pass + notch vs resample to RESAMPLE_HZ
+        OrPipeline:    high-pass + notch vs resample to 1000 Hz (after the EMG channel is dropped)
+        output: one row of compare_orders per pipeline, also printed"""
+    from src.analysis.pre_processing.pipeline import Preprocessing
+    from src.analysis.pre_processing.or_pipeline import OrPipeline
+
+    n_jobs = n_jobs or n_jobs_per_worker()
+    if vhdr is None:
+        vhdr = Path(tempfile.mkdtemp()) / "resample_first_check.vhdr"
+        write_brainvision(vhdr, n_channels=32, minutes=2.0, sfreq=2000)
+    raw = read_raw(Path(vhdr))
+
+    or_raw = OrPipeline._prepare_raw(raw.copy(), EOG_ch=True)
+    OrPipeline._move_out_emg_electrode(or_raw)
+    rows = [
+        {"pipeline": "Preprocessing", **compare_orders(raw, Preprocessing.filter_raw, Preprocessing.resample_raw,
+                                                       n_jobs=n_jobs)},
+        {"pipeline": "OrPipeline",    **compare_orders(or_raw, OrPipeline.filter_raw, OrPipeline.resample_raw,
+                                                       n_jobs=n_jobs)},
+    ]
+    for row in rows:
+        print(f"  [resample first] {row['pipeline']:<13} {row['speedup']:.1f}x faster "
+              f"({row['reference_s']:.1f} s -> {row['fast_s']:.1f} s), max deviation {row['max_abs_deviation']:.3g} "
+              f"({row['relative_deviation']:.2e} of peak), {row['max_interior_deviation']:.3g} away from the edges")
+    return pd.DataFrame(rows)
@@ -0,0 +1,102 @@
+import json
+import hashlib
+from datetime import datetime
+from pathlib import Path
+from typing import Optional, Union
+
+import mne
+
+from src.analysis.enums.analysis_enums import CacheParams
+
+
+def class_params(params_class) -> dict:
+    """the UPPER_CASE attributes of an analysis_enums class as a JSON-able dict (tuples become lists)"""
+    return {name: json.loads(json.dumps(value, default=str))
+            for name, value in vars(params_class).items() if name.isupper()}
+
+
+def file_hash(paths: list) -> str:
+    """sha256 over the contents of the files (read in chunks, in the given order)"""
+    digest = hashlib.sha256()
+    for path in paths:
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(CacheParams.HASH_CHUNK_BYTES), b""):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+def recording_files(vhdr: Path) -> list:
+    """the files of a BrainVision recording: the .vhdr header and its .vmrk markers and .eeg data"""
+    return [path for path in [vhdr, vhdr.with_suffix(".vmrk"), vhdr.with_suffix(".eeg")] if path.exists()]
+
+
+class StageCache:
+    def __init__(self, cache_dir: Path, input_hash: str):
+        """on-disk checkpoints of pipeline stages:
+            input: cache_dir: folder of the checkpoints of one subject session
+                   input_hash: content hash of the input recording
+           the key of a stage hashes its name and parameters with the key of the stage before it,
+           so a checkpoint is valid only for the same input and the same parameters of every upstream stage"""
+        self.cache_dir  = cache_dir
+        self.input_hash = input_hash
+
+    def stage_key(self, stage: str, params: dict, upstream_key: Optional[str]) -> str:
+        """chained key of a stage"""
+        payload = json.dumps({"stage": stage, "params": params, "upstream": upstream_key or self.input_hash,
+                              "version": CacheParams.VERSION}, sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def chain_keys(self, stages: list) -> list:
+        """keys of a list of (name, function, params) stages in order"""
+        keys = []
+        for name, _, params in stages:
+            keys.append(self.stage_key(stage=name, params=params, upstream_key=keys[-1] if keys else None))
+        return keys
+
+    def load(self, stage: str, key: str,
+             preload: Union[bool, str] = True) -> Optional[Union[mne.io.BaseRaw, mne.BaseEpochs]]:
+        """the checkpointed output of a stage, or None if there is no valid checkpoint for this key
+           (preload: True, or a memory-mapped file for a raw checkpoint)"""
+        if not CacheParams.ENABLED:
+            return None
+        for fif_path in self.cache_dir.glob(f"{stage}_{key[:16]}-*.fif"):
+            sidecar = self._sidecar(fif_path)
+            if not sidecar.exists() or json.loads(sidecar.read_text()).get("key") != key:
+                continue
+            if fif_path.name.endswith("-epo.fif"):
+                return mne.read_epochs(fif_path, preload=True, verbose=False)
+            return mne.io.read_raw_fif(fif_path, preload=preload, verbose=False)
+        return None
+
+    def save(self, stage: str, key: str, params: dict, data: Union[mne.io.BaseRaw, mne.BaseEpochs]):
+        """checkpoint the output of a stage (double precision, so a resumed run matches an uncached one)
+           with a sidecar JSON describing what it was computed from; the checkpoints of the same stage with
+           other keys (older parameters, input or VERSION) are deleted, so one session keeps one per stage"""
+        if not CacheParams.ENABLED:
+            return
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        suffix   = "-epo.fif" if isinstance(data, mne.BaseEpochs) else "-raw.fif"
+        fif_path = self.cache_dir / f"{stage}_{key[:16]}{suffix}"
+        data.save(fif_path, fmt="double", overwrite=True, verbose=False)
+        self._sidecar(fif_path).write_text(json.dumps({
+            "stage": stage, "key": key, "params": params, "input_hash": self.input_hash,
+            "version": CacheParams.VERSION, "created": datetime.now().isoformat(timespec="seconds"),
+        }, indent=2, default=str))
+        self._evict(stage=stage, keep=fif_path)
+
+    def _evict(self, stage: str, keep: Path):
+        """delete every other checkpoint of the stage in this session folder (its .fif and sidecar)"""
+        for fif_path in self.cache_dir.glob(f"{stage}_*-*.fif"):
+            sidecar = self._sidecar(fif_path)
+            if fif_path == keep:
+                continue
+            # the name prefix alone could match another stage whose name starts with this one
+            if sidecar.exists() and json.loads(sidecar.read_text()).get("stage") != stage:
+                continue
+            fif_path.unlink(missing_ok=True)
+            sidecar.unlink(missing_ok=True)
+
+    @staticmethod
+    def _sidecar(fif_path: Path) -> Path:
+        """<checkpoint>.json next to the checkpoint .fif"""
+        return fif_path.with_name(fif_path.name.replace(".fif", ".json"))
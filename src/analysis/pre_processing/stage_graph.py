@@ -0,0 +1,105 @@
+from pathlib import Path
+from typing import Callable, Optional
+
+import mne
+
+from src.analysis.pre_processing.memory import preload_target
+from src.analysis.pre_processing.profiler import StageProfiler
+from src.analysis.pre_processing.stage_cache import StageCache
+
+
+class Node:
+    def __init__(self, name: str, function: Callable, params: dict = None, inputs: list = None,
+                 checkpoint: bool = True):
+        """one step of a pipeline:
+            input: name: stage name (also the checkpoint file prefix)
+                   function: function(*input outputs) -> output, may modify its inputs in place
+                   params: everything the output depends on besides the inputs (part of the key)
+                   inputs: names of the upstream nodes of the same variant (default: the node before it)
+                   checkpoint: save / resume the output in the StageCache (raw or epochs outputs only)"""
+        self.name       = name
+        self.function   = function
+        self.params     = params or {}
+        self.inputs     = inputs
+        self.checkpoint = checkpoint
+
+
+def read_raw(vhdr: Path) -> mne.io.BaseRaw:
+    """read a BrainVision recording (into a memory-mapped file in out-of-core mode), the usual root node"""
+    return mne.io.read_raw_brainvision(vhdr, preload=preload_target(f"{vhdr.stem}_raw"), verbose=False)
+
+
+class StageGraph:
+    def __init__(self, cache: StageCache, profiler: Optional[StageProfiler] = None):
+        """executor of pipeline variants on one recording:
+           the key of a node hashes its name and params with the keys of its inputs (StageCache.stage_key), so
+           nodes with the same key in different variants are the same computation: it runs once, its output is
+           kept in memory until its last consumer takes it (the others get copies) and it is checkpointed once"""
+        self.cache     = cache
+        self.profiler  = profiler or StageProfiler(subject_id="graph", session="graph")
+        self.nodes     = {}
+        self.edges     = set()
+        self.consumers = {}
+        self.sinks     = {}
+        self.outputs   = {}
+
+    def add(self, variant: str, nodes: list):
+        """register a variant: its nodes in order, the output of the last one is the output of the variant"""
+        keys = {}
+        for position, node in enumerate(nodes):
+            inputs = node.inputs if node.inputs is not None else ([nodes[position - 1].name] if position else [])
+            input_keys = [keys[name] for name in inputs]
+            key = self.cache.stage_key(stage=node.name, params=node.params,
+                                       upstream_key="+".join(input_keys) or None)
+            keys[node.name] = key
+            self.nodes.setdefault(key, (node, input_keys))
+            for input_key in input_keys:
+                if (input_key, key) not in self.edges:
+                    self.edges.add((input_key, key))
+                    self.consumers[input_key] = self.consumers.get(input_key, 0) + 1
+        self.sinks[variant] = keys[nodes[-1].name]
+        self.consumers[self.sinks[variant]] = self.consumers.get(self.sinks[variant], 0) + 1
+
+    def run(self) -> dict:
+        """compute every variant, output: {variant: output of its last node}
+           (a node with a valid checkpoint is loaded instead of computed, so nothing upstream of it runs)"""
+        shared = [key for key, count in self.consumers.items() if count > 1]
+        if len(self.sinks) > 1 and shared:
+            print(f"  [graph] {len(self.sinks)} variants, shared nodes: "
+                  f"{', '.join(self.nodes[key][0].name for key in shared)}")
+        return {variant: self._compute(key) for variant, key in self.sinks.items()}
+
+    def _compute(self, key: str):
+        """output of a node for one consumer: from memory, the checkpoint, or computed from its inputs"""
+        if key not in self.outputs:
+            node, input_keys = self.nodes[key]
+            checkpoint = (self.cache.load(stage=node.name, key=key, preload=preload_target(f"{node.name}_cache"))
+                          if node.checkpoint else None)
+            if checkpoint is not None:
+                print(f"  [cache] resuming after {node.name}")
+                self.outputs[key] = checkpoint
+            else:
+                inputs = [self._compute(input_key) for input_key in input_keys]
+                with self.profiler.stage(node.name, data=lambda: self.outputs.get(key)):
+                    self.outputs[key] = node.function(*inputs)
+                if node.checkpoint and isinstance(self.outputs[key], (mne.io.BaseRaw, mne.BaseEpochs)):
+                    self.cache.save(stage=node.name, key=key, params=node.params, data=self.outputs[key])
+            # the first continuous output (the read node, or a checkpoint on resume) gives the recording length
+            # (resampling keeps it), so every pipeline's profile has it
+            if self.profiler.recording_seconds is None and isinstance(self.outputs[key], mne.io.BaseRaw):
+                self.profiler.set_recording(self.outputs[key])
+        return self._take(key)
+
+    def _take(self, key: str):
+        """hand the output to one consumer: a copy while other consumers still need it, else the output itself"""
+        self.consumers[key] -= 1
+        if self.consumers[key] > 0:
+            return _copy(self.outputs[key])
+        return self.outputs.pop(key)
+
+
+def _copy(data):
+    """copy of raw, epochs or a {name: epochs} dict"""
+    if isinstance(data, dict):
+        return {name: value.copy() for name, value in data.items()}
+    return data.copy()
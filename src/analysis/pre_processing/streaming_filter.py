@@ -0,0 +1,97 @@
+import time
+from typing import Optional
+
+import mne
+import numpy as np
+from scipy.signal import sosfilt
+
+from src.analysis.enums.analysis_enums import MemoryParams
+from src.analysis.pre_processing.memory import chunks, memmap_file, memmap_raw
+
+NOTCH_TRANS_BANDWIDTH = 1.0   # mne notch_filter default (Hz)
+
+
+def filter_picks(info: mne.Info) -> np.ndarray:
+    """the channels raw.filter filters by default here: the data channels, bad ones included (not the stim)"""
+    return mne.pick_types(info, eeg=True, eog=True, ecg=True, emg=True, exclude=[])
+
+
+def padding(sfreq: float, l_freq: Optional[float], h_freq: Optional[float], method: str = "fir",
+            iir_params: dict = None, notch_freqs=None) -> int:
+    """samples of real data needed on each side of a chunk so the filters (forward-backward IIR or zero-phase
+       FIR, then the notch) see the same context as on the whole recording:
+       FIR: the filter length; IIR: twice the samples until the impulse response decays below IIR_DECAY × peak"""
+    pad = 0
+    if l_freq is not None or h_freq is not None:
+        design = mne.filter.create_filter(None, sfreq, l_freq, h_freq, method=method, iir_params=iir_params,
+                                          verbose=False)
+        if method == "iir":
+            impulse = np.zeros(int(sfreq * 600))
+            impulse[0] = 1.0
+            response = np.abs(sosfilt(design["sos"], impulse))
+            pad += 2 * int(np.nonzero(response > MemoryParams.IIR_DECAY * response.max())[0][-1] + 1)
+        else:
+            pad += len(design)
+    if notch_freqs is not None:
+        pad += int(np.ceil(3.3 / NOTCH_TRANS_BANDWIDTH * sfreq)) + 1   # 'auto' hamming length
+    return pad
+
+
+def stream_filter(raw: mne.io.BaseRaw, l_freq: Optional[float], h_freq: Optional[float], method: str = "fir",
+                  iir_params: dict = None, notch_freqs=None, n_jobs: int = 1, name: str = "filtered") -> mne.io.BaseRaw:
+    """band-pass (and notch) filter raw chunk by chunk into a memory-mapped copy (overlap-save):
+        1. every FILTER_CHUNK_SECONDS chunk is read with `padding` samples of real data on each side
+           (clipped at the ends of the recording, where mne pads exactly as for the whole recording)
+        2. the padded segment is filtered with the same mne designs as raw.filter / raw.notch_filter,
+           the channels in parallel (n_jobs)
+        3. only the chunk itself is written into the memory-mapped output, so memory is bounded by one
+           padded chunk whatever the length of the recording
+        output: a new Raw over the memory-mapped data (same info, first sample and annotations)"""
+    sfreq = raw.info["sfreq"]
+    picks = filter_picks(raw.info)
+    pad   = padding(sfreq, l_freq, h_freq, method, iir_params, notch_freqs)
+    out   = np.memmap(memmap_file(name), dtype=np.float64, mode="w+", shape=(len(raw.ch_names), raw.n_times))
+
+    for start, stop in chunks(raw, seconds=MemoryParams.FILTER_CHUNK_SECONDS):
+        seg_start, seg_stop = max(0, start - pad), min(raw.n_times, stop + pad)
+        segment = raw.get_data(start=seg_start, stop=seg_stop)
+        if l_freq is not None or h_freq is not None:
+            segment = mne.filter.filter_data(segment, sfreq, l_freq, h_freq, picks=picks, method=method,
+                                             iir_params=iir_params, n_jobs=n_jobs, copy=False, verbose=False)
+        if notch_freqs is not None:
+            segment = mne.filter.notch_filter(segment, sfreq, notch_freqs, picks=picks, n_jobs=n_jobs,
+                                              copy=False, verbose=False)
+        out[:, start:stop] = segment[:, start - seg_start:stop - seg_start]
+    out.flush()
+    print(f"  [stream filter] {raw.n_times / sfreq / 60:.1f} min in {MemoryParams.FILTER_CHUNK_SECONDS:g} s chunks, "
+          f"padding {pad / sfreq:.1f} s")
+    return memmap_raw(out, raw)
+
+
+def check_equivalence(raw: mne.io.BaseRaw, l_freq: Optional[float], h_freq: Optional[float], method: str = "fir",
+                      iir_params: dict = None, notch_freqs=None, n_jobs: int = 1) -> dict:
+    """compare stream_filter with the in-memory raw.filter / raw.notch_filter on raw (load a short recording):
+        output: {'max_abs_deviation', 'relative_deviation', 'stream_s', 'in_memory_s'}"""
+    tic = time.perf_counter()
+    streamed = stream_filter(raw, l_freq, h_freq, method, iir_params, notch_freqs, n_jobs, name="check")
+    stream_s = time.perf_counter() - tic
+
+    tic = time.perf_counter()
+    reference = raw.copy().load_data()
+    if l_freq is not None or h_freq is not None:
+        reference.filter(l_freq, h_freq, picks=filter_picks(raw.info), method=method, iir_params=iir_params,
+                         n_jobs=n_jobs, verbose=False)
+    if notch_freqs is not None:
+        reference.notch_filter(notch_freqs, picks=filter_picks(raw.info), n_jobs=n_jobs, verbose=False)
+    in_memory_s = time.perf_counter() - tic
+
+    deviation = 0.0
+    for start, stop in chunks(raw):
+        deviation = max(deviation, float(np.abs(streamed.get_data(start=start, stop=stop)
+                                                - reference.get_data(start=start, stop=stop)).max()))
+    scale  = float(np.abs(reference.get_data()).max()) or 1.0
+    result = {"max_abs_deviation": deviation, "relative_deviation": deviation / scale,
+              "stream_s": stream_s, "in_memory_s": in_memory_s}
+    print(f"  [stream filter] max deviation {deviation:.3g} ({deviation / scale:.2e} of peak), "
+          f"{stream_s:.1f} s streamed vs {in_memory_s:.1f} s in memory")
+    return result
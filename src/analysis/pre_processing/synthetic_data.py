@@ -0,0 +1,137 @@
+from pathlib import Path
+
+import mne
+import numpy as np
+from scipy.signal import lfilter, lfilter_zi
+
+from src.analysis.enums.analysis_enums import SyntheticParams, ParallelPortDict, ChannelGroups
+
+
+def channel_names(n_channels: int, montage_name: str = SyntheticParams.MONTAGE) -> tuple:
+    """the first n_channels EEG names of the montage (AFz written 'Afz' as in the lab recordings)
+       and their positions, output: (names, positions (n, 3))"""
+    positions = mne.channels.make_standard_montage(montage_name).get_positions()["ch_pos"]
+    names     = list(positions)[:n_channels]
+    if len(names) < n_channels:
+        raise ValueError(f"{montage_name} has only {len(names)} channels")
+    return ["Afz" if name == "AFz" else name for name in names], np.array([positions[name] for name in names])
+
+
+def write_brainvision(vhdr_path: Path, n_channels: int = SyntheticParams.N_CHANNELS,
+                      minutes: float = SyntheticParams.MINUTES, sfreq: int = SyntheticParams.SFREQ,
+                      with_emg: bool = True, with_eog: bool = True, seed: int = SyntheticParams.SEED) -> dict:
+    """write a realistic synthetic BrainVision recording (.vhdr / .vmrk / .eeg, float32 µV, multiplexed):
+        1. background: N_SOURCES 1/f sources mixed into the channels by sensor distance, plus channel noise
+           and a 10 Hz alpha rhythm weighted to the back of the head
+        2. artefacts: blinks (frontal), ECG (QRS spikes on every channel), LINE_HZ line noise
+        3. bad channels: N_BAD channels, the first flat and the others noisy
+        4. triggers: codes drawn from ParallelPortDict.EVENT_DICT every EVENT_INTERVAL_S seconds
+        5. with_eog: 'HEOG' and 'VEOG' channels (ChannelGroups.EOG) carrying the blinks and slow horizontal
+           eye movements (the EOG-based ICA component search needs them)
+        6. with_emg: an extra 'EMG' channel (OrPipeline expects it)
+       generated and written CHUNK_SECONDS at a time, so the memory use does not grow with the duration
+        output: {'vhdr', 'bads', 'n_events'}"""
+    rng              = np.random.default_rng(seed)
+    names, positions = channel_names(n_channels)
+    eog_names        = ChannelGroups.EOG if with_eog else []
+    n_total          = n_channels + len(eog_names) + with_emg
+    n_times          = int(minutes * 60 * sfreq)
+    chunk            = int(SyntheticParams.CHUNK_SECONDS * sfreq)
+
+    sources   = rng.normal(size=(SyntheticParams.N_SOURCES, 3)) * np.ptp(positions, axis=0) / 2
+    distances = np.linalg.norm(positions[:, None] - sources[None], axis=2)
+    mixing    = np.exp(-(distances / distances.mean()) ** 2)
+    frontal   = np.clip(positions[:, 1] / positions[:, 1].max(), 0, 1) ** 2
+    posterior = np.clip(positions[:, 1] / positions[:, 1].min(), 0, 1)
+    ecg_gain  = rng.uniform(-1, 1, n_channels)
+    bads      = list(rng.choice(names, size=min(SyntheticParams.N_BAD, n_channels), replace=False))
+    bad_index = [names.index(name) for name in bads]
+
+    # 1/f (pink) noise: white noise through the Voss-McCartney approximating filter, state kept across chunks
+    b, a    = [0.049922035, -0.095993537, 0.050612699, -0.004408786], [1, -2.494956002, 2.017265875, -0.522189400]
+    zi_src  = np.outer(np.ones(SyntheticParams.N_SOURCES), lfilter_zi(b, a))
+    blinks  = _event_times(rng, n_times, sfreq, SyntheticParams.BLINK_INTERVAL_S)
+    events  = _triggers(rng, n_times, sfreq)
+
+    vhdr_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(vhdr_path.with_suffix(".eeg"), "wb") as f:
+        for start in range(0, n_times, chunk):
+            stop  = min(start + chunk, n_times)
+            times = np.arange(start, stop) / sfreq
+            white        = rng.normal(size=(SyntheticParams.N_SOURCES, stop - start))
+            pink, zi_src = lfilter(b, a, white, axis=1, zi=zi_src)
+            data  = mixing @ pink * SyntheticParams.BACKGROUND_UV * 4
+            data += rng.normal(scale=SyntheticParams.BACKGROUND_UV / 4, size=data.shape)
+            data += np.outer(posterior, np.sin(2 * np.pi * 10 * times)) * SyntheticParams.ALPHA_UV
+            blink = _bumps(times, blinks / sfreq, width=0.1)
+            data += np.outer(frontal, blink) * SyntheticParams.BLINK_UV
+            data += np.outer(ecg_gain, _ecg(times)) * SyntheticParams.ECG_UV
+            data += np.sin(2 * np.pi * SyntheticParams.LINE_HZ * times) * SyntheticParams.LINE_UV
+            data[bad_index[:1]] *= 1e-3
+            data[bad_index[1:]]  = data[bad_index[1:]] * 8
+            data[bad_index[1:]] += rng.normal(scale=50, size=(len(bad_index[1:]), stop - start))
+            if with_eog:
+                heog  = np.sin(2 * np.pi * 0.2 * times) * SyntheticParams.BLINK_UV / 3 + blink * SyntheticParams.BLINK_UV / 10
+                veog  = blink * SyntheticParams.BLINK_UV * 1.5
+                noise = rng.normal(scale=SyntheticParams.BACKGROUND_UV / 4, size=(2, stop - start))
+                data  = np.vstack([data, heog + noise[0], veog + noise[1]])
+            if with_emg:
+                data = np.vstack([data, rng.normal(scale=20, size=(1, stop - start))])
+            f.write(np.ascontiguousarray(data.T, dtype="<f4").tobytes())
+
+    _write_header(vhdr_path, names + eog_names + ["EMG"] * with_emg, sfreq)
+    _write_markers(vhdr_path, events)
+    print(f"  [synthetic] {vhdr_path.name}: {n_total} channels, {minutes:g} min at {sfreq} Hz, "
+          f"{len(events)} triggers, bad {bads}")
+    return {"vhdr": vhdr_path, "bads": bads, "n_events": len(events)}
+
+
+def _event_times(rng: np.random.Generator, n_times: int, sfreq: float, mean_interval: float) -> np.ndarray:
+    """sample indices of a Poisson process with the given mean interval (s)"""
+    intervals = rng.exponential(mean_interval * sfreq, size=int(n_times / (mean_interval * sfreq) * 2) + 10)
+    times     = np.cumsum(intervals).astype(int)
+    return times[times < n_times]
+
+
+def _triggers(rng: np.random.Generator, n_times: int, sfreq: float) -> np.ndarray:
+    """(sample, code) triggers: codes of EVENT_DICT every EVENT_INTERVAL_S seconds"""
+    low, high = SyntheticParams.EVENT_INTERVAL_S
+    samples   = np.cumsum(rng.uniform(low, high, size=int(n_times / (low * sfreq)) + 1) * sfreq).astype(int)
+    samples   = samples[samples < n_times]
+    codes     = rng.choice(list(ParallelPortDict.EVENT_DICT.values()), size=len(samples))
+    return np.column_stack([samples, codes])
+
+
+def _bumps(times: np.ndarray, centers: np.ndarray, width: float) -> np.ndarray:
+    """sum of gaussian bumps (blinks) centered at the times in centers (s) that fall near this chunk"""
+    near   = centers[(centers > times[0] - 5 * width) & (centers < times[-1] + 5 * width)]
+    signal = np.zeros_like(times)
+    for center in near:
+        signal += np.exp(-0.5 * ((times - center) / width) ** 2)
+    return signal
+
+
+def _ecg(times: np.ndarray) -> np.ndarray:
+    """QRS-like spikes at ECG_HZ"""
+    phase = (times * SyntheticParams.ECG_HZ) % 1.0
+    return np.exp(-0.5 * ((phase - 0.5) / 0.01) ** 2) - 0.2 * np.exp(-0.5 * ((phase - 0.53) / 0.015) ** 2)
+
+
+def _write_header(vhdr_path: Path, names: list, sfreq: float):
+    """the .vhdr header: multiplexed IEEE float32 in µV"""
+    lines = ["Brain Vision Data Exchange Header File Version 1.0", "; synthetic recording", "",
+             "[Common Infos]", "Codepage=UTF-8", f"DataFile={vhdr_path.with_suffix('.eeg').name}",
+             f"MarkerFile={vhdr_path.with_suffix('.vmrk').name}", "DataFormat=BINARY",
+             "DataOrientation=MULTIPLEXED", f"NumberOfChannels={len(names)}",
+             f"SamplingInterval={1e6 / sfreq:g}", "", "[Binary Infos]", "BinaryFormat=IEEE_FLOAT_32", "",
+             "[Channel Infos]"]
+    lines += [f"Ch{index}={name},,1,µV" for index, name in enumerate(names, start=1)]
+    vhdr_path.write_text("\n".join(lines) + "\n", encoding="utf-8")
+
+
+def _write_markers(vhdr_path: Path, events: np.ndarray):
+    """the .vmrk markers: a new segment and one 'S  <code>' stimulus per trigger"""
+    lines = ["Brain Vision Data Exchange Marker File, Version 1.0", "", "[Common Infos]", "Codepage=UTF-8",
+             f"DataFile={vhdr_path.with_suffix('.eeg').name}", "", "[Marker Infos]", "Mk1=New Segment,,1,1,0"]
+    lines += [f"Mk{index}=Stimulus,S{code:>3},{sample + 1},1,0" for index, (sample, code) in enumerate(events, start=2)]
+    vhdr_path.with_suffix(".vmrk").write_text("\n".join(lines) + "\n", encoding="utf-8")
@@ -0,0 +1,100 @@
+import os
+from pathlib import Path
+from typing import Optional
+
+import mne
+import numpy as np
+import pandas as pd
+
+from src.analysis.enums.analysis_enums import AlignmentParams, ComputeParams, FileFormat, ParallelPortDict, Paths
+from src.analysis.pre_processing.batch_runner import Job, run_jobs
+from src.analysis.pre_processing.behavior_alignment import _anchor_pairs, align_events, estimate_clock, load_behavior
+from src.analysis.pre_processing.manifest import find_vhdr
+
+QUANTILES = [0.05, 0.25, 0.5, 0.75, 0.95]
+
+
+def audit_session(vhdr: Path, subject_id: str, behavior_root: Path = Path(AlignmentParams.BEHAVIOR_ROOT)) -> dict:
+    """latency of the EEG markers of one session against the task timestamps of the same moments:
+        1. the markers are read from the .vmrk (no data), the timestamps from the subject's combined CSV
+           (the trial_times of the task JSON files, one row per trial)
+        2. the task → EEG clock map and the trigger / row matching of behavior_alignment.align_events
+        3. latency of every matched trigger = its EEG time − the mapped task time: per anchor its quantiles,
+           its median (the constant latency of that marker relative to the task log) and its jitter (std around
+           that median); per session the clock drift, the largest per-anchor jitter and the unmatched triggers
+        output: {'session': row of the session table, 'anchors': rows of the anchor table}"""
+    session  = {"subject": subject_id, "file": vhdr.name}
+    behavior = load_behavior(subject_id, behavior_root)
+    if behavior is None:
+        return {"session": {**session, "status": "no behavior"}, "anchors": []}
+
+    raw       = mne.io.read_raw_brainvision(vhdr, preload=False, verbose=False)
+    events, _ = mne.events_from_annotations(raw, verbose=False)
+    sfreq     = raw.info["sfreq"]
+    pairs     = _anchor_pairs(events, sfreq, behavior)
+    if not pairs:
+        return {"session": {**session, "status": "no anchors"}, "anchors": []}
+
+    slope, offset = estimate_clock(pairs)
+    row_of_event, error_ms, _ = align_events(events, sfreq, behavior, clock=(slope, offset))
+    anchors, medians, jitters = [], {}, {}
+    for name, eeg_idx, _, beh_idx, _ in pairs:
+        latency = error_ms[eeg_idx][row_of_event[eeg_idx] >= 0]
+        row     = {"subject": subject_id, "file": vhdr.name, "anchor": name,
+                   "code": ParallelPortDict.EVENT_DICT[name], "column": AlignmentParams.ANCHORS[name],
+                   "triggers": len(eeg_idx), "rows": len(beh_idx), "matched": len(latency)}
+        if len(latency):
+            row.update({f"p{int(q * 100)}_ms": float(value) for q, value in zip(QUANTILES, np.quantile(latency, QUANTILES))})
+            # each marker type has its own constant latency (the median); only the spread around it is jitter
+            medians[name]    = float(np.median(latency))
+            jitters[name]    = float((latency - medians[name]).std())
+            row["median_ms"] = medians[name]
+            row["jitter_ms"] = jitters[name]
+        anchors.append(row)
+
+    latency  = error_ms[row_of_event >= 0]
+    triggers = sum(len(eeg_idx) for _, eeg_idx, _, _, _ in pairs)
+    worst    = max(jitters, key=jitters.get) if jitters else None
+    jitter   = jitters[worst] if jitters else np.nan
+    session.update({"status": "ok", "matched": len(latency), "unmatched_triggers": triggers - len(latency),
+                    "offset_s": float(offset), "drift_ppm": (slope - 1) * 1e6,
+                    "drift_ms_per_hour": (slope - 1) * 3600 * 1000, "jitter_ms": jitter, "jitter_anchor": worst,
+                    **{f"latency_ms_{name}": median for name, median in medians.items()},
+                    "p95_abs_ms": float(np.quantile(np.abs(latency), 0.95)) if len(latency) else np.nan,
+                    "flagged": bool(jitter > AlignmentParams.JITTER_MS)})
+    return {"session": session, "anchors": anchors}
+
+
+def audit_cohort(n_workers: Optional[int] = ComputeParams.N_WORKERS,
+                 out_path: Path = Path(AlignmentParams.AUDIT_PATH)) -> pd.DataFrame:
+    """trigger-latency audit of every session of every subject, one process per session (batch_runner.run_jobs):
+       sessions whose largest per-anchor jitter exceeds AlignmentParams.JITTER_MS are flagged and printed
+        output: the per-session table, also written to out_path, the per-anchor latency quantiles next to it
+                (<out_path stem>_anchors.csv)"""
+    data_root = Path(Paths.DATA_ROOT)
+    jobs      = []
+    for subject_dir in sorted(data_root.glob(f"{FileFormat.SUBJECT_FOLDER_PREFIX}*")):
+        subject_id = subject_dir.name[len(FileFormat.SUBJECT_FOLDER_PREFIX):]
+        for session in Paths.SESSIONS:
+            vhdr = find_vhdr(subject_dir / session)
+            if vhdr is not None:
+                jobs.append(Job(key=f"{subject_dir.name}/{session}", function=audit_session,
+                                kwargs=dict(vhdr=vhdr, subject_id=subject_id), n_threads=1))
+    if not jobs:
+        raise FileNotFoundError(f"No recordings found in {data_root}")
+
+    rows     = run_jobs(jobs=jobs, n_workers=min(n_workers or os.cpu_count() or 1, len(jobs)))
+    sessions = pd.DataFrame([{"session": row["key"], **(row["result"]["session"] if row["result"]
+                                                       else {"status": row["status"]})} for row in rows])
+    anchors  = pd.DataFrame([anchor for row in rows if row["result"] for anchor in row["result"]["anchors"]])
+
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    sessions.to_csv(out_path, index=False)
+    anchors.to_csv(out_path.with_name(f"{out_path.stem}_anchors.csv"), index=False)
+    flagged = sessions[sessions["flagged"] == True] if "flagged" in sessions else sessions.iloc[:0]
+    print(f"  [trigger audit] {int((sessions['status'] == 'ok').sum())}/{len(sessions)} sessions audited, "
+          f"{len(flagged)} with jitter above {AlignmentParams.JITTER_MS} ms")
+    for _, row in flagged.iterrows():
+        print(f"  [trigger audit] {row['session']}: jitter {row['jitter_ms']:.1f} ms ({row['jitter_anchor']}), "
+              f"drift {row['drift_ms_per_hour']:.1f} ms/h, {row['unmatched_triggers']} unmatched triggers")
+    return sessions
@@ -0,0 +1,174 @@
+import hashlib
+import json
+import os
+import sys
+from pathlib import Path
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+from src.binding_task.enums.Enums import AssetPackEnums, Paths, TaskManage
+
+# the task's image paths (Paths, AssetPackEnums.GROUPS) are relative to the binding_task folder
+ASSET_ROOT = Path(__file__).parent
+
+
+def build_asset_pack(pack_path: str = Paths.ASSET_PACK, manifest_path: str = Paths.ASSET_MANIFEST) -> dict:
+    """offline packing step: convert all objects, scenes, colors and probes into one memory-mappable file:
+        1. every image of a group (AssetPackEnums.GROUPS, relative to ASSET_ROOT) is converted to RGBA and resized to the fixed size
+           of its group (LANCZOS), one uint8 array of shape (n, height, width, 4) per group
+        2. for the objects, precompute the transparency mask (background flood-filled from the corners)
+           and the outline mask (dark pixels), so coloring an object is a vectorized select
+        3. write the arrays aligned to AssetPackEnums.ALIGNMENT into pack_path
+        4. write the manifest: offset, shape and sha256 of every array, and the index, size, mtime and sha256
+           of every source image (to detect a stale pack)
+        output: the manifest"""
+    arrays = {}
+    manifest = {"version": AssetPackEnums.VERSION, "arrays": {}, "entries": {}}
+    for group, (patterns, size) in AssetPackEnums.GROUPS.items():
+        sources = sorted({path.relative_to(ASSET_ROOT).as_posix() for pattern in patterns
+                          for path in ASSET_ROOT.glob(pattern)})
+        if not sources:
+            raise FileNotFoundError(f"no images for asset group '{group}': nothing matches {patterns} in {ASSET_ROOT}")
+        images = [Image.open(_resolve(source)).convert('RGBA') for source in sources]
+        arrays[group] = np.stack([np.asarray(image.resize(size, Image.LANCZOS)) for image in images])
+        if group == AssetPackEnums.OBJECT_GROUP:
+            arrays[AssetPackEnums.TRANSPARENT_MASK] = np.stack([_transparent_mask(image, size) for image in images])
+            arrays[AssetPackEnums.OUTLINE_MASK] = np.all(arrays[group][..., :3] < AssetPackEnums.OUTLINE_MAX, axis=-1)
+        for index, source in enumerate(sources):
+            stat = os.stat(_resolve(source))
+            manifest["entries"][source] = {"group": group, "index": index, "bytes": stat.st_size,
+                                           "mtime_ns": stat.st_mtime_ns, "sha256": _file_sha256(source)}
+        print(f"  [assets] {group}: {len(sources)} images at {size[0]}x{size[1]}")
+
+    offset = 0
+    with open(_resolve(pack_path), 'wb') as f:
+        for name, array in arrays.items():
+            array = np.ascontiguousarray(array, dtype=np.uint8)
+            offset = -(-offset // AssetPackEnums.ALIGNMENT) * AssetPackEnums.ALIGNMENT
+            f.seek(offset)
+            f.write(array.tobytes())
+            manifest["arrays"][name] = {"offset": offset, "shape": list(array.shape), "dtype": str(array.dtype),
+                                        "sha256": hashlib.sha256(array.tobytes()).hexdigest()}
+            offset += array.nbytes
+
+    with open(_resolve(manifest_path), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    print(f"  [assets] wrote {_resolve(pack_path)} ({offset / 1e6:.1f} MB)")
+    return manifest
+
+
+def _transparent_mask(image: Image.Image, size: tuple) -> np.ndarray:
+    """flood-fill the background from all 4 corners (as stimuli.color_object) at full resolution,
+       output: bool mask of the transparent pixels at the fixed size"""
+    filled = image.copy()
+    width, height = filled.size
+    for corner in [(0, 0), (width - 1, 0), (0, height - 1), (width - 1, height - 1)]:
+        ImageDraw.floodfill(filled, corner, (0, 0, 0, 0), thresh=AssetPackEnums.FLOOD_FILL_THRESHOLD)
+    alpha = filled.getchannel('A').resize(size, Image.LANCZOS)
+    return np.asarray(alpha) < 128
+
+
+def _resolve(path) -> Path:
+    """a task path (relative to ASSET_ROOT) as a path that works from any working directory"""
+    return ASSET_ROOT / path
+
+
+def _file_sha256(path: str) -> str:
+    """sha256 of a file"""
+    with open(_resolve(path), 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def _is_stale(source: str, entry: dict) -> bool:
+    """True if a source image changed since the pack was built: missing, other size, or (when its mtime
+       changed) other content"""
+    path = _resolve(source)
+    if not path.exists():
+        return True
+    stat = os.stat(path)
+    if stat.st_size != entry["bytes"]:
+        return True
+    return stat.st_mtime_ns != entry.get("mtime_ns") and _file_sha256(source) != entry["sha256"]
+
+
+class AssetPack:
+    def __init__(self):
+        """read-only view of the packed asset library:
+            the whole pack is one np.memmap, every group is an array view into it, so loading is a single mmap
+            and images are paged in on first use. opened lazily on first use in every process that uses it
+            (the presentation process and the helper process)."""
+        self.memmap = None
+        self.arrays = {}
+        self.entries = {}
+        self.tried = False
+
+    def load(self, pack_path: str = Paths.ASSET_PACK, manifest_path: str = Paths.ASSET_MANIFEST) -> bool:
+        """open the pack (single mmap) if it was built and matches the source images (by size, and by sha256
+           for the images whose mtime changed), output: True if the pack is used, False to fall back to the image files"""
+        self.tried = True
+        if not TaskManage.USE_ASSET_PACK or not _resolve(manifest_path).exists() or not _resolve(pack_path).exists():
+            return False
+        with open(_resolve(manifest_path)) as f:
+            manifest = json.load(f)
+
+        stale = [source for source, entry in manifest["entries"].items() if _is_stale(source, entry)]
+        if manifest["version"] != AssetPackEnums.VERSION or stale:
+            print(f"  [assets] pack is stale ({len(stale)} changed images), using image files - rebuild it with "
+                  f"python -m src.binding_task.asset_pack")
+            return False
+
+        self.memmap = np.memmap(_resolve(pack_path), dtype=np.uint8, mode='r')
+        self.arrays = {name: np.ndarray(shape=spec["shape"], dtype=spec["dtype"], buffer=self.memmap,
+                                        offset=spec["offset"])
+                       for name, spec in manifest["arrays"].items()}
+        self.entries = manifest["entries"]
+        print(f"  [assets] loaded {len(self.entries)} images from {pack_path}")
+        return True
+
+    def verify(self, manifest_path: str = Paths.ASSET_MANIFEST) -> list:
+        """compare the sha256 of every array and source image with the manifest,
+           output: list of names that do not match (empty if the pack is intact and up to date)"""
+        with open(_resolve(manifest_path)) as f:
+            manifest = json.load(f)
+        mismatched = [name for name, spec in manifest["arrays"].items()
+                      if hashlib.sha256(self.arrays[name].tobytes()).hexdigest() != spec["sha256"]]
+        mismatched += [source for source, entry in manifest["entries"].items()
+                       if _file_sha256(source) != entry["sha256"]]
+        return mismatched
+
+    def contains_any(self) -> bool:
+        """True if the pack is loaded (opens it on first use)"""
+        if not self.tried:
+            self.load()
+        return bool(self.entries)
+
+    def contains(self, path) -> bool:
+        """True if the image file at path is in the loaded pack"""
+        return self.contains_any() and Path(path).as_posix() in self.entries
+
+    def array(self, path, group: str = None) -> np.ndarray:
+        """the (height, width, 4) RGBA array of an image file in the pack (a view into the mmap),
+           group: read the same index from another array of the group (e.g. AssetPackEnums.OUTLINE_MASK)"""
+        entry = self.entries[Path(path).as_posix()]
+        return self.arrays[group or entry["group"]][entry["index"]]
+
+    def image(self, path):
+        """image for a psychopy ImageStim: a PIL image from the pack, or the file path if it is not packed"""
+        if not self.contains(path):
+            return str(path)
+        return Image.fromarray(self.array(path))
+
+
+asset_pack = AssetPack()
+
+
+if __name__ == '__main__':
+    if "--verify" in sys.argv:
+        if not asset_pack.contains_any():
+            print("  [assets] no usable pack to verify")
+        else:
+            mismatched = asset_pack.verify()
+            print(f"  [assets] {'ok' if not mismatched else 'mismatched: ' + ', '.join(mismatched)}")
+    else:
+        build_asset_pack()
@@ -3,18 +3,24 @@ from datetime import datetime
 import numpy as np
 import pandas as pd
 import psychopy
-from PIL import Image, ImageDraw
 from src.binding_task.enums.Enums import (ParallelPortEnums, BindingAndTestEnums, Features, Paths, StringEnums,
-                                          Instruction, TimeAttribute, TaskManage)
+                                          Instruction, TimeAttribute, TaskManage, TimelineEnums)
 import random
 from pathlib import Path
-from psychopy import visual, core, parallel, event
+from functools import partial
+from psychopy import visual, parallel
 import json
-from src.binding_task.utils import show_instruction, send_to_parallel_port, show_fixation, show_nothing, shuffle_trials
+from src.binding_task.utils import send_to_parallel_port, shuffle_trials, fixation_stim, instruction_stim
+from src.binding_task.response_keyboard import ResponseKeyboard
+from src.binding_task.trial_runner import TrialRunner, TrialState
+from src.binding_task.helper_process import InlineHelper, save_backup
+from src.binding_task.stimuli import render_binding_object
+from src.binding_task.session_timeline import timeline
 from collections import defaultdict
 
 class BindingLearning:
-    def __init__(self, win: psychopy.visual.window.Window, parallel_port: parallel.ParallelPort, categories: list, subject_id: str):
+    def __init__(self, win: psychopy.visual.window.Window, parallel_port: parallel.ParallelPort, categories: list, subject_id: str,
+                 response_keyboard: ResponseKeyboard, helper: InlineHelper = None):
         """*** IMPORTANT: the categories input determines what categories will be shown.
                           features are determined by Features.CATEGORY_TO_FEATURES ***
 
@@ -22,183 +28,198 @@ class BindingLearning:
                    win: psychopy window to display stimuli on
                    parallel_port: psychopy parallel port for sending EEG triggers
                    subject_id: subject id
+                   response_keyboard: low-latency keyboard used for the difficulty ratings
+                   helper: runs compositing and temp saves (HelperProcess, or inline when None)
             1. save all inputs as class attributes
             2. init answers dict for storing correct color/scene per trial
             3. create list of all objects divided into blocks
             4. create all binding learning blocks (shuffled feature sequences per category per block)
-            5. init difficulty_ratings dict"""
+            5. init difficulty_ratings dict
+            6. init the trial runner, the dict of pre-rendered binding stimuli {(block_index, trial_index): ImageStim}
+               and the dict of binding objects being rendered by the helper {(block_index, trial_index): job_id}"""
         self.win = win
         self.parallel_port = parallel_port
         self.subject_id = subject_id
+        self.response_keyboard = response_keyboard
+        self.helper = helper or InlineHelper()
         self.answers = {}
         self.objects = self._get_objects()
         self.blocks = self._create_blocks(categories=categories)
         self.difficulty_ratings = {}
+        self.trial_runner = TrialRunner(win=self.win, response_keyboard=self.response_keyboard)
+        self.prepared_stims = {}
+        self.render_jobs = {}
+        self.taken_stims = set()
 
+    @timeline.instrument(kind=TimelineEnums.BLOCK)
     def run_examples(self):
         """run example trials to familiarize the subject with the binding task:
             1. for each example in BINDING_EXAMPLES (object, color, scene):
-                a. create a unified object (colored object on scene background)
-                b. save to temporary file
-                c. display on screen for 3 seconds
-                d. show blank screen for 1-2 second before next example
-                e. ask difficulty question
-                f. show blank screen for 3 second before next example"""
+                a. create a unified object (colored object on scene background) and save it to a temporary file
+                   (on the helper)
+                b. run the example states on the trial runner: binding object for 3 seconds,
+                   blank screen for 1-2 seconds, difficulty question, blank screen for 3 seconds"""
         for (example_object, color, scene) in BindingAndTestEnums.BINDING_EXAMPLES:
-            unified_object = self._create_unified_object(object_image=example_object, color=color, scene_image=scene)
-            unified_object.save(Paths.BINDING_EXAMPLE)
-            unified_object.close()
-
-            img = visual.ImageStim(self.win, image=Paths.BINDING_EXAMPLE, size=1)
-            img.draw()
-            self.win.flip()
-            core.wait(3.0)
-            show_nothing(win=self.win, min_time=1.0, max_time=2.0)
-            show_instruction(win=self.win, instruction=Instruction.DIFFICULT_QUESTION, time=0)
-            rating = event.waitKeys(keyList=BindingAndTestEnums.DIFFICULT_RANGE)[0]
-            show_nothing(win=self.win, min_time=3.0, max_time=3.0)
+            job_id = self.helper.submit(render_binding_object, want_result=True, object_image=example_object, color=color,
+                                        scene_image=scene, save_path=Paths.BINDING_EXAMPLE)
+            img = visual.ImageStim(self.win, image=self.helper.result(job_id), size=1)
+            self.trial_runner.run(self._trial_states(binding_stim=img, trial_times={}, is_example=True))
+        self.trial_runner.flush()
 
+    @timeline.instrument(kind=TimelineEnums.BLOCK)
     def run_block(self, block_index: int):
         """run all trials in a single block of the binding learning phase:
             input: block_index: index of the current block (0 to NUMBER_OF_BLOCKS-1)
             1. send START_BINDING_LEARNING_BLOCK trigger
             2. for each trial in the block:
-                a. show binding learning stimulus (fixation + colored object on scene)
-                b. blank screen for 1-2 seconds
-                c. ask difficulty rating (1-5)
-                d. temp save"""
+                a. write the correct answers of the trial
+                b. run the trial states on the trial runner (fixation, binding object, blank, difficulty rating)
+                c. the binding object of the next trial is pre-rendered and the temp save runs
+                   as background tasks in idle frames
+            3. flush the background tasks still pending at the end of the block"""
 
         send_to_parallel_port(parallel_port=self.parallel_port, pulse_number=ParallelPortEnums.START_BINDING_LEARNING_BLOCK)
 
         trials_per_block = TaskManage.NUMBER_OF_BINDING_TRIALS // TaskManage.NUMBER_OF_BLOCKS
         for trial_index in range(trials_per_block):
             trial_times = dict()
-            self._show_binding_learning(block_index=block_index, trial_index=trial_index, trial_times=trial_times)
-            show_nothing(win=self.win, min_time=1.0, max_time=2.0)
             trial_num = block_index * trials_per_block + trial_index + 1
-            self._ask_difficulty_rating(trial_num=trial_num, trial_times=trial_times)
-            self._temp_save(trial=trial_index)
-
-    def _show_binding_learning(self, block_index: int, trial_index: int, trial_times: dict):
-        """show a single binding learning trial:
-            input: block_index: current block index
-                   trial_index: current trial index within the block
+            self._write_answers(phase_index=block_index, trial_index=trial_index, trial_times=trial_times, trial_num=trial_num)
+            binding_stim = self._get_binding_stim(block_index=block_index, trial_index=trial_index)
+            self.trial_runner.run(self._trial_states(binding_stim=binding_stim, trial_times=trial_times, trial_num=trial_num,
+                                                     trial_index=trial_index, next_trial=(block_index, trial_index + 1)
+                                                     if trial_index + 1 < trials_per_block else None),
+                                  trial_label=f"{type(self).__name__}_{trial_num}")
+        self.trial_runner.flush()
+
+    def _trial_states(self, binding_stim: visual.ImageStim, trial_times: dict, trial_num: int = None,
+                      trial_index: int = None, next_trial: tuple = None, is_example: bool = False) -> list:
+        """build the states of a single binding learning trial:
+            input: binding_stim: the prepared binding object stimulus
                    trial_times: dict to store timing data for this trial
-            1. show fixation cross for 1 second
-            2. blank screen for 1-2 seconds
-            3. show binding object (colored object on scene) for 3 seconds,
-               recording OBJECT_APPEAR and sending SHOW_BINDING_TRIALS trigger
-            4. record FEATURE_DISAPPEAR timestamp and send STOP_BINDING_TRIALS trigger"""
-        show_fixation(win=self.win, min_time=1.0, max_time=1.0)
-        show_nothing(win=self.win, min_time=1.0, max_time=2.0)
-        self._show_binding_object(block_index=block_index, trail_index=trial_index, trial_times=trial_times)
-
-        # after this function end there is a call to show nothing
-        trial_times[TimeAttribute.FEATURE_DISAPPEAR] = datetime.now().strftime(StringEnums.MILI_SEC_FORMAT)[:-3]
-        send_to_parallel_port(parallel_port=self.parallel_port, pulse_number=ParallelPortEnums.STOP_BINDING_TRIALS)
-
-    def _ask_difficulty_rating(self, trial_num: int, trial_times: dict):
-        """ask the subject to rate how hard it was to remember the object (1=easy, 5=hard):
-            1. show difficulty question and record DIFFICULTY_QUESTION_APPEAR timestamp
-            2. send SHOW_DIFFICULTY_QUESTION trigger
-            3. wait for key press (1-5)
-            4. record DIFFICULTY_ANSWER_TIME timestamp and send ANSWER_DIFFICULTY_QUESTION trigger
-            5. save rating to difficulty_ratings keyed by global trial_num"""
-        show_instruction(win=self.win, instruction=Instruction.DIFFICULT_QUESTION, time=0)
-        trial_times[TimeAttribute.DIFFICULTY_QUESTION_APPEAR] = datetime.now().strftime(StringEnums.MILI_SEC_FORMAT)[:-3]
-        send_to_parallel_port(parallel_port=self.parallel_port, pulse_number=ParallelPortEnums.SHOW_DIFFICULTY_QUESTION)
-
-        rating = event.waitKeys(keyList=BindingAndTestEnums.DIFFICULT_RANGE)[0]
+                   trial_num: global trial number (key of difficulty_ratings)
+                   trial_index: current trial index within the block (for the temp save)
+                   next_trial: (block_index, trial_index) to pre-render while the subject rates difficulty, or None
+            1. fixation cross for 1 second and blank screen for 1-2 seconds (not in examples)
+            2. binding object for 3 seconds, recording OBJECT_APPEAR / FEATURE_DISAPPEAR and
+               sending SHOW_BINDING_TRIALS / STOP_BINDING_TRIALS triggers
+            3. blank screen for 1-2 seconds
+            4. difficulty rating (1-5)
+            5. blank screen for 3 seconds (only in examples)"""
+        states = []
+        if not is_example:
+            states += [TrialState(name="fixation", stims=[fixation_stim(win=self.win)], duration=1.0),
+                       TrialState(name="blank_before_object", duration=(1.0, 2.0))]
+        states += [
+            TrialState(name="binding_object", stims=[binding_stim], duration=3.0, frame_stats=trial_times,
+                       on_start=lambda: self._binding_object_appear(trial_times=trial_times, is_example=is_example),
+                       on_end=lambda key, rt_ms: self._binding_object_disappear(trial_times=trial_times, is_example=is_example)),
+            TrialState(name="blank_after_object", duration=(1.0, 2.0)),
+            TrialState(name="difficulty_question", stims=[instruction_stim(win=self.win, instruction=Instruction.DIFFICULT_QUESTION)],
+                       wait_keys=True, key_list=BindingAndTestEnums.DIFFICULT_RANGE,
+                       on_start=lambda: self._difficulty_question_appear(trial_times=trial_times, next_trial=next_trial,
+                                                                         is_example=is_example),
+                       on_end=lambda key, rt_ms: self._on_difficulty_rating(rating=key, rt_ms=rt_ms, trial_num=trial_num,
+                                                                            trial_index=trial_index, trial_times=trial_times,
+                                                                            is_example=is_example)),
+        ]
+        if is_example:
+            states.append(TrialState(name="blank_after_example", duration=3.0))
+        return states
+
+    def _binding_object_appear(self, trial_times: dict, is_example: bool = False):
+        """record OBJECT_APPEAR and send SHOW_BINDING_TRIALS trigger (right before the first flip of the object)"""
+        if not is_example:
+            trial_times[TimeAttribute.OBJECT_APPEAR] = datetime.now().strftime(StringEnums.MILI_SEC_FORMAT)[:-3]
+            send_to_parallel_port(parallel_port=self.parallel_port, pulse_number=ParallelPortEnums.SHOW_BINDING_TRIALS)
+
+    def _binding_object_disappear(self, trial_times: dict, is_example: bool = False):
+        """record FEATURE_DISAPPEAR and send STOP_BINDING_TRIALS trigger (right before the blank screen flip)"""
+        if not is_example:
+            trial_times[TimeAttribute.FEATURE_DISAPPEAR] = datetime.now().strftime(StringEnums.MILI_SEC_FORMAT)[:-3]
+            send_to_parallel_port(parallel_port=self.parallel_port, pulse_number=ParallelPortEnums.STOP_BINDING_TRIALS)
+
+    def _difficulty_question_appear(self, trial_times: dict, next_trial: tuple = None, is_example: bool = False):
+        """record DIFFICULTY_QUESTION_APPEAR, send SHOW_DIFFICULTY_QUESTION trigger and schedule the
+           pre-rendering of the next binding object as a background task, so it starts in the idle part of a
+           frame after the question is on screen (the subject's answer is timestamped by the keyboard,
+           so background work during the question does not affect the RT)"""
+        if not is_example:
+            trial_times[TimeAttribute.DIFFICULTY_QUESTION_APPEAR] = datetime.now().strftime(StringEnums.MILI_SEC_FORMAT)[:-3]
+            send_to_parallel_port(parallel_port=self.parallel_port, pulse_number=ParallelPortEnums.SHOW_DIFFICULTY_QUESTION)
+        if next_trial is not None:
+            self.trial_runner.schedule(partial(self._pre_render_binding_object, block_index=next_trial[0],
+                                               trial_index=next_trial[1]))
+
+    def _on_difficulty_rating(self, rating: str, rt_ms: int, trial_num: int, trial_index: int, trial_times: dict,
+                              is_example: bool = False):
+        """handle the difficulty rating (1=easy, 5=hard):
+            1. record DIFFICULTY_ANSWER_TIME timestamp, DIFFICULTY_ANSWER_RT (from the question flip)
+               and send ANSWER_DIFFICULTY_QUESTION trigger
+            2. save rating to difficulty_ratings keyed by global trial_num
+            3. schedule the temp save as a background task"""
+        if is_example:
+            return
         trial_times[TimeAttribute.DIFFICULTY_ANSWER_TIME] = datetime.now().strftime(StringEnums.MILI_SEC_FORMAT)[:-3]
+        trial_times[TimeAttribute.DIFFICULTY_ANSWER_RT] = rt_ms
         send_to_parallel_port(parallel_port=self.parallel_port, pulse_number=ParallelPortEnums.ANSWER_DIFFICULTY_QUESTION)
 
         self.difficulty_ratings[trial_num] = int(rating)
+        self.trial_runner.schedule(lambda: self._temp_save(trial=trial_index))
+
+    def _get_binding_stim(self, block_index: int, trial_index: int) -> visual.ImageStim:
+        """return the binding object stimulus of a trial, pre-rendered during the previous trial when possible
+           (the first trial of a block is rendered now, a pre-render that is not finished yet is waited for
+           with a blocking helper.result, between trials)"""
+        self.taken_stims.add((block_index, trial_index))
+        if (block_index, trial_index) in self.prepared_stims:
+            return self.prepared_stims.pop((block_index, trial_index))
+        if (block_index, trial_index) not in self.render_jobs:
+            self._render_binding_object(block_index=block_index, trial_index=trial_index)
+        binding_object_path = self.helper.result(self.render_jobs.pop((block_index, trial_index)))
+        return visual.ImageStim(self.win, image=binding_object_path, size=1)
+
+    def _pre_render_binding_object(self, block_index: int, trial_index: int):
+        """background task: render the binding object of a coming trial and load it into prepared_stims
+           (nothing to do if _get_binding_stim already took that trial, e.g. the subject answered
+           before an idle frame ran the task)"""
+        if (block_index, trial_index) in self.taken_stims:
+            return
+        self._render_binding_object(block_index=block_index, trial_index=trial_index)
+        self._prepare_binding_stim(block_index=block_index, trial_index=trial_index)
+
+    def _prepare_binding_stim(self, block_index: int, trial_index: int):
+        """load the rendered binding object of a trial into an ImageStim, kept in prepared_stims.
+           while the helper is still rendering, the task re-schedules itself to the next frame
+           (it stops once _get_binding_stim has taken the render)"""
+        job_id = self.render_jobs.get((block_index, trial_index))
+        if job_id is None:
+            return
+        if not self.helper.is_done(job_id):
+            self.trial_runner.schedule(partial(self._prepare_binding_stim, block_index=block_index, trial_index=trial_index))
+            return
+        binding_object_path = self.helper.result(self.render_jobs.pop((block_index, trial_index)))
+        self.prepared_stims[(block_index, trial_index)] = visual.ImageStim(self.win, image=binding_object_path, size=1)
 
-    def _show_binding_object(self, block_index: int, trail_index: int, trial_times: dict):
-        """display the binding object on screen:
-            input: block_index: current block index
-                   trail_index: current trial index within the block
-                   trial_times: dict to store timing data
-            1. get the binding object image path (creates the unified object)
-            2. create ImageStim and draw on screen
-            3. record object_appear time
-            4. send parallel port signal for SHOW_BINDING_TRIALS
-            5. show window and wait 3 seconds"""
-        binding_object_path = self._get_binding_object(block_index=block_index, trial_index=trail_index, trial_times=trial_times)
-        img = visual.ImageStim(self.win, image=str(binding_object_path), size=1)
-        img.draw()
-
-        trial_times[TimeAttribute.OBJECT_APPEAR] = datetime.now().strftime(StringEnums.MILI_SEC_FORMAT)[:-3]
-        send_to_parallel_port(parallel_port=self.parallel_port, pulse_number=ParallelPortEnums.SHOW_BINDING_TRIALS)
-        self.win.flip()
-        core.wait(3.0)
-
-    def _get_binding_object(self, block_index: int, trial_index: int, trial_times: dict):
-        """create and save the binding object for a trial:
+    @staticmethod
+    def _binding_photo_path(block_index: int, trial_index: int) -> str:
+        """path of the rendered binding object: features/binding_photos/block_{block_index}_trial_{trial_index}.png"""
+        return f"{Paths.BINDING_PHOTOS_FOLDER}{StringEnums.BLOCK}_{block_index}_{StringEnums.TRIAL}_{trial_index}.png"
+
+    def _render_binding_object(self, block_index: int, trial_index: int):
+        """send the creation of the binding object of a trial to the helper:
             input: block_index: current block index
                    trial_index: current trial index
-                   trial_times: dict to store timing data
-            output: path to the saved binding object image
             1. get the object image path for this trial
             2. get the color (RGBA) and scene for this trial from blocks
-            3. create unified object (colored object on scene background)
-            4. save to features/binding_photos/trial_{trial_index}.png
-            5. write answers (correct color and scene) for this trial"""
-        binding_photo_path = f"{Paths.BINDING_PHOTOS_FOLDER}{StringEnums.BLOCK}_{block_index}_{StringEnums.TRIAL}_{trial_index}.png"
+            3. submit render_binding_object (colored object on scene background), saved to
+               features/binding_photos/block_{block_index}_trial_{trial_index}.png, and keep the job id in render_jobs"""
         object_image = self.objects[block_index][trial_index]
         color = Features.COLOR_TO_RGBA[self.blocks[block_index][Features.COLORS][trial_index]]
         scene = Features.SCENE_TO_IMAGE[self.blocks[block_index][Features.SCENES][trial_index]]
-        unified_object = self._create_unified_object(object_image=object_image, color=color, scene_image=scene)
-        unified_object.save(binding_photo_path)
-        unified_object.close()
-
-        trials_per_block = TaskManage.NUMBER_OF_BINDING_TRIALS // TaskManage.NUMBER_OF_BLOCKS
-        trial_num = block_index * trials_per_block + trial_index + 1
-        self._write_answers(phase_index=block_index, trial_index=trial_index, trial_times=trial_times, trial_num=trial_num)
-        return binding_photo_path
-
-    def _create_unified_object(self, object_image, color, scene_image):
-        """create a unified image of a colored object pasted onto a scene background:
-            input: object_image: path to the object PNG
-                   color: RGBA tuple to apply to the object
-                   scene_image: path to the scene background image
-            1. color the object pixels using the given RGBA color
-            2. resize the colored object to 40% of the scene dimensions
-            3. open the scene image and paste the object centered on it
-            output: PIL Image (scene with object — caller is responsible for saving)"""
-        colored_object = self._color_object(object_image, color)
-        scene_image = Image.open(scene_image)
-        colored_object = colored_object.resize((int(scene_image.width * 0.4), int(scene_image.height * 0.4)))
-        x = (scene_image.width - colored_object.width) // 2
-        y = (scene_image.height - colored_object.height) // 2
-
-        scene_image.paste(colored_object, (x, y), colored_object)
-        return scene_image
-
-    @staticmethod
-    def _color_object(input_path, color):
-        """color the object in the color input:
-            flood-fills background transparent from all 4 corners with a threshold to catch
-            near-white pixels, preserves dark outlines (r,g,b < 50), and colors all remaining
-            pixels with the given color at alpha 210"""
-        image = Image.open(input_path).convert('RGBA')
-        width, height = image.size
-
-        for corner in [(0, 0), (width - 1, 0), (0, height - 1), (width - 1, height - 1)]:
-            ImageDraw.floodfill(image, corner, (0, 0, 0, 0), thresh=30)
-
-        pixels = image.load()
-        for i in range(width):
-            for j in range(height):
-                r, g, b, a = pixels[i, j]
-                if a == 0:
-                    continue
-                elif r < 50 and g < 50 and b < 50:
-                    continue
-                else:
-                    pixels[i, j] = (*color, 210)
-
-        return image
+        self.render_jobs[(block_index, trial_index)] = self.helper.submit(
+            render_binding_object, want_result=True, object_image=object_image, color=color, scene_image=scene,
+            save_path=self._binding_photo_path(block_index=block_index, trial_index=trial_index))
 
     def _write_answers(self, phase_index: int, trial_index: int, trial_times: dict, trial_num: int):
         """save the correct answers (color, scene) for a trial to self.answers"""
@@ -252,6 +273,7 @@ class BindingLearning:
 
         return blocks
 
+    @timeline.instrument(kind=TimelineEnums.OVERHEAD)
     def save_subject(self, time):
         """save final subject data (answers, difficulty ratings) to JSON and CSV files"""
         true_answer_folder = f"{Paths.SAVE_DATA_FOLDER}subject_{self.subject_id}/{StringEnums.TRUE_ANSWERS}/"
@@ -267,22 +289,21 @@ class BindingLearning:
         answer_df.to_csv(f'{true_answer_folder}subject_{self.subject_id}_{time}_{StringEnums.TRUE_ANSWERS}.csv')
 
     def _temp_save(self, trial: int):
-        """save temporary backup after each trial for crash recovery"""
+        """save temporary backup after each trial for crash recovery (written by the helper)"""
         temp_save_path = f'{Paths.SAVE_TEMP_FOLDER}subject_{self.subject_id}/'
-        Path(temp_save_path).mkdir(parents=True, exist_ok=True)
         curr_time = datetime.now().strftime(StringEnums.MILI_SEC_FORMAT)[:-3]
 
-        with open(f'{temp_save_path}true_answers_trial_{trial}_{curr_time}.json', 'w') as f:
-            json.dump(self.answers, f)
-
-        with open(f'{temp_save_path}true_answers_trial_{trial}_{curr_time}_difficulty.json', 'w') as f:
-            json.dump(self.difficulty_ratings, f)
-
-        answer_df = self.convert_answer_to_df()
-        answer_df.to_csv(f'{temp_save_path}true_answers_trial_{trial}_{curr_time}.csv')
+        self.helper.submit(save_backup,
+                           json_files={f'{temp_save_path}true_answers_trial_{trial}_{curr_time}.json': self.answers,
+                                       f'{temp_save_path}true_answers_trial_{trial}_{curr_time}_difficulty.json': self.difficulty_ratings},
+                           csv_files={f'{temp_save_path}true_answers_trial_{trial}_{curr_time}.csv': self._answer_rows()})
 
     def convert_answer_to_df(self):
         """convert self.answers dict to pandas DataFrame with one row per trial"""
+        return pd.DataFrame(self._answer_rows())
+
+    def _answer_rows(self) -> list:
+        """flatten self.answers to one row dict per trial"""
         rows = []
         for trial_index, trial_data in self.answers.items():
             trial_times = trial_data.get(StringEnums.TRAIL_TIMES, {})
@@ -297,5 +318,5 @@ class BindingLearning:
                     }
                     row.update(trial_times)
                     rows.append(row)
-        return pd.DataFrame(rows)
+        return rows
 
@@ -1,17 +1,22 @@
-from psychopy import visual, core, event, parallel
+from psychopy import visual, parallel
 import psychopy
 import random
 from src.binding_task.enums.Enums import BreakGameEnums, Instruction, StringEnums, ParallelPortEnums, \
-    BindingAndTestEnums
+    BindingAndTestEnums, TimelineEnums
+from src.binding_task.session_timeline import timeline
 from src.binding_task.utils import show_instruction, send_to_parallel_port
+from src.binding_task.response_keyboard import ResponseKeyboard
+from src.binding_task.trial_runner import TrialRunner, TrialState
 
 
 class BreakGame:
-    def __init__(self, win: psychopy.visual.window.Window, parallel_port: parallel.ParallelPort):
+    def __init__(self, win: psychopy.visual.window.Window, parallel_port: parallel.ParallelPort,
+                 response_keyboard: ResponseKeyboard):
         """initialize the break game where subject counts how many times the rectangle gets brighter:
             1. save game parameters from BreakGameEnums (duration, interval, brightness, change amount)
             2. init brighter_count and compute num_changes (game_duration // change_interval)
-            3. create the rectangle stimulus at base brightness"""
+            3. create the rectangle stimuli (the flash and the base brightness between flashes)
+            4. init the trial runner that presents the flashes frame by frame (with frame statistics)"""
         self.game_duration = BreakGameEnums.GAME_DURATION  # seconds
         self.change_interval = BreakGameEnums.CHANGE_INTERVAL
         self.brightness = BreakGameEnums.BASE_BRIGHTNESS
@@ -19,11 +24,15 @@ class BreakGame:
 
         self.parallel_port = parallel_port
         self.win = win
+        self.response_keyboard = response_keyboard
         self.brighter_count = 0
         self.subject_answer = None
         self.num_changes = self.game_duration // self.change_interval
         self.rect = visual.Rect(self.win, width=0.5, height=0.5, fillColor=[self.brightness] * 3)
+        self.base_rect = visual.Rect(self.win, width=0.5, height=0.5, fillColor=[BreakGameEnums.BASE_BRIGHTNESS] * 3)
+        self.trial_runner = TrialRunner(win=self.win, response_keyboard=self.response_keyboard)
 
+    @timeline.instrument(kind=TimelineEnums.BLOCK, name="break_game")
     def run(self):
         """run the break game:
             1. send START_BREAK_GAME trigger
@@ -35,25 +44,23 @@ class BreakGame:
         send_to_parallel_port(parallel_port=self.parallel_port, pulse_number=ParallelPortEnums.START_BREAK_GAME)
 
         show_instruction(win=self.win, instruction=Instruction.BREAK_GAME_INSTRUCTION)
-        for _ in range(self.num_changes):
-            self._show_rectangle()
+        for change_index in range(self.num_changes):
+            self._show_rectangle(change_index=change_index)
             self._random_next_trial_brightness()
+        self.trial_runner.flush()
         self._get_subject_answer_in_break_game()
 
         show_instruction(win=self.win, instruction=Instruction.BREAK_GAME_FINISH)
         return self.subject_answer, self.brighter_count
 
-    def _show_rectangle(self):
-        """show rectangle at current brightness for 0.5s, then reset to base brightness for the remaining
-           (change_interval - 0.5) seconds before the next trial"""
+    def _show_rectangle(self, change_index: int):
+        """show rectangle at current brightness for 0.5s, then the base brightness rectangle for the remaining
+           (change_interval - 0.5) seconds before the next trial. the flash is a critical presentation:
+           its dropped frame count and max frame interval go to the trial runner's frame log only"""
         self.rect.fillColor = [self.brightness] * 3
-        self.rect.draw()
-        self.win.flip()
-        core.wait(0.5)
-        self.rect.fillColor = [BreakGameEnums.BASE_BRIGHTNESS] * 3
-        self.rect.draw()
-        self.win.flip()
-        core.wait(self.change_interval-0.5)
+        self.trial_runner.run([TrialState(name="flash", stims=[self.rect], duration=0.5, frame_stats={}),
+                               TrialState(name="base", stims=[self.base_rect], duration=self.change_interval - 0.5)],
+                              trial_label=f"{type(self).__name__}_{change_index}")
 
     def _random_next_trial_brightness(self):
         """randomly set next brightness to brighter or darker than base"""
@@ -68,7 +75,10 @@ class BreakGame:
         text = visual.TextStim(self.win, text=Instruction.BREAK_GAME_QUESTION, font=StringEnums.ARIAL_FONT, pos=(0, 0),
                                height=BindingAndTestEnums.TEXT_HEIGHT, languageStyle='rtl', wrapWidth=0.8)
         text.draw()
+        self.response_keyboard.start_on_flip(win=self.win)
         self.win.flip()
-        self.subject_answer = int(event.waitKeys(keyList=BreakGameEnums.ANSWER_KEY_LIST)[0])
+        with timeline.span(name="break_game_answer", kind=TimelineEnums.SUBJECT_WAIT):
+            answer, _ = self.response_keyboard.wait_keys(key_list=BreakGameEnums.ANSWER_KEY_LIST)
+        self.subject_answer = int(answer)
 
 
@@ -4,6 +4,8 @@ class TaskManage:
     NUMBER_OF_TRIALS_PER_FEATURE = 70
     NUMBER_OF_BLOCKS = 5
     NUMBER_OF_BINDING_TRIALS = 45
+    USE_HELPER_PROCESS = True  # compositing and saving in a separate process (False = inline)
+    USE_ASSET_PACK = True  # load images from the packed asset library when it was built (False = image files)
 
 
 class Paths:
@@ -24,6 +26,9 @@ class Paths:
 
     OBJECT_PATH = 'features/objects/{}.png'
 
+    ASSET_PACK = "features/asset_pack.bin"
+    ASSET_MANIFEST = "features/asset_pack.json"
+
 
 class StringEnums:
     Y = 'y'
@@ -286,6 +291,68 @@ class BreakGameEnums:
     TRIAL_CHANGE = 0.2
     ANSWER_KEY_LIST = ['1', '2', '3', '4', '5', '6', '7', '8', '9']
 
+class TrialRunnerEnums:
+    BACKGROUND_FRAME_FRACTION = 0.5  # part of each frame period background tasks may use
+    END = "end"  # returned from TrialState.on_end to finish the trial
+    RAISE_PRIORITY = True  # psychopy core.rush while trials run
+    DISABLE_GC_DURING_TRIALS = True  # gc runs only in flush (block ends and breaks)
+    DROPPED_FRAME_THRESHOLD = 1.5  # a frame interval longer than this many frame periods means dropped frames
+    MAX_DROPPED_FRAMES = 0  # presentations with more dropped frames are flagged for exclusion from EEG analysis
+    FRAME_STATS_FOLDER = "frame_stats"
+
+
+class TimelineEnums:
+    FOLDER = "timeline"
+
+    # span kinds
+    SESSION = "session"
+    STAGE = "stage"
+    BLOCK = "block"
+    TRIAL = "trial"
+    SUBJECT_WAIT = "subject_wait"  # response screens, instructions waiting for a key
+    DISPLAY_WAIT = "display_wait"  # timed screens (the stimulus is scheduled to stay on screen)
+    OVERHEAD = "overhead"  # our own work: compositing, saving, building stimuli
+    CONTAINER_KINDS = [STAGE, BLOCK, TRIAL]
+    WAIT_KINDS = [SUBJECT_WAIT, DISPLAY_WAIT]
+
+    # columns
+    NAME = "name"
+    KIND = "kind"
+    PATH = "path"
+    START = "start_s"
+    END = "end_s"
+    DURATION = "duration_s"
+    NESTED = "nested"  # inside a wait or overhead span, its time is counted by that span
+    EVENT_COLUMNS = [NAME, KIND, PATH, START, END, DURATION, NESTED]
+    WALL = "wall_s"
+    OVERHEAD_SHARE = "overhead_share"
+    NAMED_OVERHEAD = "named_overhead_s"
+
+
+class AssetPackEnums:
+    VERSION = 1
+    ALIGNMENT = 4096  # byte alignment of every array in the pack
+    OBJECT_SCALE = 0.4  # object size relative to the scene in the binding object
+    SCENE_SIZE = (1536, 1024)  # (width, height), all scenes are 3:2
+    OBJECT_SIZE = (int(SCENE_SIZE[0] * OBJECT_SCALE), int(SCENE_SIZE[1] * OBJECT_SCALE))
+    COLOR_SIZE = (375, 330)
+    PROBE_SIZE = (225, 225)
+
+    # object coloring (see stimuli.color_object)
+    FLOOD_FILL_THRESHOLD = 30  # near-white background reached from the corners becomes transparent
+    OUTLINE_MAX = 50  # pixels with r, g, b below this are outline and keep their original color
+    OBJECT_ALPHA = 210  # alpha of the colored object pixels
+
+    # group name: (source glob patterns, (width, height) of every image in the group)
+    GROUPS = {"objects": ([f"{Paths.OBJECTS_PATH}/*.png", "features/object example/*.png"], OBJECT_SIZE),
+              "scenes": (["features/scenes/*.png"], SCENE_SIZE),
+              "colors": (["features/colors/*.png"], COLOR_SIZE),
+              "probes": (["features/probes/*.jpeg"], PROBE_SIZE)}
+    OBJECT_GROUP = "objects"
+    TRANSPARENT_MASK = "objects_transparent"
+    OUTLINE_MASK = "objects_outline"
+
+
 class BindingAndTestEnums:
     TEXT_HEIGHT = 0.07
 
@@ -351,5 +418,13 @@ class TimeAttribute:
     PROBE_DISAPPEAR = "probe_disappear"
     START_RETRIVAL_TIME = "start_retrival_time"
 
+    # response times in ms, measured by ResponseKeyboard from the flip of the response screen
+    ANSWER_RT = "answer_rt_ms"
+    DIFFICULTY_ANSWER_RT = "difficulty_answer_rt_ms"
+    RETRIVAL_RT = "retrival_rt_ms"
+    RETRIVAL_REPORT_RT = "retrival_report_rt_ms"
 
-
+    # frame statistics of the critical presentations (binding object, test object, feature, probe),
+    # keyed as f'{state_name}_{...}' in trial_times
+    DROPPED_FRAMES = "dropped_frames"
+    MAX_FRAME_INTERVAL = "max_frame_interval_ms"
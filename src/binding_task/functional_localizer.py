@@ -4,15 +4,20 @@ from pathlib import Path
 from datetime import datetime
 import pandas as pd
 import psychopy
-from psychopy import visual, core, event, parallel
+from psychopy import visual, parallel
 from src.binding_task.enums.Enums import StringEnums, ParallelPortEnums, Features, Instruction, TimeAttribute, \
-    HebrewEnums, Paths, TaskManage, BindingAndTestEnums
-from src.binding_task.utils import shuffle_trials, show_nothing, show_fixation, show_instruction, send_to_parallel_port
+    HebrewEnums, Paths, TaskManage, BindingAndTestEnums, TimelineEnums
+from src.binding_task.utils import shuffle_trials, show_instruction, send_to_parallel_port, fixation_stim, instruction_stim
+from src.binding_task.response_keyboard import ResponseKeyboard
+from src.binding_task.trial_runner import TrialRunner, TrialState
+from src.binding_task.helper_process import InlineHelper, save_backup
+from src.binding_task.session_timeline import timeline
+from src.binding_task.asset_pack import asset_pack
 
 class FunctionalLocalizer:
 
     def __init__(self, categories: list, win: psychopy.visual.window.Window, parallel_port: parallel.ParallelPort,
-                 subject_id: str) -> None:
+                 subject_id: str, response_keyboard: ResponseKeyboard, helper: InlineHelper = None) -> None:
         """*** IMPORTANT: the categories input determines what categories will be shown.
                           features are determined by Features.CATEGORY_TO_FEATURES ***
 
@@ -20,15 +25,20 @@ class FunctionalLocalizer:
                    win: psychopy window to display stimuli on
                    parallel_port: psychopy parallel port for sending EEG triggers
                    subject_id: id of the subject
+                   response_keyboard: low-latency keyboard used for all subject responses
+                   helper: runs the temp saves (HelperProcess, or inline when None)
             1. save all inputs as class attributes
             2. init correctness_score list for storing attention question results
             3. build category_to_features dict from the given categories
             4. build all_trials by repeating each feature NUMBER_OF_TRIALS_PER_FEATURE times and shuffling
-            5. build feature_to_image_file dict mapping each feature to its image path"""
+            5. build feature_to_image_file dict mapping each feature to its image path
+            6. init the trial runner that ticks every trial once per frame"""
 
         self.win = win
         self.parallel_port = parallel_port
         self.subject_id = subject_id
+        self.response_keyboard = response_keyboard
+        self.helper = helper or InlineHelper()
         self.correctness_score = []
 
         self.category_to_features = {category: Features.CATEGORY_TO_FEATURES[category] for category in categories}
@@ -36,13 +46,16 @@ class FunctionalLocalizer:
         self.all_trials = shuffle_trials(items=self.all_trials, max_consecutive=2)
 
         self.feature_to_image_file = {key: value for category in self.category_to_features.values() for key, value in category.items()}
+        self.trial_runner = TrialRunner(win=self.win, response_keyboard=self.response_keyboard)
 
+    @timeline.instrument(kind=TimelineEnums.BLOCK)
     def run(self):
         """run the functional localizer:
             1. run the examples
             2. send START_FUNCTIONAL_LOCALIZER trigger
             3. run all trials
-            4. show a rest break instruction every 50 trials"""
+            4. show a rest break instruction every 50 trials
+            5. flush background tasks (temp saves) still pending on the trial runner"""
 
         self._run_examples()
         send_to_parallel_port(parallel_port=self.parallel_port,pulse_number=ParallelPortEnums.START_FUNCTIONAL_LOCALIZER)
@@ -50,73 +63,79 @@ class FunctionalLocalizer:
         for trial_index, trial_feature in enumerate(self.all_trials):
             self._run_trial(trial_index=trial_index, trial_feature=trial_feature)
             if (trial_index + 1) % 50 == 0:
+                self.trial_runner.flush()
                 show_instruction(win=self.win, instruction=Instruction.BREAK)
+        self.trial_runner.flush()
 
+    @timeline.instrument(kind=TimelineEnums.BLOCK)
     def _run_examples(self):
         """Run 2 example trials to familiarize the subject with the task."""
         for (feature, word_question, is_true) in Features.FUNCTIONAL_LOCALIZER_EXAMPLES:
-            self._fixation_and_show_feature(trial_feature=feature, trial_times={}, is_example=True)
-            self._show_attention_question(word_question=word_question, trial_times={}, is_example=True)
-            self._get_subject_answer(is_true=is_true, trial_times={}, is_example=True)
-            show_nothing(win=self.win, min_time=1.0, max_time=3.0)
+            self.trial_runner.run(self._trial_states(trial_feature=feature, word_question=word_question, is_true=is_true,
+                                                     trial_times={}, is_example=True))
+        self.trial_runner.flush()
 
         show_instruction(win=self.win, instruction=Instruction.FINISH_EXAMPLES)
 
     def _run_trial(self, trial_index: int, trial_feature: str):
-        """run a single trial:
-            1. show fixation and feature image
-            2. show attention question and get subject answer
-            3. temp save
-            4. blank screen for 1-3 seconds"""
+        """run a single trial on the trial runner:
+            1. randomly decide whether to show a true or false word and pick the word
+            2. run the trial states (fixation, feature image, attention question, mistake, blank screen)
+            3. the temp save is scheduled by the answer and runs in idle frames of the final blank screen"""
         trial_times = {}
-        self._fixation_and_show_feature(trial_feature=trial_feature, trial_times=trial_times)
-        self._attention_question(trial_index=trial_index, trial_feature=trial_feature, trial_times=trial_times)
-        self._temp_save(trial=trial_index)
-        show_nothing(win=self.win, min_time=1.0, max_time=3.0)
-
-    def _fixation_and_show_feature(self, trial_feature: str, trial_times: dict, is_example: bool = False):
-        """show fixation cross then feature image with blank screens between:
-            1. show fixation for 1 second
+        is_true = random.choice([True, False])
+        word_question = self._get_word_question(is_true=is_true, trial_feature=trial_feature)
+        self.trial_runner.run(self._trial_states(trial_feature=trial_feature, word_question=word_question,
+                                                 is_true=is_true, trial_times=trial_times, trial_index=trial_index),
+                              trial_label=f"{type(self).__name__}_{trial_index}")
+
+    def _trial_states(self, trial_feature: str, word_question: str, is_true: bool, trial_times: dict,
+                      trial_index: int = None, is_example: bool = False) -> list:
+        """build the states of a single trial:
+            1. fixation for 1 second
             2. blank screen for 1 to 2 seconds
-            3. show the feature image for 1.5 second
-            4. blank screen for 1 to 2 seconds"""
-        show_fixation(win=self.win, min_time=1.0, max_time=1.0)
-        show_nothing(win=self.win, min_time=1.0, max_time=2.0)
-        self._show_feature(trial_feature=trial_feature, trial_times=trial_times, is_example=is_example)
-        show_nothing(win=self.win, min_time=1.0, max_time=2.0)
-
-    def _show_feature(self, trial_feature: str, trial_times: dict = None, is_example: bool = False):
-        """display the feature image on screen for 1.5 seconds and record timing.
+            3. the feature image for 1.5 second (FEATURE_APPEAR / FEATURE_DISAPPEAR and triggers)
+            4. blank screen for 1 to 2 seconds
+            5. attention question until right / left is pressed
+            6. mistake instruction for 3 seconds (only if the answer was wrong)
+            7. blank screen for 1 to 3 seconds"""
+        return [
+            TrialState(name="fixation", stims=[fixation_stim(win=self.win)], duration=1.0),
+            TrialState(name="blank_before_feature", duration=(1.0, 2.0)),
+            TrialState(name="feature", stims=[self._feature_stim(trial_feature=trial_feature)], duration=1.5,
+                       frame_stats=trial_times,
+                       on_start=lambda: self._feature_appear(trial_feature=trial_feature, trial_times=trial_times, is_example=is_example),
+                       on_end=lambda key, rt_ms: self._feature_disappear(trial_feature=trial_feature, trial_times=trial_times, is_example=is_example)),
+            TrialState(name="blank_after_feature", duration=(1.0, 2.0)),
+            TrialState(name="question", stims=self._attention_question_stims(word_question=word_question), wait_keys=True,
+                       key_list=StringEnums.KEY_OPTIONS_FUNCTIONAL_LOCALIZER,
+                       on_start=lambda: self._attention_question_appear(trial_times=trial_times, is_example=is_example),
+                       on_end=lambda key, rt_ms: self._on_subject_answer(user_answer=key, rt_ms=rt_ms, is_true=is_true,
+                                                                         trial_feature=trial_feature, word_question=word_question,
+                                                                         trial_index=trial_index, trial_times=trial_times,
+                                                                         is_example=is_example)),
+            TrialState(name="mistake", stims=[instruction_stim(win=self.win, instruction=Instruction.MISTAKE)], duration=3.0),
+            TrialState(name="blank", duration=(1.0, 3.0)),
+        ]
+
+    def _feature_stim(self, trial_feature: str) -> visual.ImageStim:
+        """create the feature image stimulus.
             color features are displayed at size 0.33, all other features at size 1."""
         size = 0.33 if trial_feature in Features.COLOR_TO_IMAGE else 1
-        img = visual.ImageStim(self.win, image=str(self.feature_to_image_file[trial_feature]), size=size)
-        img.draw()
+        return visual.ImageStim(self.win, image=asset_pack.image(self.feature_to_image_file[trial_feature]), size=size)
 
+    def _feature_appear(self, trial_feature: str, trial_times: dict, is_example: bool = False):
+        """record FEATURE_APPEAR timestamp and send the feature show trigger (right before the first flip)"""
         if not is_example:
             trial_times[TimeAttribute.FEATURE_APPEAR] = datetime.now().strftime(StringEnums.MILI_SEC_FORMAT)[:-3]
             send_to_parallel_port(parallel_port=self.parallel_port, pulse_number=ParallelPortEnums.FEATURE_SHOW_TO_PULSE_CODE[trial_feature])
 
-        self.win.flip()
-        core.wait(1.5)
-
-        # after this function finished, there is a call to show nothing
+    def _feature_disappear(self, trial_feature: str, trial_times: dict, is_example: bool = False):
+        """record FEATURE_DISAPPEAR timestamp and send the feature stop trigger (right before the blank screen flip)"""
         if not is_example:
             trial_times[TimeAttribute.FEATURE_DISAPPEAR] = datetime.now().strftime(StringEnums.MILI_SEC_FORMAT)[:-3]
             send_to_parallel_port(parallel_port=self.parallel_port, pulse_number=ParallelPortEnums.FEATURE_STOP_TO_PULSE_CODE[trial_feature])
 
-    def _attention_question(self, trial_index: int, trial_feature: str, trial_times: dict):
-        """run the attention question for a single trial:
-            1. randomly decide whether to show a true or false word
-            2. pick the word based on the decision
-            3. display the attention question screen
-            4. get subject answer and save the result to correctness_score"""
-        is_true = random.choice([True, False])
-        word_question = self._get_word_question(is_true=is_true, trial_feature=trial_feature)
-        self._show_attention_question(word_question=word_question, trial_times=trial_times)
-        is_right, user_answer = self._get_subject_answer(is_true=is_true, trial_times=trial_times)
-        self._update_subject_score(trial_feature=trial_feature, is_right=is_right, word_question=word_question,
-                                   user_answer=user_answer, trial_index=trial_index, trial_times=trial_times)
-
     def _get_word_question(self, is_true: bool, trial_feature: str) -> str:
         """if is_true: return the word of the photo
             else: return word of another feature from the same category"""
@@ -130,44 +149,42 @@ class FunctionalLocalizer:
 
         return word_question
 
-    def _show_attention_question(self, word_question: str, trial_times: dict, is_example: bool = False)-> None:
-        """display the attention question screen:
+    def _attention_question_stims(self, word_question: str) -> list:
+        """create the attention question screen:
             - center: the word to judge (translated to Hebrew)
             - bottom-right: correct option (נכון)
-            - bottom-left: incorrect option (לא נכון)
-            records QUESTION_APPEAR timestamp and sends SHOW_ATTENTION_QUESTION trigger"""
+            - bottom-left: incorrect option (לא נכון)"""
         stims = [visual.TextStim(self.win, text=HebrewEnums.TRANSLATE.get(word_question), font=StringEnums.ARIAL_FONT, languageStyle='rtl')]
         for option in BindingAndTestEnums.ATTENTION_QUESTION_OPTIONS.values():
             stims.append(visual.TextStim(self.win, text=option[StringEnums.TEXT], pos=option[StringEnums.LOCATION],
                                          font=StringEnums.ARIAL_FONT, languageStyle='rtl'))
-        for stim in stims:
-            stim.draw()
+        return stims
 
+    def _attention_question_appear(self, trial_times: dict, is_example: bool = False) -> None:
+        """record QUESTION_APPEAR timestamp and send SHOW_ATTENTION_QUESTION trigger"""
         if not is_example:
             trial_times[TimeAttribute.QUESTION_APPEAR] = datetime.now().strftime(StringEnums.MILI_SEC_FORMAT)[:-3]
             send_to_parallel_port(parallel_port=self.parallel_port, pulse_number=ParallelPortEnums.SHOW_ATTENTION_QUESTION)
-        self.win.flip()
 
-    def _get_subject_answer(self, is_true: bool, trial_times: dict, is_example: bool = False)-> tuple:
-        """wait for subject to press right (correct) or left (incorrect) and evaluate the answer:
+    def _on_subject_answer(self, user_answer: str, rt_ms: int, is_true: bool, trial_feature: str, word_question: str,
+                           trial_index: int, trial_times: dict, is_example: bool = False):
+        """evaluate the right (correct) / left (incorrect) answer to the attention question:
             - right key = subject says the word matches the image
             - left key  = subject says the word does not match the image
-            records ANSWER_TIME timestamp and sends ANSWER_ATTENTION_QUESTION trigger
-            if wrong: shows a mistake instruction for 3 seconds
-            output: (is_right: bool, user_answer: str)"""
+            records ANSWER_TIME timestamp, ANSWER_RT (from the question flip) and sends ANSWER_ATTENTION_QUESTION trigger,
+            saves the result to correctness_score and schedules the temp save as a background task
+            output: name of the next state - the mistake screen if wrong, otherwise the final blank screen"""
+        is_right = (is_true and user_answer == StringEnums.RIGHT) or (not is_true and user_answer == StringEnums.LEFT)
 
-        user_answer = event.waitKeys(keyList=StringEnums.KEY_OPTIONS_FUNCTIONAL_LOCALIZER)[0]
         if not is_example:
             trial_times[TimeAttribute.ANSWER_TIME] = datetime.now().strftime(StringEnums.MILI_SEC_FORMAT)[:-3]
+            trial_times[TimeAttribute.ANSWER_RT] = rt_ms
             send_to_parallel_port(parallel_port=self.parallel_port, pulse_number=ParallelPortEnums.ANSWER_ATTENTION_QUESTION)
+            self._update_subject_score(trial_feature=trial_feature, is_right=is_right, word_question=word_question,
+                                       user_answer=user_answer, trial_index=trial_index, trial_times=trial_times)
+            self.trial_runner.schedule(lambda: self._temp_save(trial=trial_index))
 
-        if (is_true and user_answer == StringEnums.RIGHT) or (not is_true and user_answer == StringEnums.LEFT):
-            is_right = True
-        else:
-            is_right = False
-            show_instruction(win=self.win, instruction=Instruction.MISTAKE, time= 3.0)
-
-        return is_right, user_answer
+        return "blank" if is_right else None
 
     def _update_subject_score(self, trial_feature: str, is_right: bool, word_question: str, user_answer: str, trial_index: int, trial_times: dict):
         """append trial data to correctness_score list"""
@@ -177,17 +194,15 @@ class FunctionalLocalizer:
         self.correctness_score.append(trial_data)
 
     def _temp_save(self, trial: int):
-        """save temporary backup after each trial for crash recovery"""
+        """save temporary backup after each trial for crash recovery (written by the helper)"""
         temp_save_path = f'{Paths.SAVE_TEMP_FOLDER}subject_{self.subject_id}/'
-        Path(temp_save_path).mkdir(parents=True, exist_ok=True)
         curr_time = datetime.now().strftime(StringEnums.MILI_SEC_FORMAT)[:-3]
 
-        with open(f'{temp_save_path}functional_localizer_trial_{trial}_{curr_time}.json', 'w') as f:
-            json.dump(self.correctness_score, f)
-
-        answer_df = self.convert_answer_to_df()
-        answer_df.to_csv(f'{temp_save_path}functional_localizer_trial_{trial}_{curr_time}.csv')
+        self.helper.submit(save_backup,
+                           json_files={f'{temp_save_path}functional_localizer_trial_{trial}_{curr_time}.json': self.correctness_score},
+                           csv_files={f'{temp_save_path}functional_localizer_trial_{trial}_{curr_time}.csv': self._answer_rows()})
 
+    @timeline.instrument(kind=TimelineEnums.OVERHEAD)
     def save_results(self, time):
         """save final results to JSON and CSV files"""
         functional_localizer_folder = f"{Paths.SAVE_DATA_FOLDER}subject_{self.subject_id}/functional_localizer/"
@@ -201,6 +216,10 @@ class FunctionalLocalizer:
 
     def convert_answer_to_df(self):
         """convert correctness_score list to pandas DataFrame with one row per trial"""
+        return pd.DataFrame(self._answer_rows())
+
+    def _answer_rows(self) -> list:
+        """flatten correctness_score to one row dict per trial"""
         rows = []
         for trial_data in self.correctness_score:
             trial_times = trial_data.get(StringEnums.TRAIL_TIMES, {})
@@ -214,5 +233,5 @@ class FunctionalLocalizer:
             }
             row.update(trial_times)
             rows.append(row)
-        return pd.DataFrame(rows)
+        return rows
 
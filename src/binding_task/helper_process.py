@@ -0,0 +1,122 @@
+import itertools
+import json
+import multiprocessing
+import queue
+from pathlib import Path
+from typing import Callable
+
+import pandas as pd
+
+from src.binding_task.enums.Enums import TimelineEnums
+from src.binding_task.session_timeline import timeline
+
+
+def save_backup(json_files: dict, csv_files: dict):
+    """write a crash-recovery backup:
+        input: json_files: {path: data} written with json.dump
+               csv_files: {path: rows} converted to a pandas DataFrame and written as CSV"""
+    for path, data in json_files.items():
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump(data, f)
+
+    for path, rows in csv_files.items():
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        pd.DataFrame(rows).to_csv(path)
+
+
+def _helper_loop(jobs: multiprocessing.Queue, finished: multiprocessing.Queue):
+    """main loop of the helper process: run (job_id, function, kwargs, want_result) jobs until a None job arrives,
+       and send back (job_id, result) for jobs that want their result (the exception if the job failed)"""
+    for job_id, function, kwargs, want_result in iter(jobs.get, None):
+        try:
+            result = function(**kwargs)
+        except Exception as e:
+            print(f"  [helper] {function.__name__} failed: {e}")
+            result = e
+        if want_result:
+            finished.put((job_id, result))
+
+
+class InlineHelper:
+    def __init__(self):
+        """run compositing and persistence jobs in the presentation process itself.
+           same interface as HelperProcess, used when the helper process option is off"""
+        self.job_ids = itertools.count()
+        self.results = {}
+
+    def start(self):
+        """nothing to start for inline jobs"""
+
+    def stop(self):
+        """nothing to stop for inline jobs"""
+
+    def submit(self, function: Callable, want_result: bool = False, **kwargs) -> int:
+        """run function(**kwargs), output: job id (its result is kept for result() if want_result)"""
+        job_id = next(self.job_ids)
+        with timeline.span(name=function.__name__, kind=TimelineEnums.OVERHEAD):
+            result = function(**kwargs)
+        if want_result:
+            self.results[job_id] = result
+        return job_id
+
+    def is_done(self, job_id: int) -> bool:
+        """True if the result of the job is ready"""
+        return job_id in self.results
+
+    def result(self, job_id: int):
+        """return (and forget) the result of a job submitted with want_result"""
+        return self._unwrap(self.results.pop(job_id))
+
+    @staticmethod
+    def _unwrap(result):
+        """re-raise a failure of the job in the caller"""
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+
+class HelperProcess(InlineHelper):
+    def __init__(self):
+        """helper process for compositing and persistence:
+            the presentation process only draws, flips and reads the keyboard, and sends everything else
+            (binding object compositing, pandas conversion, JSON / CSV writing) over a queue to this process,
+            so a slow write or a GC pause of that work can never delay a flip.
+            jobs are top level functions (pickled by reference) with picklable keyword arguments."""
+        super().__init__()
+        self.jobs = multiprocessing.Queue()
+        self.finished = multiprocessing.Queue()
+        self.process = multiprocessing.Process(target=_helper_loop, args=(self.jobs, self.finished), daemon=True)
+
+    def start(self):
+        """start the helper process"""
+        self.process.start()
+
+    def stop(self):
+        """finish all submitted jobs and stop the helper process"""
+        self.jobs.put(None)
+        self.process.join()
+
+    def submit(self, function: Callable, want_result: bool = False, **kwargs) -> int:
+        """send a job to the helper process, output: job id"""
+        job_id = next(self.job_ids)
+        self.jobs.put((job_id, function, kwargs, want_result))
+        return job_id
+
+    def is_done(self, job_id: int) -> bool:
+        """collect finished results without blocking, True if the result of the job is ready"""
+        try:
+            while True:
+                finished_id, result = self.finished.get_nowait()
+                self.results[finished_id] = result
+        except queue.Empty:
+            pass
+        return job_id in self.results
+
+    def result(self, job_id: int):
+        """wait for the result of a job submitted with want_result"""
+        with timeline.span(name="wait_for_helper", kind=TimelineEnums.OVERHEAD):
+            while job_id not in self.results:
+                finished_id, result = self.finished.get()
+                self.results[finished_id] = result
+        return self._unwrap(self.results.pop(job_id))
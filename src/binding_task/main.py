@@ -1,5 +1,6 @@
 from psychopy import visual, event, parallel, gui
-from src.binding_task.enums.Enums import Features, Instruction, StringEnums, TaskManage
+from src.binding_task.enums.Enums import Features, Instruction, StringEnums, TaskManage, TimeAttribute, Paths, \
+    TimelineEnums, TrialRunnerEnums
 from src.binding_task.binding_learning import BindingLearning
 from src.binding_task.functional_localizer import FunctionalLocalizer
 from src.binding_task.partial_retrival_test import PartialRetrivalTest
@@ -7,6 +8,11 @@ from src.binding_task.test_phase import TestPhase
 from src.binding_task.break_game import BreakGame
 from datetime import datetime
 from src.binding_task.utils import show_instruction
+from src.binding_task.response_keyboard import ResponseKeyboard
+from src.binding_task.helper_process import HelperProcess, InlineHelper
+from src.binding_task.session_timeline import timeline
+from src.binding_task.trial_runner import frame_log
+from src.binding_task.asset_pack import asset_pack
 from pathlib import Path
 import pandas as pd
 
@@ -22,12 +28,18 @@ def get_subject_info() -> str:
 
 
 class BindingTask:
-    def __init__(self, subject_id: str):
-        """initialize the experiment with a subject ID, psychopy window, parallel port, and timestamp"""
+    def __init__(self, subject_id: str, use_helper_process: bool = TaskManage.USE_HELPER_PROCESS):
+        """initialize the experiment with a subject ID, psychopy window, parallel port, response keyboard and timestamp.
+           if use_helper_process: this process only presents stimuli (at raised priority while trials run) and
+           a HelperProcess does the compositing and saving, otherwise those run inline.
+           the packed asset library (if built) is opened here, with a single mmap"""
         self.subject_id = subject_id
         self.win = visual.Window(fullscr=True)
         self.parallel_port = parallel.ParallelPort(address=0x5EFC)
+        self.response_keyboard = ResponseKeyboard()
+        self.helper = HelperProcess() if use_helper_process else InlineHelper()
         self.time = datetime.now().strftime(StringEnums.MINUTE_FORMAT)
+        asset_pack.load()
 
     def main(self):
         """run the experiment:
@@ -37,14 +49,26 @@ class BindingTask:
             4. second stage - binding learning + test phase (5 blocks)
             5. save unified combined CSV
             6. third stage - partial retrieval test
-            7. goodbye instruction"""
-        self._general_setting()
-        show_instruction(win=self.win, instruction=Instruction.WELLCOME)
-        self._first_stage()
-        binding, test = self._second_stage()
-        self._save_unified_file_for_all_data(binding=binding, test=test)
-        self._third_stage()
-        show_instruction(win=self.win, instruction=Instruction.GOODBYE, time=10)
+            7. goodbye instruction
+           the helper is started first and stopped (after finishing all its saves) at the end,
+           the session timeline and the frame statistics of the critical presentations are recorded throughout
+           and saved at the end (also if the session crashed)"""
+        timeline.start()
+        self.helper.start()
+        try:
+            self._general_setting()
+            show_instruction(win=self.win, instruction=Instruction.WELLCOME)
+            self._first_stage()
+            binding, test = self._second_stage()
+            self._save_unified_file_for_all_data(binding=binding, test=test)
+            self._third_stage()
+            show_instruction(win=self.win, instruction=Instruction.GOODBYE, time=10)
+        finally:
+            self.helper.stop()
+            timeline.save(folder=f"{Paths.SAVE_DATA_FOLDER}subject_{self.subject_id}/{TimelineEnums.FOLDER}",
+                          file_prefix=f"subject_{self.subject_id}_{self.time}")
+            frame_log.save(folder=f"{Paths.SAVE_DATA_FOLDER}subject_{self.subject_id}/{TrialRunnerEnums.FRAME_STATS_FOLDER}",
+                           file_prefix=f"subject_{self.subject_id}_{self.time}")
 
     @staticmethod
     def _general_setting():
@@ -52,6 +76,7 @@ class BindingTask:
             1. disappear the mouse"""
         event.Mouse(visible=False)
 
+    @timeline.instrument(kind=TimelineEnums.STAGE)
     def _first_stage(self):
         """the first part of the experiment:
             1. show the instruction to the first part
@@ -59,10 +84,12 @@ class BindingTask:
 
         show_instruction(win=self.win, instruction=Instruction.FIRST_PHASE_INSTRUCTION)
         functional_localizer = FunctionalLocalizer(categories=Features.ALL_CATEGORIES, win=self.win,
-                                                   parallel_port=self.parallel_port, subject_id=self.subject_id)
+                                                   parallel_port=self.parallel_port, subject_id=self.subject_id,
+                                                   response_keyboard=self.response_keyboard, helper=self.helper)
         functional_localizer.run()
         functional_localizer.save_results(time=self.time)
 
+    @timeline.instrument(kind=TimelineEnums.STAGE)
     def _second_stage(self):
         """the second part of the experiment:
         1. show the instruction to the second part
@@ -73,9 +100,10 @@ class BindingTask:
 
         show_instruction(win=self.win, instruction=Instruction.SECOND_PHASE_INSTRUCTION)
         binding = BindingLearning(win=self.win, parallel_port=self.parallel_port, categories=Features.ALL_CATEGORIES,
-                                  subject_id=self.subject_id)
+                                  subject_id=self.subject_id, response_keyboard=self.response_keyboard, helper=self.helper)
         test = TestPhase(win=self.win, parallel_port=self.parallel_port, categories=Features.ALL_CATEGORIES,
-                         objects=binding.objects, subject_id=self.subject_id)
+                         objects=binding.objects, subject_id=self.subject_id, response_keyboard=self.response_keyboard,
+                         helper=self.helper)
 
         binding.run_examples()
         test.run_examples()
@@ -90,6 +118,7 @@ class BindingTask:
 
         return binding, test
 
+    @timeline.instrument(kind=TimelineEnums.STAGE)
     def _third_stage(self):
         """the third part of the experiment:
             1. show instruction
@@ -99,12 +128,14 @@ class BindingTask:
             5. save results"""
         show_instruction(win=self.win, instruction = Instruction.THIRD_STAGE_INSTRUCTION)
         partial_retrival = PartialRetrivalTest(win=self.win, parallel_port=self.parallel_port,
-                                               categories=Features.ALL_CATEGORIES, subject_id=self.subject_id)
+                                               categories=Features.ALL_CATEGORIES, subject_id=self.subject_id,
+                                               response_keyboard=self.response_keyboard, helper=self.helper)
         partial_retrival.run_examples()
         show_instruction(win=self.win, instruction=Instruction.FINISH_EXAMPLES)
         partial_retrival.run()
         partial_retrival.save_subject_answer(time=self.time)
 
+    @timeline.instrument(kind=TimelineEnums.BLOCK)
     def _block_learning_and_test(self, binding: BindingLearning, test: TestPhase, block: int):
         """run one block of the second stage:
              1. show instruction to the block
@@ -114,10 +145,11 @@ class BindingTask:
 
         show_instruction(win=self.win, instruction=(Instruction.START_X_BLOCK + str(block + 1) + "/" + str(TaskManage.NUMBER_OF_BLOCKS)))
         binding.run_block(block_index=block)
-        break_game = BreakGame(win=self.win, parallel_port=self.parallel_port)
+        break_game = BreakGame(win=self.win, parallel_port=self.parallel_port, response_keyboard=self.response_keyboard)
         break_game.run()
         test.run_block(block_index=block)
 
+    @timeline.instrument(kind=TimelineEnums.OVERHEAD)
     def _save_unified_file_for_all_data(self, binding: BindingLearning, test: TestPhase):
         """Save a single combined CSV with one row per binding trial, merging binding and test data.
            Input:  binding - BindingLearning object holding binding.answers and binding.difficulty_ratings
@@ -218,7 +250,7 @@ class BindingTask:
                    test_times   - timing dict from the test trial (used for RT and order)
            Steps:
                1. Compare test_answers vs features for Colors and Scenes to get color_correct / scene_correct
-               2. Calculate RT in ms for each category via _calc_response_time
+               2. Get the keyboard RT in ms for each category via _calc_response_time
                3. Determine which question was presented first via _get_question_order
            Output: dict with keys: test_trial, subject_color, subject_scene,
                                    color_correct, scene_correct, both_correct,
@@ -246,17 +278,9 @@ class BindingTask:
 
     @staticmethod
     def _calc_response_time(test_times, category):
-        """calculate response time in ms for a category"""
-        start = test_times.get(f'{category}_question_appear')
-        end = test_times.get(f'{category}_answer_time')
-        if not start or not end:
-            return None
-        try:
-            fmt = StringEnums.MILI_SEC_FORMAT[:-3]
-            delta = datetime.strptime(end, fmt) - datetime.strptime(start, fmt)
-            return int(delta.total_seconds() * 1000)
-        except ValueError:
-            return None
+        """return the response time in ms for a category, as timestamped by ResponseKeyboard
+           relative to the flip of the question screen (None if the question was not asked)"""
+        return test_times.get(f'{category}_{TimeAttribute.ANSWER_RT}')
 
     @staticmethod
     def _get_question_order(test_times):
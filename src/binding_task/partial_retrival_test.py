@@ -1,20 +1,26 @@
 from datetime import datetime
 from pathlib import Path
+from functools import partial
 import json
 import pandas as pd
 import psychopy
-from psychopy import parallel, visual, core, event
+from psychopy import parallel, visual
 import random
 
 from src.binding_task.enums.Enums import Features, Paths, StringEnums, BindingAndTestEnums, \
-    ParallelPortEnums, TimeAttribute
+    ParallelPortEnums, TimeAttribute, TrialRunnerEnums, TimelineEnums
 from src.binding_task.test_phase import TestPhase
-from src.binding_task.utils import show_nothing, send_to_parallel_port
+from src.binding_task.utils import send_to_parallel_port
+from src.binding_task.response_keyboard import ResponseKeyboard
+from src.binding_task.trial_runner import TrialState
+from src.binding_task.helper_process import InlineHelper
+from src.binding_task.session_timeline import timeline
+from src.binding_task.asset_pack import asset_pack
 
 
 class PartialRetrivalTest(TestPhase):
     def __init__(self, win: psychopy.visual.window.Window, parallel_port: parallel.ParallelPort, categories: list,
-                 subject_id: str):
+                 subject_id: str, response_keyboard: ResponseKeyboard, helper: InlineHelper = None):
         """*** IMPORTANT: loads only objects that were correctly retrieved in both color and scene
                           during the test phase (from combined_data CSV). ***
 
@@ -22,101 +28,129 @@ class PartialRetrivalTest(TestPhase):
                    parallel_port: psychopy parallel port for sending EEG triggers
                    categories: list of feature categories (e.g., Colors, Scenes)
                    subject_id: subject identifier
+                   response_keyboard: low-latency keyboard used for all subject responses
+                   helper: runs the temp saves (HelperProcess, or inline when None)
             1. load correct objects from the most recent combined_data CSV
             2. call super().__init__ with the correct objects as a single block"""
         correct_objects = self._load_correct_objects(subject_id)
         super().__init__(win=win, parallel_port=parallel_port, categories=categories,
-                         objects=[correct_objects], subject_id=subject_id)
+                         objects=[correct_objects], subject_id=subject_id, response_keyboard=response_keyboard,
+                         helper=helper)
 
+    @timeline.instrument(kind=TimelineEnums.BLOCK)
     def run(self):
         """run all partial retrieval trials:
             1. send START_PARTIAL_RETRIVAL trigger
-            2. for each trial: run test, write answers, temp save"""
+            2. for each trial: run test, write answers, schedule temp save as a background task
+            3. flush the background tasks still pending at the end"""
         send_to_parallel_port(parallel_port=self.parallel_port, pulse_number=ParallelPortEnums.START_PARTIAL_RETRIVAL)
         for trial_index, object_path in enumerate(self.blocks[0]):
             trial_times = {}
             subject_answer = self.run_test(image_path=object_path, trial_times=trial_times)
             self._write_subject_answers(object_path=object_path, subject_answer=subject_answer, trial_times=trial_times)
-            self._temp_save(trial=trial_index)
+            self.trial_runner.schedule(partial(self._temp_save, trial=trial_index))
+        self.trial_runner.flush()
 
     def run_test(self, image_path: Path, trial_times: dict, is_example: bool = False):
-        """run a single partial retrieval trial:
+        """run a single partial retrieval trial on the trial runner:
             input: image_path: path to the object image
                    trial_times: dict to store timing data
                    is_example: if True, skip EEG triggers
             output: dict of subject answers including probe category, retrieval success, and feature answer
             1. randomly select a probe category (color or scene)
             2. show probe image for 1 second
-            3. show object image for 2 seconds
-            4. show retrieval prompt (subject presses key when they remember, or times out after 3s)
-            5. blank screen for 0.5 seconds
-            6. if no click: automatically move to next trial
-            7. if clicked: treat as remembered and ask subject to choose the feature for the probe category"""
+            3. blank screen for 0.3 seconds
+            4. show object image for 2 seconds
+            5. show retrieval prompt (subject presses key when they remember, or times out after 3s)
+            6. blank screen for 0.5 seconds
+            7. if no click: automatically move to next trial
+            8. if clicked: treat as remembered and ask subject to choose the feature for the probe category"""
         retrival_category = random.choice(self.categories)
         trial_answers = {StringEnums.PROBE: retrival_category}
 
-        self._show_probe(retrival_category=retrival_category, trial_times=trial_times, is_example=is_example)
-        show_nothing(win=self.win, min_time=0.3, max_time=0.3)
-        self._show_object(image_path=image_path, trial_times=trial_times, is_example=is_example)
-        self._subject_retrival(trial_times=trial_times, trial_answers=trial_answers, is_example=is_example)
-        show_nothing(win=self.win, min_time=0.5, max_time=0.5)
+        states = [
+            self._probe_state(retrival_category=retrival_category, trial_times=trial_times, is_example=is_example),
+            TrialState(name="blank_after_probe", duration=0.3),
+            self._object_state(image_path=image_path, trial_times=trial_times, is_example=is_example),
+            self._retrival_state(trial_times=trial_times, trial_answers=trial_answers, is_example=is_example),
+            TrialState(name="blank_after_retrival", duration=0.5,
+                       on_end=lambda key, rt_ms: self._after_retrival(trial_answers=trial_answers)),
+        ]
+        states += self._question_states(category=retrival_category, trial_times=trial_times, trial_answers=trial_answers,
+                                        on_done=lambda: TrialRunnerEnums.END, is_example=is_example)
+
+        self.trial_runner.run(states, trial_label=None if is_example else f"{type(self).__name__}_{image_path.stem}")
+        return trial_answers
 
+    @staticmethod
+    def _after_retrival(trial_answers: dict):
+        """end the trial if the subject did not press, otherwise mark IS_REMEMBER and continue to the probe question"""
         if not trial_answers.get(StringEnums.RETRIVAL_SUCCESS):
-            return trial_answers
-
+            return TrialRunnerEnums.END
         trial_answers[StringEnums.IS_REMEMBER] = True
-        trial_answers[retrival_category] = self._show_question(category=retrival_category,
-                                                               trial_times=trial_times, is_example=is_example)
-        return trial_answers
+        return None
 
-    def _show_probe(self, retrival_category: str, trial_times: dict, is_example: bool = False):
-        """display the probe image (color or scene cue) for 1 second:
+    def _probe_state(self, retrival_category: str, trial_times: dict, is_example: bool = False) -> TrialState:
+        """the probe image (color or scene cue) for 1 second:
             input: retrival_category: the category to probe (Colors or Scenes)
                    trial_times: dict to store timing data
                    is_example: if True, skip EEG triggers
             records PROBE_APPEAR and PROBE_DISAPPEAR timestamps and sends SHOW_PROBE / STOP_PROBE triggers"""
         retrival_probe = Features.PROBE_TO_PATH[retrival_category]
-        img = visual.ImageStim(self.win, image=retrival_probe, size=(0.4, 0.4), pos=(0, 0))
-        img.draw()
+        img = visual.ImageStim(self.win, image=asset_pack.image(retrival_probe), size=(0.4, 0.4), pos=(0, 0))
+        return TrialState(name="probe", stims=[img], duration=1.0, frame_stats=trial_times,
+                          on_start=lambda: self._probe_appear(trial_times=trial_times, is_example=is_example),
+                          on_end=lambda key, rt_ms: self._probe_disappear(trial_times=trial_times, is_example=is_example))
 
+    def _probe_appear(self, trial_times: dict, is_example: bool = False):
+        """record PROBE_APPEAR timestamp and send SHOW_PROBE trigger"""
         if not is_example:
             trial_times[TimeAttribute.PROBE_APPEAR] = datetime.now().strftime(StringEnums.MILI_SEC_FORMAT)[:-3]
             send_to_parallel_port(parallel_port=self.parallel_port, pulse_number=ParallelPortEnums.SHOW_PROBE)
 
-        self.win.flip()
-        core.wait(1.0)
-
+    def _probe_disappear(self, trial_times: dict, is_example: bool = False):
+        """record PROBE_DISAPPEAR timestamp and send STOP_PROBE trigger"""
         if not is_example:
             trial_times[TimeAttribute.PROBE_DISAPPEAR] = datetime.now().strftime(StringEnums.MILI_SEC_FORMAT)[:-3]
             send_to_parallel_port(parallel_port=self.parallel_port, pulse_number=ParallelPortEnums.STOP_PROBE)
 
-    def _subject_report_retrival_success(self, trial_times: dict, trial_answers: dict, is_example: bool = False) -> bool:
-        """show remember / don't remember options (left/right arrow keys):
-            records RETRIVAL_QUESTION_APPEAR and RETRIVAL_REPORT_TIME timestamps,
+    def _subject_report_retrival_success(self, trial_times: dict, trial_answers: dict,
+                                         is_example: bool = False) -> TrialState:
+        """remember / don't remember options (left/right arrow keys):
+            records RETRIVAL_QUESTION_APPEAR and RETRIVAL_REPORT_TIME timestamps and RETRIVAL_REPORT_RT,
             sends SHOW_PARTIAL_RETRIVAL_REMEMBER_QUESTION and ANSWER_PARTIAL_RETRIVAL_REMEMBER_QUESTION triggers.
-            saves IS_REMEMBER to trial_answers.
-            output: True if subject pressed remember, False otherwise"""
-        for key, option in BindingAndTestEnums.RETRIVAL_OPTION_BONUS.items():
-            visual.TextStim(self.win, text=option[StringEnums.TEXT], pos=option[StringEnums.LOCATION],
-                            height=BindingAndTestEnums.TEXT_HEIGHT, languageStyle='rtl', font=StringEnums.ARIAL_FONT).draw()
-
+            saves IS_REMEMBER to trial_answers and ends the trial if the subject does not remember.
+            output: the remember question TrialState"""
+        stims = [visual.TextStim(self.win, text=option[StringEnums.TEXT], pos=option[StringEnums.LOCATION],
+                                 height=BindingAndTestEnums.TEXT_HEIGHT, languageStyle='rtl', font=StringEnums.ARIAL_FONT)
+                 for option in BindingAndTestEnums.RETRIVAL_OPTION_BONUS.values()]
+        return TrialState(name="remember_question", stims=stims, wait_keys=True,
+                          key_list=list(BindingAndTestEnums.RETRIVAL_OPTION_BONUS.keys()),
+                          on_start=lambda: self._remember_question_appear(trial_times=trial_times, is_example=is_example),
+                          on_end=lambda key, rt_ms: self._on_remember_answer(remember_choose=key, rt_ms=rt_ms,
+                                                                             trial_times=trial_times, trial_answers=trial_answers,
+                                                                             is_example=is_example))
+
+    def _remember_question_appear(self, trial_times: dict, is_example: bool = False):
+        """record RETRIVAL_QUESTION_APPEAR timestamp and send SHOW_PARTIAL_RETRIVAL_REMEMBER_QUESTION trigger"""
         if not is_example:
             trial_times[TimeAttribute.RETRIVAL_QUESTION_APPEAR] = datetime.now().strftime(StringEnums.MILI_SEC_FORMAT)[:-3]
             send_to_parallel_port(parallel_port=self.parallel_port,
                                   pulse_number=ParallelPortEnums.SHOW_PARTIAL_RETRIVAL_REMEMBER_QUESTION)
 
-        self.win.flip()
-        remember_choose = event.waitKeys(keyList=list(BindingAndTestEnums.RETRIVAL_OPTION_BONUS.keys()))[0]
-
+    def _on_remember_answer(self, remember_choose: str, rt_ms: int, trial_times: dict, trial_answers: dict,
+                            is_example: bool = False):
+        """save IS_REMEMBER, record RETRIVAL_REPORT_TIME / RETRIVAL_REPORT_RT and send
+           ANSWER_PARTIAL_RETRIVAL_REMEMBER_QUESTION trigger, output: END if the subject does not remember"""
         if not is_example:
             trial_times[TimeAttribute.RETRIVAL_REPORT_TIME] = datetime.now().strftime(StringEnums.MILI_SEC_FORMAT)[:-3]
+            trial_times[TimeAttribute.RETRIVAL_REPORT_RT] = rt_ms
             send_to_parallel_port(parallel_port=self.parallel_port,
                                   pulse_number=ParallelPortEnums.ANSWER_PARTIAL_RETRIVAL_REMEMBER_QUESTION)
 
-        self.win.flip()
         is_remember = BindingAndTestEnums.RETRIVAL_OPTION_BONUS[remember_choose][StringEnums.IS_REMEMBER]
         trial_answers[StringEnums.IS_REMEMBER] = is_remember
-        return is_remember
+        return None if is_remember else TrialRunnerEnums.END
 
     def _write_subject_answers(self, object_path: Path, subject_answer: dict, trial_times: dict):
         """save subject's answers for a trial to self.subject_answers:
@@ -134,8 +168,8 @@ class PartialRetrivalTest(TestPhase):
             StringEnums.TRAIL_TIMES: trial_times,
         }
 
-    def convert_answer_to_df(self):
-        """convert self.subject_answers dict to pandas DataFrame with one row per trial"""
+    def _answer_rows(self) -> list:
+        """flatten self.subject_answers to one row dict per trial (probe, is_remember, answer)"""
         rows = []
         for trial_index, trial_data in self.subject_answers.items():
             trial_times = trial_data.get(StringEnums.TRAIL_TIMES, {})
@@ -154,8 +188,9 @@ class PartialRetrivalTest(TestPhase):
                     }
                     row.update(trial_times)
                     rows.append(row)
-        return pd.DataFrame(rows)
+        return rows
 
+    @timeline.instrument(kind=TimelineEnums.OVERHEAD)
     def save_subject_answer(self, time):
         """save final subject answers to JSON and CSV files in subject_answer/final_data/subject_<id>/partial_retrival/"""
         save_folder = f"{Paths.SAVE_DATA_FOLDER}subject_{self.subject_id}/partial_retrival/"
@@ -0,0 +1,45 @@
+import psychopy
+from psychopy.hardware import keyboard
+
+
+class ResponseKeyboard:
+    def __init__(self):
+        """low-latency input layer for all subject responses:
+            uses psychopy.hardware.keyboard (psychtoolbox backend when available) instead of event.waitKeys,
+            so key presses are timestamped by the device and not when python happens to poll them.
+            the response clock is reset by the window at the flip of the response screen, so every RT
+            is measured on the same clock as the flip times."""
+        self.keyboard = keyboard.Keyboard()
+
+    def start_on_flip(self, win: psychopy.visual.window.Window):
+        """arm the keyboard for the next screen:
+            input: win: psychopy window whose next flip is the onset of the response screen
+            1. clear keys pressed before the screen appeared (at the flip itself)
+            2. reset the response clock exactly at the flip"""
+        win.callOnFlip(self.keyboard.clearEvents)
+        win.callOnFlip(self.keyboard.clock.reset)
+
+    def wait_keys(self, key_list: list = None, max_wait: float = float('inf')) -> tuple:
+        """wait for a key press, returning on key down (not release):
+            input: key_list: allowed keys (None = any key)
+                   max_wait: timeout in seconds
+            output: (key_name, rt_ms) where rt_ms is relative to the flip armed by start_on_flip,
+                    or (None, None) on timeout"""
+        keys = self.keyboard.waitKeys(maxWait=max_wait, keyList=key_list, waitRelease=False, clear=True)
+        if not keys:
+            return None, None
+        return keys[0].name, self.rt_to_ms(keys[0].rt)
+
+    def get_keys(self, key_list: list = None) -> tuple:
+        """non-blocking check for a key press, for callers that poll once per frame:
+            input: key_list: allowed keys (None = any key)
+            output: (key_name, rt_ms) of the first press since the armed flip, or (None, None)"""
+        keys = self.keyboard.getKeys(keyList=key_list, waitRelease=False, clear=True)
+        if not keys:
+            return None, None
+        return keys[0].name, self.rt_to_ms(keys[0].rt)
+
+    @staticmethod
+    def rt_to_ms(rt: float) -> int:
+        """convert a keyboard rt in seconds to integer milliseconds"""
+        return int(round(rt * 1000))
@@ -1,45 +1,55 @@
 from pathlib import Path
+from functools import partial
 import json
 
 import pandas as pd
 import psychopy
 from psychopy import parallel
 
-from src.binding_task.enums.Enums import Features, Paths, StringEnums
+from src.binding_task.enums.Enums import Features, Paths, StringEnums, TimelineEnums
 from src.binding_task.test_phase import TestPhase
 from src.binding_task.utils import shuffle_trials
+from src.binding_task.response_keyboard import ResponseKeyboard
+from src.binding_task.helper_process import InlineHelper
+from src.binding_task.session_timeline import timeline
 
 
 class SecondDayTask(TestPhase):
     def __init__(self, win: psychopy.visual.window.Window, parallel_port: parallel.ParallelPort,
-                 categories: list, subject_id: str):
+                 categories: list, subject_id: str, response_keyboard: ResponseKeyboard, helper: InlineHelper = None):
         """*** IMPORTANT: loads objects from the most recent partial_retrival CSV saved on day 1. ***
 
             input: win: psychopy window to display stimuli on
                    parallel_port: psychopy parallel port (unused, no triggers sent)
                    categories: list of feature categories (e.g., Colors, Scenes)
                    subject_id: subject identifier
+                   response_keyboard: low-latency keyboard used for all subject responses
+                   helper: runs the temp saves (HelperProcess, or inline when None)
             1. load objects from the most recent partial_retrival CSV (shuffled, max 1 consecutive)
             2. call super().__init__ with the objects as a single block"""
         objects_by_block = self._load_partial_retrival_objects(subject_id)
         super().__init__(win=win, parallel_port=parallel_port, categories=categories,
-                         objects=objects_by_block, subject_id=subject_id)
+                         objects=objects_by_block, subject_id=subject_id, response_keyboard=response_keyboard,
+                         helper=helper)
 
     def run_example(self):
         """run 2 example trials using the fork and robot example objects"""
         self.run_test(image_path=Path(Paths.OBJECT_EXAMPLE_FORK), trial_times={}, is_example=True)
         self.run_test(image_path=Path(Paths.OBJECT_EXAMPLE_ROBOT), trial_times={}, is_example=True)
 
+    @timeline.instrument(kind=TimelineEnums.BLOCK)
     def run(self):
         """run all second day test trials:
-            for each trial: run test, write answers, temp save"""
+            for each trial: run test, write answers, schedule temp save as a background task of the trial runner"""
         for trial_index, object_path in enumerate(self.blocks[0]):
             trial_times = {}
             subject_answer = self.run_test(image_path=object_path, trial_times=trial_times)
             self._write_subject_answers(object_path=object_path, subject_answer=subject_answer,
                                         trial_times=trial_times)
-            self._temp_save(trial=trial_index)
+            self.trial_runner.schedule(partial(self._temp_save, trial=trial_index))
+        self.trial_runner.flush()
 
+    @timeline.instrument(kind=TimelineEnums.OVERHEAD)
     def save_subject_answer(self, time):
         """save final subject answers to JSON and CSV files in subject_answer/final_data/subject_<id>/second_day/"""
         save_folder = f"{Paths.SAVE_DATA_FOLDER}subject_{self.subject_id}/second_day/"
@@ -0,0 +1,130 @@
+import csv
+import json
+import time
+from contextlib import contextmanager
+from functools import wraps
+from pathlib import Path
+
+from src.binding_task.enums.Enums import TimelineEnums
+
+
+class SessionTimeline:
+    def __init__(self):
+        """session timeline profiler: records nested spans of the session (stages, blocks, trials) and the time
+           inside them spent waiting on the subject, in scheduled display waits, and in our own overhead.
+           disabled (every span is a no-op) until start() is called."""
+        self.enabled = False
+        self.start_time = None
+        self.stack = []
+        self.events = []
+
+    def start(self):
+        """enable recording, times are in seconds from this call"""
+        self.enabled = True
+        self.start_time = time.perf_counter()
+        self.stack = []
+        self.events = []
+
+    @contextmanager
+    def span(self, name: str, kind: str):
+        """record the wall time of the with-block:
+            input: name: name of the span (e.g. stage / state / function name)
+                   kind: one of TimelineEnums.CONTAINER_KINDS, SUBJECT_WAIT, DISPLAY_WAIT or OVERHEAD"""
+        if not self.enabled:
+            yield
+            return
+        nested = self.is_nested()
+        self.stack.append((name, kind))
+        path = "/".join(parent_name for parent_name, _ in self.stack)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stack.pop()
+            self.add(name=name, kind=kind, path=path, start=start, end=time.perf_counter(), nested=nested)
+
+    def add(self, name: str, kind: str, path: str, start: float, end: float, nested: bool = False):
+        """record a span measured by the caller (start / end are time.perf_counter values),
+           nested: the span is inside a wait or overhead span, so its time is already counted by that span"""
+        self.events.append({TimelineEnums.NAME: name, TimelineEnums.KIND: kind, TimelineEnums.PATH: path,
+                            TimelineEnums.START: start - self.start_time, TimelineEnums.END: end - self.start_time,
+                            TimelineEnums.DURATION: end - start, TimelineEnums.NESTED: nested})
+
+    def is_nested(self) -> bool:
+        """True if a wait or overhead span is open (e.g. a background task hidden inside the wait of a state)"""
+        return any(kind in TimelineEnums.WAIT_KINDS + [TimelineEnums.OVERHEAD] for _, kind in self.stack)
+
+    def instrument(self, kind: str, name: str = None):
+        """decorator: record every call of the function as a span of this kind (named after the function)"""
+        def decorator(function):
+            @wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.span(name=name or function.__name__, kind=kind):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def summary(self) -> list:
+        """one row per container span (stage / block / trial) and one for the whole session:
+            wall time, subject wait, display wait, overhead (= wall - waits) and its share, and the named
+            overhead spans that were not hidden inside a wait (or counted by an enclosing overhead span)"""
+        containers = [event for event in self.events if event[TimelineEnums.KIND] in TimelineEnums.CONTAINER_KINDS]
+        session_end = max([event[TimelineEnums.END] for event in self.events], default=0.0)
+        containers.append({TimelineEnums.NAME: TimelineEnums.SESSION, TimelineEnums.KIND: TimelineEnums.SESSION,
+                           TimelineEnums.PATH: "", TimelineEnums.START: 0.0, TimelineEnums.END: session_end,
+                           TimelineEnums.DURATION: session_end})
+        return [self._summarize(container) for container in containers]
+
+    def _summarize(self, container: dict) -> dict:
+        """sum the waits and the overhead spans inside a container span, skipping nested spans"""
+        prefix = container[TimelineEnums.PATH]
+        inside = [event for event in self.events if event is not container and
+                  (not prefix or event[TimelineEnums.PATH].startswith(prefix + "/")) and
+                  container[TimelineEnums.START] <= event[TimelineEnums.START] <= container[TimelineEnums.END]]
+        waits = {kind: sum(event[TimelineEnums.DURATION] for event in inside
+                           if event[TimelineEnums.KIND] == kind and not event[TimelineEnums.NESTED])
+                 for kind in TimelineEnums.WAIT_KINDS}
+        wall = container[TimelineEnums.DURATION]
+        overhead = wall - sum(waits.values())
+
+        named_overhead = {}
+        for event in inside:
+            if event[TimelineEnums.KIND] == TimelineEnums.OVERHEAD and not event[TimelineEnums.NESTED]:
+                named_overhead[event[TimelineEnums.NAME]] = named_overhead.get(event[TimelineEnums.NAME], 0.0) + event[TimelineEnums.DURATION]
+
+        return {TimelineEnums.PATH: container[TimelineEnums.PATH] or TimelineEnums.SESSION,
+                TimelineEnums.KIND: container[TimelineEnums.KIND],
+                TimelineEnums.START: container[TimelineEnums.START],
+                TimelineEnums.WALL: wall,
+                TimelineEnums.SUBJECT_WAIT: waits[TimelineEnums.SUBJECT_WAIT],
+                TimelineEnums.DISPLAY_WAIT: waits[TimelineEnums.DISPLAY_WAIT],
+                TimelineEnums.OVERHEAD: overhead,
+                TimelineEnums.OVERHEAD_SHARE: overhead / wall if wall else 0.0,
+                TimelineEnums.NAMED_OVERHEAD: named_overhead}
+
+    def save(self, folder: str, file_prefix: str):
+        """write the timeline of the session:
+            1. <file_prefix>_timeline.csv: one row per recorded span
+            2. <file_prefix>_timeline_summary.json: the summary rows
+            3. print the session summary line"""
+        if not self.enabled:
+            return
+        Path(folder).mkdir(parents=True, exist_ok=True)
+
+        with open(Path(folder) / f"{file_prefix}_timeline.csv", 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=TimelineEnums.EVENT_COLUMNS)
+            writer.writeheader()
+            writer.writerows(self.events)
+
+        summary = self.summary()
+        with open(Path(folder) / f"{file_prefix}_timeline_summary.json", 'w') as f:
+            json.dump(summary, f, indent=2)
+
+        session = summary[-1]
+        print(f"  [timeline] session {session[TimelineEnums.WALL] / 60:.1f} min: "
+              f"subject {session[TimelineEnums.SUBJECT_WAIT] / 60:.1f} min, "
+              f"display {session[TimelineEnums.DISPLAY_WAIT] / 60:.1f} min, "
+              f"overhead {session[TimelineEnums.OVERHEAD] / 60:.1f} min ({session[TimelineEnums.OVERHEAD_SHARE]:.0%})")
+
+
+timeline = SessionTimeline()
@@ -0,0 +1,81 @@
+import numpy as np
+from PIL import Image, ImageDraw
+
+from src.binding_task.asset_pack import asset_pack
+from src.binding_task.enums.Enums import AssetPackEnums
+
+
+def create_unified_object(object_image, color, scene_image):
+    """create a unified image of a colored object pasted onto a scene background:
+        input: object_image: path to the object PNG
+               color: RGBA tuple to apply to the object
+               scene_image: path to the scene background image
+        1. color the object pixels using the given RGBA color
+        2. resize the colored object to 40% of the scene dimensions
+        3. open the scene image and paste the object centered on it
+        output: PIL Image (scene with object — caller is responsible for saving)"""
+    colored_object = color_object(object_image, color)
+    scene_image = Image.open(scene_image)
+    colored_object = colored_object.resize((int(scene_image.width * 0.4), int(scene_image.height * 0.4)))
+    x = (scene_image.width - colored_object.width) // 2
+    y = (scene_image.height - colored_object.height) // 2
+
+    scene_image.paste(colored_object, (x, y), colored_object)
+    return scene_image
+
+
+def color_object(input_path, color):
+    """color the object in the color input:
+        flood-fills background transparent from all 4 corners with a threshold to catch
+        near-white pixels, preserves dark outlines (r,g,b < 50), and colors all remaining
+        pixels with the given color at alpha 210"""
+    image = Image.open(input_path).convert('RGBA')
+    width, height = image.size
+
+    for corner in [(0, 0), (width - 1, 0), (0, height - 1), (width - 1, height - 1)]:
+        ImageDraw.floodfill(image, corner, (0, 0, 0, 0), thresh=30)
+
+    pixels = image.load()
+    for i in range(width):
+        for j in range(height):
+            r, g, b, a = pixels[i, j]
+            if a == 0:
+                continue
+            elif r < 50 and g < 50 and b < 50:
+                continue
+            else:
+                pixels[i, j] = (*color, 210)
+
+    return image
+
+
+def compose_from_pack(object_image, color, scene_image) -> Image.Image:
+    """same image as create_unified_object, from the pre-normalized arrays of the asset pack:
+        the object is already resized to OBJECT_SIZE with its transparency and outline masks precomputed,
+        so coloring and pasting it centered on the scene is a vectorized alpha blend
+        output: PIL Image (RGB)"""
+    rgba = asset_pack.array(object_image)
+    transparent = asset_pack.array(object_image, group=AssetPackEnums.TRANSPARENT_MASK)
+    outline = asset_pack.array(object_image, group=AssetPackEnums.OUTLINE_MASK)
+    alpha = np.where(transparent, 0, np.where(outline, rgba[..., 3], AssetPackEnums.OBJECT_ALPHA))[..., None] / 255
+    colored = np.where(outline[..., None], rgba[..., :3], np.asarray(color[:3], dtype=np.uint8))
+
+    scene = np.array(asset_pack.array(scene_image)[..., :3])
+    height, width = alpha.shape[:2]
+    y = (scene.shape[0] - height) // 2
+    x = (scene.shape[1] - width) // 2
+    region = scene[y:y + height, x:x + width]
+    scene[y:y + height, x:x + width] = np.rint(colored * alpha + region * (1 - alpha)).astype(np.uint8)
+    return Image.fromarray(scene)
+
+
+def render_binding_object(object_image, color, scene_image, save_path: str) -> str:
+    """create the unified object (from the asset pack when both images are packed) and save it:
+        output: save_path (so the caller can load the rendered image)"""
+    if asset_pack.contains(object_image) and asset_pack.contains(scene_image):
+        unified_object = compose_from_pack(object_image=object_image, color=color, scene_image=scene_image)
+    else:
+        unified_object = create_unified_object(object_image=object_image, color=color, scene_image=scene_image)
+    unified_object.save(save_path)
+    unified_object.close()
+    return save_path
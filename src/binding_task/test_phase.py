@@ -1,39 +1,55 @@
 import json
+from functools import partial
+from typing import Callable
 import pandas as pd
 import psychopy
-from psychopy import visual, event, parallel, core
+from psychopy import visual, parallel
 import random
 from pathlib import Path
 from datetime import datetime
 from src.binding_task.enums.Enums import Features, BindingAndTestEnums, ParallelPortEnums, Paths, StringEnums, \
-    HebrewEnums, TimeAttribute
-from src.binding_task.utils import show_nothing, send_to_parallel_port, shuffle_trials
+    HebrewEnums, TimeAttribute, TrialRunnerEnums, TimelineEnums
+from src.binding_task.utils import send_to_parallel_port, shuffle_trials
+from src.binding_task.response_keyboard import ResponseKeyboard
+from src.binding_task.trial_runner import TrialRunner, TrialState
+from src.binding_task.helper_process import InlineHelper, save_backup
+from src.binding_task.session_timeline import timeline
+from src.binding_task.asset_pack import asset_pack
 
 class TestPhase:
     def __init__(self, win: psychopy.visual.window.Window, parallel_port: parallel.ParallelPort, categories: list,
-                 objects: list, subject_id: str) -> None:
+                 objects: list, subject_id: str, response_keyboard: ResponseKeyboard, helper: InlineHelper = None) -> None:
         """input: win: psychopy window to display stimuli
                   parallel_port: parallel port for sending EEG/fMRI triggers
                   categories: list of feature categories to test (e.g., Colors, Scenes)
                   objects: list of object paths from BindingLearning (divided by blocks)
                   subject_id: subject identifier
+                  response_keyboard: low-latency keyboard used for all subject responses
+                  helper: runs the temp saves (HelperProcess, or inline when None)
             1. save all inputs as class attributes
             2. shuffle objects within each block (max 1 consecutive same object)
-            3. init empty dict for subject_answers"""
+            3. init empty dict for subject_answers
+            4. init the trial runner that ticks every trial once per frame"""
         self.win = win
         self.parallel_port = parallel_port
         self.categories = categories
         self.subject_id = subject_id
+        self.response_keyboard = response_keyboard
+        self.helper = helper or InlineHelper()
         self.blocks = {}
         for block_index, block_objects in enumerate(objects):
             self.blocks[block_index] = shuffle_trials(items=block_objects, max_consecutive=1)
         self.subject_answers = {}
+        self.trial_runner = TrialRunner(win=self.win, response_keyboard=self.response_keyboard)
 
+    @timeline.instrument(kind=TimelineEnums.BLOCK)
     def run_examples(self):
         """run examples for test phase"""
         self.run_test(image_path=Path(Paths.OBJECT_EXAMPLE_FORK), trial_times={}, is_example=True)
         self.run_test(image_path=Path(Paths.OBJECT_EXAMPLE_ROBOT), trial_times={}, is_example=True)
+        self.trial_runner.flush()
 
+    @timeline.instrument(kind=TimelineEnums.BLOCK)
     def run_block(self, block_index: int):
         """run all test trials in a single block:
             input: block_index: index of the current block
@@ -41,17 +57,19 @@ class TestPhase:
             2. for each trial in the block:
                 a. run the test (show object, ask questions)
                 b. write subject answers to self.subject_answers
-                c. save temporary backup"""
+                c. schedule the temporary backup as a background task of the trial runner
+            3. flush the background tasks still pending at the end of the block"""
         send_to_parallel_port(parallel_port=self.parallel_port, pulse_number=ParallelPortEnums.START_TESH_PHASE_BLOCK)
 
         for trial_index in range(len(self.blocks[block_index])):
             trial_times = {}
             subject_answer = self.run_test(image_path=self.blocks[block_index][trial_index], trial_times=trial_times)
             self._write_subject_answers(object_path=self.blocks[block_index][trial_index], subject_answer=subject_answer, trial_times=trial_times)
-            self._temp_save(trial=trial_index)
+            self.trial_runner.schedule(partial(self._temp_save, trial=trial_index))
+        self.trial_runner.flush()
 
     def run_test(self, image_path: Path, trial_times: dict, is_example: bool = False):
-        """run a single test trial:
+        """run a single test trial on the trial runner:
             input: image_path: path to the object image
                    trial_times: dict to store timing data
                    is_example: if True, skip EEG triggers
@@ -64,128 +82,152 @@ class TestPhase:
             6. blank screen for 0.5 seconds
             7. for each reported category (randomized order), ask subject to choose the feature"""
         trial_answers = {}
+        question_order = []
+        states = [
+            self._object_state(image_path=image_path, trial_times=trial_times, is_example=is_example),
+            self._retrival_state(trial_times=trial_times, trial_answers=trial_answers, is_example=is_example),
+            TrialState(name="blank_after_retrival", duration=0.5,
+                       on_end=lambda key, rt_ms: None if trial_answers.get(StringEnums.RETRIVAL_SUCCESS) else TrialRunnerEnums.END),
+            TrialState(name="retrival_report", stims=self._retrival_report_stims(), wait_keys=True,
+                       key_list=list(BindingAndTestEnums.RETRIVAL_OPTION.keys()),
+                       on_start=lambda: self._retrival_report_appear(trial_times=trial_times, is_example=is_example),
+                       on_end=lambda key, rt_ms: self._on_retrival_report(remember_choose=key, rt_ms=rt_ms, trial_times=trial_times,
+                                                                          trial_answers=trial_answers, question_order=question_order,
+                                                                          is_example=is_example)),
+            TrialState(name="blank_after_report", duration=0.5,
+                       on_end=lambda key, rt_ms: self._next_question(question_order=question_order)),
+        ]
+        for category in self.categories:
+            states += self._question_states(category=category, trial_times=trial_times, trial_answers=trial_answers,
+                                            on_done=partial(self._next_question, question_order=question_order, after=category),
+                                            is_example=is_example)
 
-        self._show_object(image_path=image_path, trial_times=trial_times, is_example=is_example)
-        self._subject_retrival(trial_times=trial_times, trial_answers=trial_answers, is_example=is_example)
-        show_nothing(win=self.win, min_time=0.5, max_time=0.5)
-
-        if not trial_answers.get(StringEnums.RETRIVAL_SUCCESS):
-            return trial_answers
-
-        retrival_report_list = self._subject_report_retrival_success(trial_times=trial_times,
-                                                                     trial_answers=trial_answers, is_example=is_example)
-        show_nothing(win=self.win, min_time=0.5, max_time=0.5)
-
-        if retrival_report_list is not None and len(retrival_report_list) > 0:
-            random.shuffle(retrival_report_list)
-
-        for question in retrival_report_list:
-            trial_answers[question] = self._show_question(category=question, trial_times=trial_times, is_example=is_example)
-
+        self.trial_runner.run(states, trial_label=None if is_example else f"{type(self).__name__}_{image_path.stem}")
         return trial_answers
 
-    def _show_object(self, image_path: Path, trial_times: dict, is_example: bool = False):
-        """display the object image on screen for 2 seconds, record OBJECT_APPEAR timestamp, and send SHOW_OBJECT_IN_TEST_TRIAL trigger"""
-        img = visual.ImageStim(self.win, image=image_path, size=(0.4, 0.4), pos=(0, 0))
-        img.draw()
+    def _object_state(self, image_path: Path, trial_times: dict, is_example: bool = False) -> TrialState:
+        """the object image for 2 seconds, recording OBJECT_APPEAR timestamp and sending SHOW_OBJECT_IN_TEST_TRIAL trigger"""
+        img = visual.ImageStim(self.win, image=asset_pack.image(image_path), size=(0.4, 0.4), pos=(0, 0))
+        return TrialState(name="object", stims=[img], duration=2.0, frame_stats=trial_times,
+                          on_start=lambda: self._object_appear(trial_times=trial_times, is_example=is_example))
 
+    def _object_appear(self, trial_times: dict, is_example: bool = False):
+        """record OBJECT_APPEAR timestamp and send SHOW_OBJECT_IN_TEST_TRIAL trigger"""
         if not is_example:
             trial_times[TimeAttribute.OBJECT_APPEAR] = datetime.now().strftime(StringEnums.MILI_SEC_FORMAT)[:-3]
             send_to_parallel_port(parallel_port=self.parallel_port, pulse_number=ParallelPortEnums.SHOW_OBJECT_IN_TEST_TRIAL)
-        self.win.flip()
-        core.wait(2.0)
 
-    def _subject_retrival(self, trial_times: dict, trial_answers: dict, is_example: bool = False):
-        """show blank screen for up to 3 seconds; stops early if subject presses any arrow key.
-           saves RETRIVAL_TIME to trial_times.
-           returns True if subject pressed a key, False if timed out."""
+    def _retrival_state(self, trial_times: dict, trial_answers: dict, is_example: bool = False) -> TrialState:
+        """show '+' for up to 3 seconds; stops early if subject presses any key.
+           saves RETRIVAL_TIME and RETRIVAL_RT (from the flip of the retrieval screen) to trial_times
+           and RETRIVAL_SUCCESS (True if subject pressed a key, False if timed out) to trial_answers."""
         text = visual.TextStim(self.win, text="+", font=StringEnums.ARIAL_FONT, pos=(0, 0),
                                height=BindingAndTestEnums.TEXT_HEIGHT, languageStyle='rtl', wrapWidth=1.8)
-        text.draw()
+        return TrialState(name="retrival", stims=[text], duration=3.0, wait_keys=True,
+                          on_start=lambda: self._retrival_appear(trial_times=trial_times, is_example=is_example),
+                          on_end=lambda key, rt_ms: self._on_retrival(key=key, rt_ms=rt_ms, trial_times=trial_times,
+                                                                      trial_answers=trial_answers, is_example=is_example))
 
+    def _retrival_appear(self, trial_times: dict, is_example: bool = False):
+        """record OBJECT_DISAPPEAR and START_RETRIVAL_TIME timestamps and send START_RETRIVAL_TIME trigger"""
         if not is_example:
             trial_times[TimeAttribute.OBJECT_DISAPPEAR] = datetime.now().strftime(StringEnums.MILI_SEC_FORMAT)[:-3]
             trial_times[TimeAttribute.START_RETRIVAL_TIME] = datetime.now().strftime(StringEnums.MILI_SEC_FORMAT)[:-3]
             send_to_parallel_port(parallel_port=self.parallel_port, pulse_number=ParallelPortEnums.START_RETRIVAL_TIME)
 
-        self.win.flip()
-        keys = event.waitKeys(maxWait=3.0)
+    def _on_retrival(self, key: str, rt_ms: int, trial_times: dict, trial_answers: dict, is_example: bool = False):
+        """record RETRIVAL_TIME, RETRIVAL_RT and send ANSWER_ON_RETRIVAL_TIME trigger, save RETRIVAL_SUCCESS"""
         if not is_example:
             trial_times[TimeAttribute.RETRIVAL_TIME] = datetime.now().strftime(StringEnums.MILI_SEC_FORMAT)[:-3]
+            trial_times[TimeAttribute.RETRIVAL_RT] = rt_ms
             send_to_parallel_port(parallel_port=self.parallel_port,pulse_number=ParallelPortEnums.ANSWER_ON_RETRIVAL_TIME)
-        trial_answers[StringEnums.RETRIVAL_SUCCESS] = keys is not None
-
-    def _subject_report_retrival_success(self, trial_times: dict, trial_answers: dict, is_example: bool = False) -> list:
-        """show 3 options for what the subject remembers (color / scene / both).
-           options are displayed at arrow key positions:
-               up=nothing, left=color, right=scene, down=both
-           saves RETRIVAL_REPORT_TIME to trial_times.
-           return: list of remembered categories ([Features.COLORS], [Features.SCENES],
-                   [Features.COLORS, Features.SCENES], or [] for nothing)"""
+        trial_answers[StringEnums.RETRIVAL_SUCCESS] = key is not None
 
-        for key, option in BindingAndTestEnums.RETRIVAL_OPTION.items():
-            visual.TextStim(self.win, text=option[StringEnums.TEXT], pos=option[StringEnums.LOCATION],
-                            height=BindingAndTestEnums.TEXT_HEIGHT, languageStyle='rtl', font=StringEnums.ARIAL_FONT).draw()
+    def _retrival_report_stims(self) -> list:
+        """create the 3 options for what the subject remembers (color / scene / both).
+           options are displayed at arrow key positions: left=color, right=scene, down=both"""
+        return [visual.TextStim(self.win, text=option[StringEnums.TEXT], pos=option[StringEnums.LOCATION],
+                                height=BindingAndTestEnums.TEXT_HEIGHT, languageStyle='rtl', font=StringEnums.ARIAL_FONT)
+                for option in BindingAndTestEnums.RETRIVAL_OPTION.values()]
 
+    def _retrival_report_appear(self, trial_times: dict, is_example: bool = False):
+        """record RETRIVAL_QUESTION_APPEAR timestamp and send SHOW_RETRIVAL_QUESTION trigger"""
         if not is_example:
             trial_times[TimeAttribute.RETRIVAL_QUESTION_APPEAR] = datetime.now().strftime(StringEnums.MILI_SEC_FORMAT)[:-3]
             send_to_parallel_port(parallel_port=self.parallel_port, pulse_number=ParallelPortEnums.SHOW_RETRIVAL_QUESTION)
 
-        self.win.flip()
-        remember_choose = event.waitKeys(keyList=list(BindingAndTestEnums.RETRIVAL_OPTION.keys()))[0]
-
+    def _on_retrival_report(self, remember_choose: str, rt_ms: int, trial_times: dict, trial_answers: dict,
+                            question_order: list, is_example: bool = False):
+        """handle the subject's report of what they remember:
+           saves RETRIVAL_REPORT_TIME and RETRIVAL_REPORT_RT to trial_times, RETRIVAL_REPORT_COLOR / SCENE to
+           trial_answers, and fills question_order with the remembered categories ([Features.COLORS],
+           [Features.SCENES] or [Features.COLORS, Features.SCENES]) in random order"""
         if not is_example:
             trial_times[TimeAttribute.RETRIVAL_REPORT_TIME] = datetime.now().strftime(StringEnums.MILI_SEC_FORMAT)[:-3]
+            trial_times[TimeAttribute.RETRIVAL_REPORT_RT] = rt_ms
             send_to_parallel_port(parallel_port=self.parallel_port, pulse_number=ParallelPortEnums.ANSWER_RETRIVAL_QUESTION)
 
         trial_answers[StringEnums.RETRIVAL_REPORT_COLOR] = Features.COLORS in BindingAndTestEnums.RETRIVAL_OPTION[remember_choose][StringEnums.LIST]
         trial_answers[StringEnums.RETRIVAL_REPORT_SCENE] = Features.SCENES in BindingAndTestEnums.RETRIVAL_OPTION[remember_choose][StringEnums.LIST]
 
-        return BindingAndTestEnums.RETRIVAL_OPTION[remember_choose][StringEnums.LIST]
+        question_order.extend(BindingAndTestEnums.RETRIVAL_OPTION[remember_choose][StringEnums.LIST])
+        random.shuffle(question_order)
+
+    @staticmethod
+    def _next_question(question_order: list, after: str = None) -> str:
+        """name of the next category question state in question_order (the first one, or the one after the
+           given category), or END when no question is left"""
+        remaining = question_order[question_order.index(after) + 1:] if after is not None else question_order
+        return f"{remaining[0]}_question" if remaining else TrialRunnerEnums.END
 
-    def _show_question(self, category: str, trial_times: dict, is_example: bool = False):
+    def _question_states(self, category: str, trial_times: dict, trial_answers: dict, on_done: Callable,
+                         is_example: bool = False) -> list:
         """ask subject to choose the correct feature for a category:
             input: category: the feature category to ask about (e.g., Colors, Scenes)
                    trial_times: dict to store timing data
-            output: the feature name the subject selected
+                   trial_answers: dict the chosen feature is saved to (under the category)
+                   on_done: returns the state to move to after the question
             1. get all possible features for this category and shuffle them
-            2. display the features as words on screen
-            3. wait for subject to choose and return the answer"""
+            2. display the features as words at the arrow key positions until the subject chooses
+            3. blank screen for 1 second"""
         question_answers = list(Features.CATEGORY_TO_FEATURES[category].keys())
         random.shuffle(question_answers)
-        self._show_words_arrow_locations(words=question_answers, trial_times=trial_times, category=category, is_example=is_example)
-        answer = self._subject_choose(question_answers=question_answers, category=category, trial_times=trial_times, is_example=is_example)
-        show_nothing(win=self.win, min_time=1.0, max_time=1.0)
-        return answer
-
-    def _show_words_arrow_locations(self, words: list, trial_times: dict, category: str, is_example: bool = False):
-        """display feature words at arrow key positions (up, left, right) and record timing"""
+        return [
+            TrialState(name=f"{category}_question", stims=self._words_arrow_locations_stims(words=question_answers),
+                       wait_keys=True, key_list=list(BindingAndTestEnums.ARROW_TO_LOCATION.keys()),
+                       on_start=lambda: self._question_appear(category=category, trial_times=trial_times, is_example=is_example),
+                       on_end=lambda key, rt_ms: self._on_subject_choose(keyboard_answer=key, rt_ms=rt_ms,
+                                                                         question_answers=question_answers, category=category,
+                                                                         trial_times=trial_times, trial_answers=trial_answers,
+                                                                         is_example=is_example)),
+            TrialState(name=f"{category}_blank", duration=1.0, on_end=lambda key, rt_ms: on_done()),
+        ]
+
+    def _words_arrow_locations_stims(self, words: list) -> list:
+        """create the feature words at arrow key positions (up, left, right)"""
         positions = BindingAndTestEnums.FEATURE_QUESTION_POSITIONS
-        texts = [visual.TextStim(self.win, text=HebrewEnums.TRANSLATE.get(word), pos=pos, height=BindingAndTestEnums.TEXT_HEIGHT,
-                                 languageStyle="rtl", font=StringEnums.ARIAL_FONT)
-                 for word, pos in zip(words, positions)]
-
-        for text in texts:
-            text.draw()
+        return [visual.TextStim(self.win, text=HebrewEnums.TRANSLATE.get(word), pos=pos, height=BindingAndTestEnums.TEXT_HEIGHT,
+                                languageStyle="rtl", font=StringEnums.ARIAL_FONT)
+                for word, pos in zip(words, positions)]
 
+    def _question_appear(self, category: str, trial_times: dict, is_example: bool = False):
+        """record <category>_question_appear timestamp and send the category answers trigger"""
         if not is_example:
             trial_times[f'{category}_{StringEnums.QUESTION_APPEAR}'] = datetime.now().strftime(StringEnums.MILI_SEC_FORMAT)[:-3]
             send_to_parallel_port(parallel_port=self.parallel_port,
                                   pulse_number=ParallelPortEnums.CATEGORY_ANSWERS_SHOW_TO_PULSE_CODE[category])
 
-        self.win.flip()
-
-    def _subject_choose(self, question_answers: list, category: str, trial_times: dict, is_example: bool = False):
-        """wait for subject to press arrow key and return the corresponding feature answer"""
-        keyboard_answer = event.waitKeys(keyList=list(BindingAndTestEnums.ARROW_TO_LOCATION.keys()))[0]
-
+    def _on_subject_choose(self, keyboard_answer: str, rt_ms: int, question_answers: list, category: str,
+                           trial_times: dict, trial_answers: dict, is_example: bool = False):
+        """save the feature at the pressed arrow key position to trial_answers[category].
+           RT is measured from the flip of the words screen and saved as <category>_answer_rt_ms"""
         if not is_example:
             trial_times[f'{category}_{TimeAttribute.ANSWER_TIME}'] = datetime.now().strftime(StringEnums.MILI_SEC_FORMAT)[:-3]
+            trial_times[f'{category}_{TimeAttribute.ANSWER_RT}'] = rt_ms
             send_to_parallel_port(parallel_port=self.parallel_port,
                                   pulse_number=ParallelPortEnums.CATEGORY_QUESTION_ANSWER_TO_PULSE_CODE[category])
 
-        answer = question_answers[BindingAndTestEnums.ARROW_TO_LOCATION[keyboard_answer]]
-        return answer
+        trial_answers[category] = question_answers[BindingAndTestEnums.ARROW_TO_LOCATION[keyboard_answer]]
 
     def _write_subject_answers(self, object_path: Path, subject_answer: dict, trial_times: dict):
         """save subject's answers and timing data to self.subject_answers dict"""
@@ -201,6 +243,7 @@ class TestPhase:
             StringEnums.TRAIL_TIMES: trial_times,
         }
 
+    @timeline.instrument(kind=TimelineEnums.OVERHEAD)
     def save_subject_answer(self, time):
         """save final subject answers to JSON and CSV files"""
         subject_answer_folder = f"{Paths.SAVE_DATA_FOLDER}subject_{self.subject_id}/{StringEnums.SUBJECT_ANSWER}/"
@@ -213,19 +256,20 @@ class TestPhase:
         subject_answer_df.to_csv(f'{subject_answer_folder}subject_{self.subject_id}_{time}_{StringEnums.SUBJECT_ANSWER}.csv')
 
     def _temp_save(self, trial: int):
-        """save temporary backup after each trial for crash recovery"""
+        """save temporary backup after each trial for crash recovery (written by the helper)"""
         temp_save_path = f'{Paths.SAVE_TEMP_FOLDER}subject_{self.subject_id}/'
-
-        Path(temp_save_path).mkdir(parents=True, exist_ok=True)
         curr_time = datetime.now().strftime(StringEnums.MILI_SEC_FORMAT)[:-3]
-        with open(f'{temp_save_path}subject_{self.subject_id}_subject_answers_trial_{trial}_{curr_time}.json', 'w') as f:
-            json.dump(self.subject_answers, f)
 
-        subject_answer_df = self.convert_answer_to_df()
-        subject_answer_df.to_csv(f'{temp_save_path}subject_{self.subject_id}_subject_answers_trial_{trial}_{curr_time}.csv')
+        self.helper.submit(save_backup,
+                           json_files={f'{temp_save_path}subject_{self.subject_id}_subject_answers_trial_{trial}_{curr_time}.json': self.subject_answers},
+                           csv_files={f'{temp_save_path}subject_{self.subject_id}_subject_answers_trial_{trial}_{curr_time}.csv': self._answer_rows()})
 
     def convert_answer_to_df(self):
         """convert self.subject_answers dict to pandas DataFrame with one row per trial"""
+        return pd.DataFrame(self._answer_rows())
+
+    def _answer_rows(self) -> list:
+        """flatten self.subject_answers to one row dict per trial"""
         rows = []
         for trial_index, trial_data in self.subject_answers.items():
             trial_times = trial_data.get(StringEnums.TRAIL_TIMES, {})
@@ -248,5 +292,5 @@ class TestPhase:
                     }
                     row.update(trial_times)
                     rows.append(row)
-        return pd.DataFrame(rows)
+        return rows
 
@@ -0,0 +1,243 @@
+import csv
+import gc
+import json
+import random
+from collections import deque
+from pathlib import Path
+from typing import Callable
+import psychopy
+from psychopy import core
+
+from src.binding_task.enums.Enums import TrialRunnerEnums, TimelineEnums, TimeAttribute
+from src.binding_task.response_keyboard import ResponseKeyboard
+from src.binding_task.session_timeline import timeline
+
+
+class TrialState:
+    def __init__(self, name: str, stims: list = None, duration=None, wait_keys: bool = False, key_list: list = None,
+                 on_start: Callable = None, on_end: Callable = None, frame_stats: dict = None):
+        """one screen of a trial:
+            input: name: unique name of the state inside the trial (used for transitions)
+                   stims: psychopy stimuli drawn on every frame of the state (empty list = blank screen)
+                   duration: seconds on screen, a (min, max) tuple for a random duration,
+                             or the max wait of a response state (None = wait forever)
+                   wait_keys: if True the state ends on a key press from key_list (or after duration)
+                   key_list: allowed keys for a response state (None = any key)
+                   on_start: called once right before the first flip (timestamps, triggers)
+                   on_end: called with (key, rt_ms) when the state ends, returns the name of the next state,
+                           TrialRunnerEnums.END to finish the trial, or None to continue to the next state in order
+                   frame_stats: for critical presentations, the dict (trial_times) that gets the dropped frame count
+                                and max frame interval of the state, keyed f'{name}_{TimeAttribute.DROPPED_FRAMES}'
+                                and f'{name}_{TimeAttribute.MAX_FRAME_INTERVAL}'.
+                                background tasks do not run during a state with frame_stats"""
+        self.name = name
+        self.stims = stims or []
+        self.duration = random.uniform(*duration) if isinstance(duration, tuple) else duration
+        self.wait_keys = wait_keys
+        self.key_list = key_list
+        self.on_start = on_start
+        self.on_end = on_end
+        self.frame_stats = frame_stats
+
+
+class FrameLog:
+    def __init__(self):
+        """session log of the frame statistics of every critical presentation, for excluding trials
+           with dropped frames from the EEG analysis"""
+        self.rows = []
+
+    def add(self, trial_label: str, state_name: str, n_frames: int, dropped_frames: int, max_interval_ms: float):
+        """record one presentation, flagged if it dropped more than MAX_DROPPED_FRAMES frames"""
+        self.rows.append({'trial': trial_label, 'state': state_name, 'n_frames': n_frames,
+                          TimeAttribute.DROPPED_FRAMES: dropped_frames,
+                          TimeAttribute.MAX_FRAME_INTERVAL: max_interval_ms,
+                          'flagged': dropped_frames > TrialRunnerEnums.MAX_DROPPED_FRAMES})
+
+    def save(self, folder: str, file_prefix: str):
+        """write the frame statistics of the session:
+            1. <file_prefix>_frame_stats.csv: one row per critical presentation
+            2. <file_prefix>_frame_stats_summary.json: counts and the flagged trials to exclude
+            3. print the summary line"""
+        if not self.rows:
+            return
+        Path(folder).mkdir(parents=True, exist_ok=True)
+
+        with open(Path(folder) / f"{file_prefix}_frame_stats.csv", 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=list(self.rows[0].keys()))
+            writer.writeheader()
+            writer.writerows(self.rows)
+
+        flagged = [row for row in self.rows if row['flagged']]
+        summary = {'presentations': len(self.rows),
+                   'flagged': len(flagged),
+                   TimeAttribute.DROPPED_FRAMES: sum(row[TimeAttribute.DROPPED_FRAMES] for row in self.rows),
+                   TimeAttribute.MAX_FRAME_INTERVAL: max(row[TimeAttribute.MAX_FRAME_INTERVAL] for row in self.rows),
+                   'flagged_trials': [f"{row['trial']}/{row['state']}" for row in flagged]}
+        with open(Path(folder) / f"{file_prefix}_frame_stats_summary.json", 'w') as f:
+            json.dump(summary, f, indent=2)
+
+        print(f"  [frames] {len(flagged)}/{len(self.rows)} critical presentations dropped frames "
+              f"(max interval {summary[TimeAttribute.MAX_FRAME_INTERVAL]:.1f} ms)")
+
+
+frame_log = FrameLog()
+
+
+class TrialRunner:
+    def __init__(self, win: psychopy.visual.window.Window, response_keyboard: ResponseKeyboard):
+        """run trials as state machines ticked once per frame instead of chains of blocking waits:
+            every frame the runner draws the current state, flips, polls the keyboard without blocking,
+            and spends the idle part of the frame (up to BACKGROUND_FRAME_FRACTION of the frame period)
+            on scheduled background tasks such as temp saves and pre-rendering the next stimulus.
+            while trials run the process is in realtime mode (raised priority, garbage collection disabled),
+            until flush() at the end of a block or before a break.
+            the flip times of states with frame_stats are kept, and their frame statistics are written
+            at the flip that ends their last frame (the first flip of the next state)."""
+        self.win = win
+        self.response_keyboard = response_keyboard
+        self.clock = core.Clock()
+        self.frame_period = win.monitorFramePeriod
+        self.frame_budget = self.frame_period * TrialRunnerEnums.BACKGROUND_FRAME_FRACTION
+        self.background_tasks = deque()
+        self.budget_overruns = 0
+        self.realtime = False
+        self.trial_label = None
+        self.pending_frames = None
+
+    def schedule(self, task: Callable):
+        """queue a background task (a callable without arguments) to run in an idle part of a frame"""
+        self.background_tasks.append(task)
+
+    def flush(self):
+        """run all pending background tasks now and leave realtime mode (end of a block, break or phase)"""
+        while self.background_tasks:
+            self._run_task(self.background_tasks.popleft())
+        self._leave_realtime()
+
+    def run(self, states: list, trial_label: str = None):
+        """run one trial:
+            input: states: list of TrialState, started from the first one
+                   trial_label: identifies the trial in the session frame log (None for examples)
+            1. run the current state frame by frame until its duration passes or a key is pressed
+            2. ask the state's on_end for the next state (default: the next one in the list)
+            3. finish when on_end returns END or the last state ended"""
+        self.trial_label = trial_label
+        with timeline.span(name=TimelineEnums.TRIAL, kind=TimelineEnums.TRIAL):
+            self._run_states(states=states)
+        if self.pending_frames is not None:
+            self._finish_frame_stats(offset=None)
+
+    def _run_states(self, states: list):
+        """run the states of one trial (see run)"""
+        self._enter_realtime()
+        index_by_name = {state.name: index for index, state in enumerate(states)}
+        index = 0
+        while index < len(states):
+            state = states[index]
+            key, rt_ms = self._run_state(state)
+            next_state = state.on_end(key, rt_ms) if state.on_end else None
+            if next_state == TrialRunnerEnums.END:
+                return
+            index = index + 1 if next_state is None else index_by_name[next_state]
+
+    def _run_state(self, state: TrialState) -> tuple:
+        """tick the state once per frame, output: (key, rt_ms) for response states, (None, None) otherwise.
+           the frames of the state are a subject wait (response state) or a display wait (timed state) on the
+           session timeline, on_start (triggers, timestamps) before them is overhead"""
+        if state.on_start:
+            state.on_start()
+        if state.wait_keys:
+            self.response_keyboard.start_on_flip(win=self.win)
+
+        flip_times = [] if state.frame_stats is not None else None
+        wait_kind = TimelineEnums.SUBJECT_WAIT if state.wait_keys else TimelineEnums.DISPLAY_WAIT
+        with timeline.span(name=state.name, kind=wait_kind):
+            key, rt_ms = self._run_frames(state=state, flip_times=flip_times)
+        if flip_times is not None:
+            self.pending_frames = (state, self.trial_label, flip_times)
+        return key, rt_ms
+
+    def _run_frames(self, state: TrialState, flip_times: list = None) -> tuple:
+        """draw, flip and poll the state once per frame until it ends (see _run_state),
+           appending the time of every flip to flip_times if given"""
+        onset = None
+        while True:
+            for stim in state.stims:
+                stim.draw()
+            self.win.flip()
+            frame_start = self.clock.getTime()
+            if onset is None:
+                onset = frame_start
+                if self.pending_frames is not None:
+                    self._finish_frame_stats(offset=frame_start)
+            if flip_times is not None:
+                flip_times.append(frame_start)
+
+            if state.wait_keys:
+                key, rt_ms = self.response_keyboard.get_keys(key_list=state.key_list)
+                if key is not None:
+                    return key, rt_ms
+
+            # end on the frame whose successor flip is the first at or after onset + duration
+            if state.duration is not None and frame_start + self.frame_period >= onset + state.duration - self.frame_period / 2:
+                return None, None
+
+            # critical presentations (frame_stats) get no background work, so no task runs right after an onset
+            if state.frame_stats is None:
+                self._run_background(frame_start=frame_start)
+
+    def _finish_frame_stats(self, offset: float = None):
+        """compute the frame statistics of the pending presentation from its flip times and the flip that
+           ended it (offset, None at the end of a trial), write them to its frame_stats dict and the frame log:
+            a frame interval longer than DROPPED_FRAME_THRESHOLD frame periods counts the refreshes it missed"""
+        state, trial_label, flip_times = self.pending_frames
+        self.pending_frames = None
+        times = flip_times + [offset] if offset is not None else flip_times
+        intervals = [later - earlier for earlier, later in zip(times, times[1:])]
+        dropped_frames = sum(max(round(interval / self.frame_period) - 1, 1) for interval in intervals
+                             if interval > self.frame_period * TrialRunnerEnums.DROPPED_FRAME_THRESHOLD)
+        max_interval_ms = round(max(intervals, default=0.0) * 1000, 2)
+
+        state.frame_stats[f'{state.name}_{TimeAttribute.DROPPED_FRAMES}'] = dropped_frames
+        state.frame_stats[f'{state.name}_{TimeAttribute.MAX_FRAME_INTERVAL}'] = max_interval_ms
+        frame_log.add(trial_label=trial_label or 'example', state_name=state.name, n_frames=len(flip_times),
+                      dropped_frames=dropped_frames, max_interval_ms=max_interval_ms)
+
+    def _run_background(self, frame_start: float):
+        """run queued background tasks while the frame budget allows (a started task always runs to completion).
+           each task runs at most once per frame, so a task that re-schedules itself polls once per frame"""
+        for _ in range(len(self.background_tasks)):
+            if self.clock.getTime() - frame_start >= self.frame_budget:
+                break
+            self._run_task(self.background_tasks.popleft())
+        if self.clock.getTime() - frame_start > self.frame_period:
+            self.budget_overruns += 1
+
+    @staticmethod
+    def _run_task(task: Callable):
+        """run one background task as an overhead span of the session timeline
+           (hidden inside the wait of the current state when run from an idle frame)"""
+        name = getattr(task, '__name__', None) or getattr(getattr(task, 'func', None), '__name__', 'background_task')
+        with timeline.span(name=name, kind=TimelineEnums.OVERHEAD):
+            task()
+
+    def _enter_realtime(self):
+        """raise the process priority and disable garbage collection, so a GC pause can not delay a flip"""
+        if self.realtime:
+            return
+        self.realtime = True
+        if TrialRunnerEnums.DISABLE_GC_DURING_TRIALS:
+            gc.disable()
+        if TrialRunnerEnums.RAISE_PRIORITY:
+            core.rush(True)
+
+    def _leave_realtime(self):
+        """restore normal priority, re-enable garbage collection and collect what the trials left"""
+        if not self.realtime:
+            return
+        self.realtime = False
+        if TrialRunnerEnums.RAISE_PRIORITY:
+            core.rush(False)
+        if TrialRunnerEnums.DISABLE_GC_DURING_TRIALS:
+            gc.enable()
+            gc.collect()
@@ -3,7 +3,8 @@ from collections import Counter
 import psychopy
 from psychopy import visual, core, event, parallel
 
-from src.binding_task.enums.Enums import StringEnums, BindingAndTestEnums
+from src.binding_task.enums.Enums import StringEnums, BindingAndTestEnums, TimelineEnums
+from src.binding_task.session_timeline import timeline
 
 def shuffle_trials(items, max_consecutive=2):
     """Shuffle items ensuring no more than max_consecutive identical items in a row.
@@ -70,14 +71,15 @@ def show_instruction(win: psychopy.visual.window.Window, instruction: str, time:
         1. create text stimulus with RTL support for Hebrew
         2. draw and flip to screen
         3. if time provided, wait for that duration; otherwise wait for any keypress"""
-    text = visual.TextStim(win, text=instruction, font=StringEnums.ARIAL_FONT, pos=(0, 0),
-                           height=BindingAndTestEnums.TEXT_HEIGHT, languageStyle='rtl', wrapWidth=1.8)
+    text = instruction_stim(win=win, instruction=instruction)
     text.draw()
     win.flip()
     if time is not None:
-        core.wait(time)
+        with timeline.span(name="instruction", kind=TimelineEnums.DISPLAY_WAIT):
+            core.wait(time)
     else:
-        event.waitKeys()
+        with timeline.span(name="instruction", kind=TimelineEnums.SUBJECT_WAIT):
+            event.waitKeys()
 
 def show_fixation(win: psychopy.visual.window.Window, min_time: float, max_time: float):
     """display fixation cross (+) on screen for random duration:
@@ -87,10 +89,20 @@ def show_fixation(win: psychopy.visual.window.Window, min_time: float, max_time:
         1. create white fixation cross text stimulus
         2. draw and flip to screen
         3. wait for random duration between min_time and max_time"""
-    fixation = visual.TextStim(win, text='+', pos=(0, 0), height=0.1, color='white')
+    fixation = fixation_stim(win=win)
     fixation.draw()
     win.flip()
-    core.wait(random.uniform(min_time, max_time))
+    with timeline.span(name="fixation", kind=TimelineEnums.DISPLAY_WAIT):
+        core.wait(random.uniform(min_time, max_time))
+
+def instruction_stim(win: psychopy.visual.window.Window, instruction: str) -> visual.TextStim:
+    """create the centered RTL (Hebrew) instruction text stimulus without drawing it"""
+    return visual.TextStim(win, text=instruction, font=StringEnums.ARIAL_FONT, pos=(0, 0),
+                           height=BindingAndTestEnums.TEXT_HEIGHT, languageStyle='rtl', wrapWidth=1.8)
+
+def fixation_stim(win: psychopy.visual.window.Window) -> visual.TextStim:
+    """create the white fixation cross (+) stimulus without drawing it"""
+    return visual.TextStim(win, text='+', pos=(0, 0), height=0.1, color='white')
 
 def show_nothing(win: psychopy.visual.window.Window, min_time: float, max_time: float):
     """display blank screen for random duration:
@@ -100,8 +112,10 @@ def show_nothing(win: psychopy.visual.window.Window, min_time: float, max_time:
         1. flip window to show blank screen
         2. wait for random duration between min_time and max_time"""
     win.flip()
-    core.wait(random.uniform(min_time, max_time))
+    with timeline.span(name="blank", kind=TimelineEnums.DISPLAY_WAIT):
+        core.wait(random.uniform(min_time, max_time))
 
+@timeline.instrument(kind=TimelineEnums.OVERHEAD)
 def send_to_parallel_port(parallel_port: parallel.ParallelPort, pulse_number):
     """send trigger pulse to parallel port for EEG/fMRI synchronization:
         input: parallel_port: psychopy ParallelPort object